@@ -6,7 +6,7 @@ from unfold.admin import ModelAdmin, StackedInline
 
 # ADICIONE esta linha:
 from django import forms as django_forms
-from .models import Lavandaria, ItemServico, Servico, Cliente, Pedido, ItemPedido, Funcionario, Recibo, PagamentoPedido
+from .models import Lavandaria, ItemServico, Servico, Cliente, Pedido, ItemPedido, Funcionario, Recibo, PagamentoPedido, TarefaRelatorio
 from django.utils.html import format_html
 from django.contrib.auth.admin import GroupAdmin as BaseGroupAdmin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
@@ -15,14 +15,14 @@ from django.contrib.auth.models import Group, User
 from django.contrib import messages
 import requests
 import json
+import base64
 from django.urls import reverse
 from import_export.admin import ImportExportModelAdmin
 from unfold.contrib.import_export.forms import ExportForm, ImportForm
 from unfold.contrib.filters.admin import RangeDateTimeFilter
 from django.template.loader import render_to_string
-from xhtml2pdf import pisa
 from io import BytesIO
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from datetime import datetime
 from django.utils import timezone
 from django.contrib import admin
@@ -31,87 +31,105 @@ from unfold.admin import ModelAdmin, StackedInline
 
 from decimal import Decimal
 from django.contrib import admin, messages
-from django.db.models import Sum, DecimalField, Value
-from django.db.models.functions import Coalesce
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.utils import timezone
 from django.urls import path, reverse
 from django.shortcuts import redirect
 from django.utils.html import format_html
 
 from unfold.admin import ModelAdmin
-from .models import Pedido, PagamentoPedido, Funcionario
+from .models import Pedido, PagamentoPedido, Funcionario, quitar_pedidos
+from .middleware import obter_funcionario
+from .recalculo import agendar_recalculo
+from .tarefas import enfileirar
+from .exportacao import (
+    CABECALHO_MOVIMENTOS, CABECALHO_VENDAS, itens_para_exportar, linhas_movimentos, linhas_vendas, resposta_csv,
+)
+from .relatorios import ler_movimentos, movimentos, pagamentos_periodo, periodo_pedidos
+from .recibos import recibos_png_em_lote
 
 admin.site.unregister(Group)
 admin.site.unregister(User)
 
 
-def gerar_relatorio_pdf(modeladmin, request, queryset):
-    # 🔥 Otimiza queryset para evitar N+1 queries
-    queryset = queryset.prefetch_related('itens')
-
-    # 🔥 Processa os totais por pedido
-    for pedido in queryset:
-        itens = pedido.itens.all()
-        pedido.total_quantidade = sum(item.quantidade for item in itens)
-        pedido.total_valor = sum(item.preco_total for item in itens)
-
-    # 🔥 Totais gerais
-    total_quantidade = sum(pedido.total_quantidade for pedido in queryset)
-    total_valor = sum(pedido.total_valor for pedido in queryset)
-
-    # 🔥 Datas do relatório
-    if queryset.exists():
-        start_date = timezone.localtime(queryset.first().criado_em).strftime('%d/%m/%Y')
-        end_date = timezone.localtime(queryset.last().criado_em).strftime('%d/%m/%Y')
+def _resposta_tarefa(request, tarefa):
+    """
+    Resposta das ações de relatório: o PDF é gerado pelo worker (core/tarefas.py)
+    e descarregado depois em "Tarefas de relatório".
+    """
+    if tarefa.estado == "concluido":
+        # gerado já neste processo (RELATORIOS_EM_SEGUNDO_PLANO = False)
+        return redirect("admin:core_tarefarelatorio_descarregar", tarefa.pk)
+    if tarefa.estado == "erro":
+        messages.error(request, f"Erro ao gerar o relatório: {tarefa.mensagem}")
+        return None
+    messages.info(request, format_html(
+        'Relatório em preparação (tarefa #{}). Acompanhe e descarregue em <a href="{}">Tarefas de relatório</a>.',
+        tarefa.pk, reverse("admin:core_tarefarelatorio_changelist"),
+    ))
+    return None
+
+
+def _parametros_vendas(queryset):
+    # 🔥 Datas do relatório: primeiro e último pedido, numa consulta
+    inicio, fim = periodo_pedidos(queryset)
+    if inicio is not None:
+        start_date = timezone.localtime(inicio).strftime('%d/%m/%Y')
+        end_date = timezone.localtime(fim).strftime('%d/%m/%Y')
     else:
         start_date = end_date = datetime.today().strftime('%d/%m/%Y')
 
-    # 🔥 Renderiza HTML
-    html_string = render_to_string('core/relatorio_vendas.html', {
-        'pedidos': queryset,
-        'total_quantidade': total_quantidade,
-        'total_valor': total_valor,
-        'start_date': start_date,
-        'end_date': end_date
-    })
+    # 🔥 Pedidos selecionados, pela ordem da lista
+    return {
+        "pedido_ids": list(queryset.values_list("pk", flat=True)),
+        "ordem": [campo for campo in queryset.query.order_by if isinstance(campo, str)],
+        "start_date": start_date,
+        "end_date": end_date,
+    }
+
+
+def gerar_relatorio_pdf(modeladmin, request, queryset):
+    # o PDF é feito pelo worker (core/tarefas.py)
+    tarefa = enfileirar("vendas", _parametros_vendas(queryset), request.user)
+    return _resposta_tarefa(request, tarefa)
 
-    # 🔥 Cria PDF
-    buffer = BytesIO()
-    filename = f"relatorio_vendas_{start_date}_a_{end_date}.pdf"
-    pisa_status = pisa.CreatePDF(html_string, dest=buffer)
 
-    # 🔥 Verifica erros
-    if pisa_status.err:
-        return HttpResponse("Erro ao gerar PDF", content_type="text/plain")
+def exportar_vendas_csv(modeladmin, request, queryset):
+    # 📄 CSV enviado enquanto é lido da base (uma linha por item)
+    parametros = _parametros_vendas(queryset)
+    nome = f"vendas_{parametros['start_date']}_a_{parametros['end_date']}.csv".replace("/", "-")
+    return resposta_csv(nome, CABECALHO_VENDAS, linhas_vendas(itens_para_exportar(queryset)))
 
-    buffer.seek(0)
-    response = HttpResponse(buffer, content_type="application/pdf")
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    return response
 
+def exportar_vendas_xlsx(modeladmin, request, queryset):
+    # 📊 XLSX gerado pelo worker, como o PDF
+    tarefa = enfileirar("vendas", {**_parametros_vendas(queryset), "formato": "xlsx"}, request.user)
+    return _resposta_tarefa(request, tarefa)
 
-from django.db.models import Sum, Count
-from django.db.models.functions import Coalesce
 
-DECIMAL_0 = Value(Decimal("0.00"), output_field=DecimalField(max_digits=12, decimal_places=2))
+gerar_relatorio_pdf.short_description = "Relatório de vendas (PDF)"
+exportar_vendas_csv.short_description = "Exportar vendas (CSV)"
+exportar_vendas_xlsx.short_description = "Exportar vendas (XLSX)"
 
 
-def gerar_relatorio_financeiro(modeladmin, request, queryset):
+def _parametros_financeiro(request, queryset):
     """
     RELATÓRIO FINANCEIRO (Caixa) - FILTRADO POR LAVANDARIA DO USUÁRIO
-    Mostra APENAS os pagamentos da lavandaria do usuário logado
+    Parâmetros da tarefa (lavandaria do usuário, período e pedidos), ou None
+    (com a mensagem de erro já registada).
     """
 
     # ===== PEGAR LAVANDARIA DO USUÁRIO =====
     try:
-        funcionario = Funcionario.objects.get(user=request.user)
+        funcionario = obter_funcionario(request)
         lavandaria_usuario = funcionario.lavandaria
         if not lavandaria_usuario:
             messages.error(request, "Você não está associado a nenhuma lavandaria!")
-            return redirect(request.META.get('HTTP_REFERER', 'admin:index'))
+            return None
     except Funcionario.DoesNotExist:
         messages.error(request, "Usuário não é um funcionário válido!")
-        return redirect(request.META.get('HTTP_REFERER', 'admin:index'))
+        return None
 
     # ===== CAPTURAR O FILTRO DE DATA DO ADMIN =====
     data_inicio = request.GET.get('data_pagamento_from_0')
@@ -134,160 +152,62 @@ def gerar_relatorio_financeiro(modeladmin, request, queryset):
             start_dt = timezone.now() - timezone.timedelta(days=30)
             end_dt = timezone.now()
     else:
-        if queryset.exists():
-            start_dt = queryset.first().criado_em
-            end_dt = queryset.last().criado_em
-        else:
+        # 🔥 primeiro e último pedido, numa consulta (a lista vem por -criado_em)
+        start_dt, end_dt = periodo_pedidos(queryset)
+        if start_dt is None:
             now = timezone.now()
             start_dt = now - timezone.timedelta(days=30)
             end_dt = now
 
-    # ===== BUSCAR APENAS PAGAMENTOS DA LAVANDARIA DO USUÁRIO =====
-    pagamentos = (
-        PagamentoPedido.objects
-        .filter(pago_em__gte=start_dt, pago_em__lte=end_dt)
-        .filter(pedido__lavandaria=lavandaria_usuario)  # ← FILTRO POR LAVANDARIA
-        .select_related(
-            "pedido", 
-            "pedido__cliente", 
-            "pedido__lavandaria", 
-            "criado_por", 
-            "criado_por__user"
-        )
-        .order_by("pago_em", "id")
-    )
+    # ===== RELATÓRIO (apenas pagamentos da lavandaria do usuário, ver core/relatorios.py) =====
+    # Se o usuário selecionou pedidos específicos, só os pagamentos desses pedidos.
+    pedido_ids = list(queryset.values_list("pk", flat=True))
+    return {
+        "lavandaria_id": lavandaria_usuario.pk,
+        "start_dt": start_dt.isoformat(),
+        "end_dt": end_dt.isoformat(),
+        "pedido_ids": pedido_ids or None,
+    }
 
-    # Se o usuário selecionou pedidos específicos, podemos filtrar
-    if queryset.exists():
-        # Mas ainda assim, só da lavandaria dele
-        pagamentos = pagamentos.filter(pedido__in=queryset.filter(lavandaria=lavandaria_usuario))
 
-    # ===== PEDIDOS RELACIONADOS (apenas da lavandaria) =====
-    pedidos_ids = pagamentos.values_list('pedido_id', flat=True).distinct()
-    qs_pedidos = Pedido.objects.filter(
-        id__in=pedidos_ids,
-        lavandaria=lavandaria_usuario  # ← Garantir que são da lavandaria
-    )
+def gerar_relatorio_financeiro(modeladmin, request, queryset, formato="pdf"):
+    parametros = _parametros_financeiro(request, queryset)
+    if parametros is None:
+        return redirect(request.META.get('HTTP_REFERER', 'admin:index'))
 
-    # ===== TOTAIS =====
-    total_faturado = Decimal("0.00")
-    for p in qs_pedidos:
-        total_faturado += p.total_final
+    # O PDF/XLSX é gerado pelo worker (core/tarefas.py).
+    tarefa = enfileirar("financeiro", {**parametros, "formato": formato}, request.user)
+    return _resposta_tarefa(request, tarefa)
 
-    total_recebido = pagamentos.aggregate(
-        t=Coalesce(Sum("valor"), DECIMAL_0)
-    )["t"]
 
-    # ===== SALDOS POR PEDIDO =====
-    saldo_total = Decimal("0.00")
-    pedidos_em_aberto = []
-    
-    pagamentos_por_pedido = {}
-    for pag in pagamentos:
-        if pag.pedido_id not in pagamentos_por_pedido:
-            pagamentos_por_pedido[pag.pedido_id] = Decimal("0.00")
-        pagamentos_por_pedido[pag.pedido_id] += pag.valor
-    
-    for p in qs_pedidos:
-        total_final = p.total_final
-        pago_no_periodo = pagamentos_por_pedido.get(p.id, Decimal("0.00"))
-        
-        todos_pagamentos = PagamentoPedido.objects.filter(
-            pedido=p,
-            pedido__lavandaria=lavandaria_usuario
-        )
-        total_pago_historico = todos_pagamentos.aggregate(
-            t=Coalesce(Sum("valor"), DECIMAL_0)
-        )["t"]
-        
-        saldo_real = total_final - total_pago_historico
-        
-        if saldo_real > 0.01:
-            pedidos_em_aberto.append({
-                "pedido": p,
-                "total_final": total_final,
-                "total_pago_historico": total_pago_historico,
-                "pago_no_periodo": pago_no_periodo,
-                "saldo": saldo_real,
-            })
-            saldo_total += saldo_real
-
-    # ===== RESUMOS (apenas pagamentos da lavandaria) =====
-    resumo_por_metodo = (
-        pagamentos.values("metodo_pagamento")
-        .annotate(
-            qtd=Count("id"),
-            total=Coalesce(Sum("valor"), DECIMAL_0),
-        )
-        .order_by("-total")
-    )
+def exportar_financeiro_xlsx(modeladmin, request, queryset):
+    # 📊 movimentos, pedidos em aberto e resumos, uma folha cada
+    return gerar_relatorio_financeiro(modeladmin, request, queryset, formato="xlsx")
 
-    resumo_por_dia = (
-        pagamentos
-        .values("pago_em__date")
-        .annotate(
-            qtd=Count("id"),
-            total=Coalesce(Sum("valor"), DECIMAL_0),
-        )
-        .order_by("pago_em__date")
-    )
 
-    # 🔥 RESUMO POR LAVANDARIA (agora vai mostrar apenas a lavandaria do usuário)
-    resumo_por_lavandaria = (
-        pagamentos
-        .values("pedido__lavandaria__nome")
-        .annotate(
-            qtd=Count("id"),
-            total=Coalesce(Sum("valor"), DECIMAL_0),
-        )
-        .order_by("-total")
-    )
+def exportar_financeiro_csv(modeladmin, request, queryset):
+    # 📄 só os movimentos (pagamentos), enviados enquanto são lidos da base
+    parametros = _parametros_financeiro(request, queryset)
+    if parametros is None:
+        return redirect(request.META.get('HTTP_REFERER', 'admin:index'))
 
-    resumo_por_caixa = (
-        pagamentos
-        .values("criado_por__user__username")
-        .annotate(
-            qtd=Count("id"),
-            total=Coalesce(Sum("valor"), DECIMAL_0),
-        )
-        .order_by("-total")
+    start_dt = datetime.fromisoformat(parametros["start_dt"])
+    end_dt = datetime.fromisoformat(parametros["end_dt"])
+    lavandaria = Lavandaria.objects.get(pk=parametros["lavandaria_id"])
+    pedidos = queryset if parametros["pedido_ids"] is not None else None
+    pagamentos = ler_movimentos(movimentos(pagamentos_periodo(lavandaria, start_dt, end_dt, pedidos)))
+
+    nome = "movimentos_{}_{}_a_{}.csv".format(
+        lavandaria.nome,
+        timezone.localtime(start_dt).strftime('%d-%m-%Y'),
+        timezone.localtime(end_dt).strftime('%d-%m-%Y'),
     )
+    return resposta_csv(nome, CABECALHO_MOVIMENTOS, linhas_movimentos(pagamentos))
 
-    start_date = timezone.localtime(start_dt).strftime("%d/%m/%Y")
-    end_date = timezone.localtime(end_dt).strftime("%d/%m/%Y")
 
-    html_string = render_to_string("core/relatorio_financeiro.html", {
-        "lavandaria": lavandaria_usuario,  # ← Agora passa a lavandaria do usuário
-        "start_date": start_date,
-        "end_date": end_date,
-        
-        "total_faturado": total_faturado,
-        "total_recebido": total_recebido,
-        "saldo_total": saldo_total,
-        
-        "resumo_por_metodo": resumo_por_metodo,
-        "resumo_por_dia": resumo_por_dia,
-        "resumo_por_lavandaria": resumo_por_lavandaria,  # ← Só da lavandaria
-        "resumo_por_caixa": resumo_por_caixa,
-        
-        "pagamentos": pagamentos,
-        "pedidos_em_aberto": pedidos_em_aberto,
-        "pedidos": qs_pedidos,
-        
-        "metodos_pagamento_dict": dict(PagamentoPedido.METODO_PAGAMENTO_CHOICES),
-    })
-
-    buffer = BytesIO()
-    filename = f"relatorio_financeiro_{lavandaria_usuario.nome}_{start_date}_a_{end_date}.pdf"
-    pisa_status = pisa.CreatePDF(html_string, dest=buffer)
-
-    if pisa_status.err:
-        return HttpResponse("Erro ao gerar PDF", content_type="text/plain")
-
-    buffer.seek(0)
-    response = HttpResponse(buffer, content_type="application/pdf")
-    response["Content-Disposition"] = f'attachment; filename="{filename}"'
-    return response
+gerar_relatorio_financeiro.short_description = "Relatório financeiro (PDF)"
+exportar_financeiro_csv.short_description = "Exportar movimentos financeiros (CSV)"
+exportar_financeiro_xlsx.short_description = "Exportar relatório financeiro (XLSX)"
 
 @admin.register(User)
 class UserAdmin(BaseUserAdmin, ModelAdmin, ImportExportModelAdmin):
@@ -330,7 +250,7 @@ class PagamentoPedidoInline(StackedInline):
     def save_new_instance(self, form, commit=True):
         obj = super().save_new_instance(form, commit=False)
         try:
-            obj.criado_por = Funcionario.objects.get(user=self.request.user)
+            obj.criado_por = obter_funcionario(self.request)
         except Funcionario.DoesNotExist:
             obj.criado_por = None
         if commit:
@@ -563,7 +483,7 @@ class PedidoAdmin(ModelAdmin, ImportExportModelAdmin):
     def save_model(self, request, obj, form, change):
         # mantém a tua lógica de atribuir funcionario/lavandaria
         try:
-            funcionario = Funcionario.objects.get(user=request.user)
+            funcionario = obter_funcionario(request)
             obj.funcionario = funcionario
             if funcionario.lavandaria:
                 obj.lavandaria = funcionario.lavandaria
@@ -602,42 +522,36 @@ class PedidoAdmin(ModelAdmin, ImportExportModelAdmin):
 
         super().save_model(request, obj, form, change)
 
-        # ✅ recalc após salvar (ex: total mudou por itens)
-        try:
-            obj.recalcular_pagamentos()
-        except Exception:
-            pass
+        # ✅ recalc no commit (ex: desconto mudou); itens/pagamentos dos inlines
+        # juntam-se ao mesmo recálculo
+        agendar_recalculo(obj)
 
     def save_formset(self, request, form, formset, change):
         """
         Garante:
         - criado_por preenchido em PagamentoPedido
-        - recalcular_pagamentos após alterações
+        - recalcular_pagamentos após alterações (agendado, uma vez por pedido)
         """
         instances = formset.save(commit=False)
 
         for inst in instances:
             if isinstance(inst, PagamentoPedido) and not inst.criado_por:
                 try:
-                    inst.criado_por = Funcionario.objects.get(user=request.user)
+                    inst.criado_por = obter_funcionario(request)
                 except Funcionario.DoesNotExist:
                     inst.criado_por = None
             inst.save()
 
         formset.save_m2m()
 
-        obj = form.instance
-        try:
-            obj.recalcular_pagamentos()
-        except Exception:
-            pass
+        agendar_recalculo(form.instance)
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         if request.user.is_superuser:
             return qs
         try:
-            funcionario = Funcionario.objects.get(user=request.user)
+            funcionario = obter_funcionario(request)
             if funcionario.lavandaria:
                 return qs.filter(lavandaria=funcionario.lavandaria)
             raise ValueError("O funcionário logado não está associado a nenhuma lavandaria.")
@@ -646,7 +560,14 @@ class PedidoAdmin(ModelAdmin, ImportExportModelAdmin):
 
     def botao_imprimir(self, obj):
         url = reverse("core:imprimir_recibo_imagem", args=[obj.id])
-        return format_html(f'<a class="button" href="{url}" target="_blank">Imprimir</a>')
+        url_escpos = reverse("core:imprimir_recibo_escpos", args=[obj.id])
+        url_pdf = reverse("core:recibo_pdf", args=[obj.id])
+        return format_html(
+            '<a class="button" href="{}" target="_blank">Imprimir</a> '
+            '<a href="{}" title="Recibo em ESC/POS para a impressora térmica">ESC/POS</a> '
+            '<a href="{}" target="_blank" title="Recibo A4 em PDF">PDF</a>',
+            url, url_escpos, url_pdf,
+        )
 
     botao_imprimir.short_description = "Imprimir Recibo"
 
@@ -746,14 +667,44 @@ class PedidoAdmin(ModelAdmin, ImportExportModelAdmin):
             messages.warning(request,
                              "ERRO. Verifique se os pedidos estão 'prontos' e se os clientes têm número de telefone.")
 
+    def imprimir_recibos_selecionados(self, request, queryset):
+        """
+        Recibos de todos os pedidos seleccionados num só documento (uma
+        página por recibo, um único diálogo de impressão). Os recibos são
+        desenhados em paralelo e enviados ao browser à medida que ficam prontos.
+        """
+        pedido_ids = list(queryset.order_by("pk").values_list("pk", flat=True))
+
+        def documento():
+            yield (
+                '<!DOCTYPE html><html lang="pt"><head><meta charset="UTF-8">'
+                f"<title>Recibos ({len(pedido_ids)})</title>"
+                "<style>body{margin:0;text-align:center}"
+                "img{max-width:100%;height:auto;display:block;margin:0 auto;"
+                "page-break-after:always;break-after:page}</style></head><body>"
+            )
+            for pedido_id, png in recibos_png_em_lote(pedido_ids):
+                img_base64 = base64.b64encode(png).decode("ascii")
+                yield f'<img src="data:image/png;base64,{img_base64}" alt="Recibo {pedido_id}">\n'
+            yield "<script>window.print();</script></body></html>"
+
+        return StreamingHttpResponse(documento(), content_type="text/html; charset=utf-8")
+
+    imprimir_recibos_selecionados.short_description = "Imprimir recibos dos pedidos selecionados"
+
     # mantém as tuas actions operacionais
     actions = [
         "marcar_como_completo",
         "marcar_como_pronto",
         "marcar_como_entregue",
         "enviar_sms_pedido_pronto",
+        "imprimir_recibos_selecionados",
         gerar_relatorio_pdf,
+        exportar_vendas_csv,
+        exportar_vendas_xlsx,
         gerar_relatorio_financeiro,
+        exportar_financeiro_csv,
+        exportar_financeiro_xlsx,
     ]
     enviar_sms_pedido_pronto.short_description = "Enviar mensagem de pedido pronto"
 
@@ -777,7 +728,7 @@ class ReciboAdmin(ModelAdmin):
     def save_model(self, request, obj, form, change):
         try:
             # Obtém o funcionário associado ao usuário logado
-            criado_por = Funcionario.objects.get(user=request.user)
+            criado_por = obter_funcionario(request)
             obj.funcionario = criado_por
 
             # Verifica se o funcionário tem uma lavandaria associada
@@ -791,27 +742,6 @@ class ReciboAdmin(ModelAdmin):
         super().save_model(request, obj, form, change)
 
 
-def _total_pago(pedido: Pedido) -> Decimal:
-    return (
-            PagamentoPedido.objects.filter(pedido=pedido)
-            .aggregate(
-                total=Coalesce(
-                    Sum("valor"),
-                    Value(Decimal("0.00")),
-                    output_field=DecimalField(max_digits=12, decimal_places=2),
-                )
-            )["total"]
-            or Decimal("0.00")
-    )
-
-
-def _saldo(pedido: Pedido) -> Decimal:
-    total = pedido.total or Decimal("0.00")
-    pago = _total_pago(pedido)
-    s = total - pago
-    return s if s > 0 else Decimal("0.00")
-
-
 @admin.register(PagamentoPedido)
 class PagamentoPedidoAdmin(ModelAdmin):
     list_display = ("id", "pedido", "valor", "metodo_pagamento", "pago_em", "criado_por")
@@ -827,16 +757,13 @@ class PagamentoPedidoAdmin(ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         if not obj.criado_por_id:
-            obj.criado_por = Funcionario.objects.get(user=request.user)
+            obj.criado_por = obter_funcionario(request)
         if not obj.pago_em:
             obj.pago_em = timezone.now()
 
+        # O save do pagamento agenda o recálculo do pedido
         super().save_model(request, obj, form, change)
 
-        # Recalcula o pedido
-        if hasattr(obj.pedido, "recalcular_pagamentos"):
-            obj.pedido.recalcular_pagamentos()
-
     # ====== BOTÃO "RECEBER SALDO" NO PEDIDO ======
     def get_urls(self):
         urls = super().get_urls()
@@ -851,23 +778,25 @@ class PagamentoPedidoAdmin(ModelAdmin):
 
     def receber_saldo_view(self, request, pedido_id):
         pedido = Pedido.objects.get(pk=pedido_id)
-        saldo = _saldo(pedido)
+        # com os descontos (total_final), como o registrar_pagamento valida
+        saldo = pedido.calcular_saldo_atual()
 
         if saldo <= 0:
             messages.warning(request, f"Pedido {pedido.id} já está quitado.")
             return redirect(reverse("admin:core_pedido_changelist"))
 
-        # cria pagamento “automaticamente” (método default: numerario)
-        PagamentoPedido.objects.create(
-            pedido=pedido,
-            valor=saldo,
-            metodo_pagamento="numerario",  # podes trocar para um default teu
-            criado_por=Funcionario.objects.get(user=request.user),
-            pago_em=timezone.now(),
-        )
-
-        if hasattr(pedido, "recalcular_pagamentos"):
-            pedido.recalcular_pagamentos()
+        # cria pagamento “automaticamente” (método default: numerario).
+        # registrar_pagamento bloqueia o pedido: num duplo clique o segundo
+        # pedido HTTP já encontra o saldo pago e não duplica o pagamento.
+        try:
+            pedido.registrar_pagamento(
+                valor=saldo,
+                metodo_pagamento="numerario",  # podes trocar para um default teu
+                funcionario=obter_funcionario(request),
+            )
+        except ValidationError as e:
+            messages.error(request, f"Pedido {pedido.id}: {' '.join(e.messages)}")
+            return redirect(reverse("admin:core_pedido_change", args=[pedido.id]))
 
         messages.success(request, f"Recebido saldo do Pedido {pedido.id}: {saldo:.2f} MZN")
         return redirect(reverse("admin:core_pedido_change", args=[pedido.id]))
@@ -879,27 +808,27 @@ class PagamentoPedidoAdmin(ModelAdmin):
         Esta action é chamada na lista de PagamentoPedido, mas vamos ignorar
         os pagamentos e usar os pedidos associados.
         """
-        pedidos = Pedido.objects.filter(id__in=queryset.values_list("pedido_id", flat=True)).distinct()
-        funcionario = Funcionario.objects.get(user=request.user)
-
-        feitos = 0
-        for pedido in pedidos:
-            saldo = _saldo(pedido)
-            if saldo <= 0:
-                continue
-            PagamentoPedido.objects.create(
-                pedido=pedido,
-                valor=saldo,
-                metodo_pagamento="numerario",
-                criado_por=funcionario,
-                pago_em=timezone.now(),
-            )
-            if hasattr(pedido, "recalcular_pagamentos"):
-                pedido.recalcular_pagamentos()
-            feitos += 1
+        pedido_ids = set(queryset.values_list("pedido_id", flat=True))
+
+        # Saldos, pagamentos, estado dos pedidos e pontos em lote, numa transação
+        resultado = quitar_pedidos(
+            pedido_ids,
+            funcionario=obter_funcionario(request),
+            metodo_pagamento="numerario",
+        )
 
-        if feitos:
-            messages.success(request, f"{feitos} pedido(s) quitado(s) com pagamento do saldo.")
+        quitados = [r for r in resultado if r["estado"] == "quitado"]
+        if quitados:
+            total = sum(r["valor"] for r in quitados)
+            pontos = sum(r["pontos"] for r in quitados)
+            messages.success(
+                request,
+                f"{len(quitados)} pedido(s) quitado(s) com pagamento do saldo: {total:.2f} MZN, "
+                f"{pontos} pontos atribuídos.",
+            )
+            com_desconto = [f"#{r['pedido']} ({r['desconto']:.2f})" for r in quitados if r["desconto"] > 0]
+            if com_desconto:
+                messages.info(request, f"Desconto de fidelidade aplicado: {', '.join(com_desconto)}")
         else:
             messages.warning(request, "Nenhum pedido com saldo pendente.")
 
@@ -920,3 +849,89 @@ class PagamentoPedidoAdmin(ModelAdmin):
 
 
 
+
+
+@admin.register(TarefaRelatorio)
+class TarefaRelatorioAdmin(ModelAdmin):
+    list_display = (
+        "id", "tipo", "estado", "progresso_display", "criado_por", "criado_em", "concluido_em",
+        "tamanho_display", "botao_descarregar",
+    )
+    list_filter = ("tipo", "estado")
+    readonly_fields = (
+        "tipo", "estado", "progresso", "tentativas", "mensagem", "nome_ficheiro", "tamanho",
+        "criado_por", "criado_em", "iniciado_em", "concluido_em", "parametros",
+    )
+    exclude = ("conteudo",)
+
+    def get_queryset(self, request):
+        # o ficheiro só é lido ao descarregar
+        qs = super().get_queryset(request).defer("conteudo").select_related("criado_por")
+        if not request.user.is_superuser:
+            qs = qs.filter(criado_por=request.user)
+        return qs
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def progresso_display(self, obj):
+        if obj.estado == "erro":
+            return format_html('<span title="{}">❌ erro</span>', obj.mensagem)
+        return f"{obj.progresso}%"
+
+    progresso_display.short_description = "Progresso"
+
+    def tamanho_display(self, obj):
+        return f"{obj.tamanho / 1024:.0f} KB" if obj.tamanho else "-"
+
+    tamanho_display.short_description = "Tamanho"
+
+    def botao_descarregar(self, obj):
+        if obj.estado != "concluido":
+            return "-"
+        url = reverse("admin:core_tarefarelatorio_descarregar", args=[obj.pk])
+        return format_html('<a class="button" href="{}">Descarregar</a>', url)
+
+    botao_descarregar.short_description = "Ficheiro"
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom = [
+            path(
+                "<int:tarefa_id>/descarregar/",
+                self.admin_site.admin_view(self.descarregar_view),
+                name="core_tarefarelatorio_descarregar",
+            ),
+            path(
+                "<int:tarefa_id>/estado/",
+                self.admin_site.admin_view(self.estado_view),
+                name="core_tarefarelatorio_estado",
+            ),
+        ]
+        return custom + urls
+
+    def descarregar_view(self, request, tarefa_id):
+        tarefa = self.get_queryset(request).defer(None).filter(pk=tarefa_id, estado="concluido").first()
+        if tarefa is None or tarefa.conteudo is None:
+            raise Http404("Relatório não encontrado (pode já ter sido apagado).")
+        return FileResponse(
+            # tipo (PDF ou XLSX) deduzido da extensão do nome do ficheiro
+            BytesIO(tarefa.conteudo), as_attachment=True, filename=tarefa.nome_ficheiro,
+        )
+
+    def estado_view(self, request, tarefa_id):
+        """Estado da tarefa em JSON, para acompanhar o progresso sem recarregar a lista."""
+        tarefa = (
+            self.get_queryset(request)
+            .filter(pk=tarefa_id)
+            .values("estado", "progresso", "mensagem", "tamanho")
+            .first()
+        )
+        if tarefa is None:
+            raise Http404("Tarefa não encontrada.")
+        if tarefa["estado"] == "concluido":
+            tarefa["descarregar"] = reverse("admin:core_tarefarelatorio_descarregar", args=[tarefa_id])
+        return JsonResponse(tarefa)
@@ -0,0 +1,101 @@
+"""
+Catálogo de artigos (ItemServico) em memória, por processo.
+
+Preço, nome e disponibilidade dos artigos são carregados uma vez por worker
+e reutilizados ao gravar itens de pedido, recibos e relatórios. Qualquer
+gravação/remoção de um ItemServico incrementa VersaoDados("catalogo"); cada
+worker compara essa versão com a que tem em memória (no máximo uma consulta
+a cada CATALOGO_VERIFICAR_SEGUNDOS) e recarrega o catálogo quando muda.
+
+Um id que não está no catálogo faz uma verificação da versão fora do
+intervalo (pode ter sido criado noutro worker); se continuar a faltar fica
+registado como ausente e não volta a ser verificado até a versão mudar.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+CHAVE_VERSAO = "catalogo"
+
+ArtigoCatalogo = namedtuple("ArtigoCatalogo", ["id", "nome", "preco_base", "disponivel"])
+
+_lock = threading.Lock()
+_estado = {"versao": None, "verificado_em": 0.0, "artigos": {}, "ausentes": set()}
+
+
+def _intervalo_verificacao():
+    return getattr(settings, "CATALOGO_VERIFICAR_SEGUNDOS", 5)
+
+
+def _carregar(versao):
+    from .models import ItemServico
+
+    artigos = {
+        pk: ArtigoCatalogo(pk, nome, preco_base, disponivel)
+        for pk, nome, preco_base, disponivel in ItemServico.objects.order_by().values_list(
+            "pk", "nome", "preco_base", "disponivel"
+        )
+    }
+    _estado.update(versao=versao, artigos=artigos, ausentes=set())
+
+
+def obter_catalogo(forcar=False, verificar=False):
+    """
+    Devolve {id: ArtigoCatalogo}. Sem consultas enquanto o intervalo de
+    verificação não expirar; depois, uma consulta à versão e só recarrega
+    os artigos se a versão mudou. verificar=True consulta já a versão;
+    forcar=True recarrega sempre.
+    """
+    from .models import VersaoDados
+
+    agora = time.monotonic()
+    with _lock:
+        if (
+            forcar or verificar or _estado["versao"] is None
+            or agora - _estado["verificado_em"] >= _intervalo_verificacao()
+        ):
+            versao = VersaoDados.atual(CHAVE_VERSAO)
+            if forcar or versao != _estado["versao"]:
+                _carregar(versao)
+            _estado["verificado_em"] = agora
+        return _estado["artigos"]
+
+
+def obter_artigo(artigo_id):
+    """ArtigoCatalogo do id dado (None se não existir)."""
+    try:
+        artigo_id = int(artigo_id)
+    except (TypeError, ValueError):
+        return None
+    artigo = obter_catalogo().get(artigo_id)
+    if artigo is None and artigo_id not in _estado["ausentes"]:
+        # pode ter sido criado noutro worker depois da última verificação
+        artigos = obter_catalogo(verificar=True)
+        artigo = artigos.get(artigo_id)
+        if artigo is None:
+            with _lock:
+                # só se entretanto ninguém recarregou
+                if _estado["artigos"] is artigos:
+                    _estado["ausentes"].add(artigo_id)
+    return artigo
+
+
+def versao_catalogo():
+    """Versão do catálogo em uso neste processo (para chaves de cache)."""
+    obter_catalogo()
+    return _estado["versao"]
+
+
+def invalidar_catalogo():
+    """
+    Chamado quando um ItemServico muda: incrementa a versão partilhada
+    (os outros workers recarregam na próxima verificação) e descarta
+    já a cópia deste processo.
+    """
+    from .models import VersaoDados
+
+    VersaoDados.incrementar(CHAVE_VERSAO)
+    with _lock:
+        _estado.update(versao=None, verificado_em=0.0, artigos={}, ausentes=set())
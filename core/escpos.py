@@ -0,0 +1,111 @@
+"""
+Comandos ESC/POS para as impressoras térmicas de 80mm do balcão.
+
+O recibo é enviado como texto nativo da impressora (fonte B, 64 colunas),
+com negrito nos totais, o logótipo como imagem raster de 1 bit e corte de
+papel no fim: poucos KB em vez de uma imagem PNG inteira.
+"""
+from PIL import Image
+
+ESC = b"\x1b"
+GS = b"\x1d"
+
+INICIALIZAR = ESC + b"@"
+CODEPAGE_PC860 = ESC + b"t\x03"  # português
+FONTE_B = ESC + b"M\x01"
+NEGRITO_ON = ESC + b"E\x01"
+NEGRITO_OFF = ESC + b"E\x00"
+CENTRAR = ESC + b"a\x01"
+ALINHAR_ESQUERDA = ESC + b"a\x00"
+CORTE_PARCIAL = GS + b"V\x42\x00"  # avança o papel e corta
+
+COLUNAS = 64
+LARGURA_PONTOS = 512  # 80mm a 203 dpi (área imprimível)
+
+# Linhas do recibo impressas a negrito
+PREFIXOS_NEGRITO = ("VD ", "Factura ", "TOTAL", "Saldo:", "Pagamento:", "Total em divida")
+
+
+def raster_logo(logo, largura_max=LARGURA_PONTOS // 2):
+    """
+    Logótipo -> comando GS v 0 (imagem raster de 1 bit, já com dithering).
+    Feito uma vez por processo (ver AtivosRecibo.logo_escpos).
+    """
+    fundo = Image.new("RGBA", logo.size, "white")
+    imagem = Image.alpha_composite(fundo, logo.convert("RGBA")).convert("L")
+    if imagem.width > largura_max:
+        imagem = imagem.resize((largura_max, imagem.height * largura_max // imagem.width))
+
+    # largura múltipla de 8 (um byte por 8 pontos)
+    largura = (imagem.width + 7) // 8 * 8
+    if largura != imagem.width:
+        alargada = Image.new("L", (largura, imagem.height), 255)
+        alargada.paste(imagem, (0, 0))
+        imagem = alargada
+
+    # "1" do Pillow: 0 = preto; na impressora o bit 1 = ponto impresso
+    bits = imagem.convert("1", dither=Image.Dither.FLOYDSTEINBERG).tobytes()
+    dados = bytes(b ^ 0xFF for b in bits)
+
+    largura_bytes = largura // 8
+    return (
+        GS + b"v0\x00"
+        + largura_bytes.to_bytes(2, "little")
+        + imagem.height.to_bytes(2, "little")
+        + dados
+    )
+
+
+def ajustar_linha(linha, colunas=COLUNAS):
+    """
+    O modelo do recibo alinha colunas com espaços para a largura da imagem;
+    aqui os maiores blocos de espaços encolhem até a linha caber no papel.
+    """
+    linha = linha.rstrip()
+    while len(linha) > colunas:
+        inicio = _maior_bloco_espacos(linha)
+        if inicio is None:
+            return linha[:colunas]
+        linha = linha[:inicio] + linha[inicio + 1:]
+    return linha
+
+
+def _maior_bloco_espacos(linha):
+    """Índice do maior bloco de 2+ espaços (None se não houver)."""
+    melhor, tamanho_melhor = None, 1
+    i = 0
+    while i < len(linha):
+        if linha[i] == " ":
+            j = i
+            while j < len(linha) and linha[j] == " ":
+                j += 1
+            if j - i > tamanho_melhor:
+                melhor, tamanho_melhor = i, j - i
+            i = j
+        else:
+            i += 1
+    return melhor
+
+
+def gerar_escpos(texto, logo=None):
+    """Texto do recibo (recibo_termico.txt) -> bytes ESC/POS."""
+    partes = [INICIALIZAR, CODEPAGE_PC860]
+    if logo:
+        partes += [CENTRAR, logo, b"\n", ALINHAR_ESQUERDA]
+    partes.append(FONTE_B)
+
+    anterior_vazia = False
+    for linha in texto.split("\n"):
+        linha = ajustar_linha(linha)
+        # linhas vazias seguidas (dos {% if %} do modelo) gastam papel
+        if not linha and anterior_vazia:
+            continue
+        anterior_vazia = not linha
+        codificada = linha.encode("cp860", errors="replace") + b"\n"
+        if linha.startswith(PREFIXOS_NEGRITO):
+            partes += [NEGRITO_ON, codificada, NEGRITO_OFF]
+        else:
+            partes.append(codificada)
+
+    partes += [b"\n\n", CORTE_PARCIAL]
+    return b"".join(partes)
@@ -0,0 +1,136 @@
+"""
+Exportação dos relatórios em CSV e XLSX (linhas em bruto, para a contabilidade).
+
+As linhas são geradas a partir de querysets lidos com .iterator(), por isso
+a memória não cresce com o período:
+
+- CSV: StreamingHttpResponse; o cabeçalho sai logo e cada bloco de linhas
+  é enviado à medida que é lido da base.
+- XLSX: openpyxl em modo write-only (as linhas vão para ficheiros
+  temporários, não ficam em memória). Um XLSX é um zip que só fica completo
+  no fim, por isso é gerado pelo worker (core/tarefas.py), como os PDFs.
+"""
+import csv
+from tempfile import SpooledTemporaryFile
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+from .catalogo import obter_artigo
+from .models import ItemPedido, PagamentoPedido, Pedido
+
+# Linhas lidas da base de cada vez
+TAMANHO_BLOCO = 2000
+
+CABECALHO_VENDAS = ["Pedido", "Data do pedido", "Cliente", "Lavandaria", "Artigo", "Serviço", "Quantidade", "Preço total", "Descrição"]
+CABECALHO_MOVIMENTOS = ["Pagamento", "Pedido", "Cliente", "Data do pedido", "Data do pagamento", "Método", "Caixa", "Lavandaria", "Valor"]
+
+
+def _conversor_data():
+    """Data/hora local, sem fuso nem microssegundos (o openpyxl não aceita datas com fuso)."""
+    fuso = timezone.get_current_timezone()
+
+    def data(valor):
+        if valor is None:
+            return None
+        return timezone.localtime(valor, fuso).replace(tzinfo=None, microsecond=0)
+    return data
+
+
+# ===== LINHAS =====
+# Lidas com values_list() (sem criar modelos), que é o que domina o tempo
+# quando há dezenas de milhares de linhas.
+
+def itens_para_exportar(pedidos):
+    """Itens dos pedidos, pela ordem dos pedidos (a da lista do admin) e do item."""
+    ordem = [campo for campo in (pedidos.query.order_by or Pedido._meta.ordering) if isinstance(campo, str)]
+    ordem_itens = [
+        f"-pedido__{campo[1:]}" if campo.startswith("-") else f"pedido__{campo}"
+        for campo in ordem if campo != "?"
+    ]
+    return ItemPedido.objects.filter(pedido__in=pedidos.order_by().values("pk")).order_by(*ordem_itens, "pedido_id", "pk")
+
+
+def linhas_vendas(itens):
+    """Uma linha por item de pedido. `itens`: itens_para_exportar()."""
+    data = _conversor_data()
+    for (pedido_id, criado_em, cliente, lavandaria, artigo_id, servico,
+         quantidade, preco_total, descricao) in itens.values_list(
+        "pedido_id", "pedido__criado_em", "pedido__cliente__nome", "pedido__lavandaria__nome",
+        "item_de_servico_id", "servico__nome", "quantidade", "preco_total", "descricao",
+    ).iterator(chunk_size=TAMANHO_BLOCO):
+        artigo = obter_artigo(artigo_id)
+        yield [
+            pedido_id, data(criado_em), cliente, lavandaria,
+            artigo.nome if artigo else "", servico or "", quantidade, preco_total, descricao or "",
+        ]
+
+
+def linhas_movimentos(pagamentos):
+    """Uma linha por pagamento. `pagamentos`: core.relatorios.Movimento (ler_movimentos())."""
+    data = _conversor_data()
+    metodos = dict(PagamentoPedido.METODO_PAGAMENTO_CHOICES)
+    for m in pagamentos:
+        yield [
+            m.id, m.pedido_id, m.cliente, data(m.pedido_criado_em), data(m.pago_em),
+            metodos.get(m.metodo_pagamento, m.metodo_pagamento), m.caixa or "", m.lavandaria, m.valor,
+        ]
+
+
+# ===== CSV =====
+
+class _Eco:
+    """Ficheiro "falso" para o csv.writer: devolve a linha em vez de a guardar."""
+
+    def write(self, valor):
+        return valor
+
+
+def resposta_csv(nome_ficheiro, cabecalho, linhas):
+    """StreamingHttpResponse com o CSV (UTF-8 com BOM, para o Excel reconhecer os acentos)."""
+    escritor = csv.writer(_Eco())
+
+    def conteudo():
+        yield "\ufeff" + escritor.writerow(cabecalho)
+        bloco = []
+        for linha in linhas:
+            bloco.append(escritor.writerow(linha))
+            if len(bloco) >= 500:
+                yield "".join(bloco)
+                bloco = []
+        if bloco:
+            yield "".join(bloco)
+
+    resposta = StreamingHttpResponse(conteudo(), content_type="text/csv; charset=utf-8")
+    resposta["Content-Disposition"] = f'attachment; filename="{nome_ficheiro}"'
+    return resposta
+
+
+# ===== XLSX =====
+
+def xlsx_em_bytes(folhas):
+    """
+    Livro XLSX com as folhas dadas: iterável de (titulo, cabecalho, linhas).
+    As linhas são escritas à medida que são lidas (modo write-only).
+    """
+    livro = Workbook(write_only=True)
+    negrito = Font(bold=True)
+    for titulo, cabecalho, linhas in folhas:
+        folha = livro.create_sheet(title=titulo[:31])
+        folha.freeze_panes = "A2"
+        celulas = []
+        for texto in cabecalho:
+            celula = WriteOnlyCell(folha, value=texto)
+            celula.font = negrito
+            celulas.append(celula)
+        folha.append(celulas)
+        for linha in linhas:
+            folha.append(linha)
+
+    with SpooledTemporaryFile(max_size=8 * 1024 * 1024) as ficheiro:
+        livro.save(ficheiro)
+        ficheiro.seek(0)
+        return ficheiro.read()
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from core.models import LotePontos, expirar_pontos_clientes
+
+
+class Command(BaseCommand):
+    help = (
+        "Expira os pontos de fidelidade vencidos de todos os clientes "
+        "(para correr diariamente a partir de um agendador)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Só mostra quantos clientes/pontos seriam expirados.",
+        )
+        parser.add_argument(
+            "--lote", type=int, default=1000,
+            help="Clientes por transação (por omissão: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        inicio = time.monotonic()
+        agora = timezone.now()
+
+        # Uma consulta agrupada: pontos expiráveis por cliente
+        candidatos = list(
+            LotePontos.objects.a_expirar(agora)
+            .order_by()
+            .values("cliente_id")
+            .annotate(total=Sum("saldo"), lotes=Count("id"))
+            .order_by("cliente_id")
+            .values_list("cliente_id", "total", "lotes")
+        )
+
+        total_pontos = sum(c[1] for c in candidatos)
+        total_lotes = sum(c[2] for c in candidatos)
+        self.stdout.write(
+            f"{len(candidatos)} cliente(s), {total_lotes} lote(s), {total_pontos} pontos a expirar "
+            f"({time.monotonic() - inicio:.2f}s)"
+        )
+
+        if options["dry_run"] or not candidatos:
+            return
+
+        tamanho = max(1, options["lote"])
+        expirados = 0
+        for i in range(0, len(candidatos), tamanho):
+            ids = [c[0] for c in candidatos[i:i + tamanho]]
+            t0 = time.monotonic()
+            resultado = expirar_pontos_clientes(ids, agora)
+            expirados += sum(resultado.values())
+            self.stdout.write(
+                f"  lote {i // tamanho + 1}: {len(resultado)} cliente(s), "
+                f"{sum(resultado.values())} pontos ({time.monotonic() - t0:.2f}s)"
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{expirados} pontos expirados em {time.monotonic() - inicio:.2f}s."
+        ))
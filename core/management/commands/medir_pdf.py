@@ -0,0 +1,90 @@
+import io
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.template.loader import render_to_string
+
+from core import pdf
+from core.models import Pedido
+from core.relatorios import pedidos_vendas, quantidade_total
+
+
+def relatorio_xhtml2pdf(queryset):
+    """Relatório de vendas pelo caminho antigo (modelo HTML + xhtml2pdf)."""
+    from xhtml2pdf import pisa
+
+    queryset = queryset.prefetch_related("itens")
+    for pedido in queryset:
+        pedido.total_quantidade = sum(item.quantidade for item in pedido.itens.all())
+    html_string = render_to_string("core/relatorio_vendas.html", {
+        "pedidos": queryset,
+        "total_quantidade": sum(pedido.total_quantidade for pedido in queryset),
+        "start_date": "-",
+        "end_date": "-",
+    })
+    buffer = io.BytesIO()
+    pisa.CreatePDF(html_string, dest=buffer)
+    return buffer.getvalue()
+
+
+def relatorio_reportlab(queryset):
+    """Relatório de vendas pelo motor reportlab (core/pdf.py)."""
+    total = quantidade_total(queryset)
+    return pdf.pdf_em_bytes(pdf.relatorio_vendas(pedidos_vendas(queryset).iterator(chunk_size=500), "-", "-", total))
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara o relatório de vendas em PDF gerado com xhtml2pdf e com o "
+        "motor reportlab para os N pedidos mais recentes: tempo, consultas, "
+        "memória de pico e tamanho."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pedidos", type=int, nargs="+", default=[10, 1000, 10000])
+        parser.add_argument(
+            "--sem-xhtml2pdf", action="store_true",
+            help="Mede só o motor reportlab (o xhtml2pdf demora minutos com 10.000 pedidos).",
+        )
+        parser.add_argument(
+            "--memoria", action="store_true",
+            help="Mede também a memória de pico (tracemalloc; torna tudo mais lento).",
+        )
+
+    def handle(self, *args, **options):
+        existentes = Pedido.objects.count()
+        if not existentes:
+            raise CommandError("Nenhum pedido encontrado.")
+
+        motores = [("reportlab", relatorio_reportlab)]
+        if not options["sem_xhtml2pdf"]:
+            motores.insert(0, ("xhtml2pdf", relatorio_xhtml2pdf))
+
+        # fontes e estilos: uma vez por processo, fora da medição
+        pdf.obter_recursos()
+
+        for n in options["pedidos"]:
+            if n > existentes:
+                self.stdout.write(f"{n} pedidos: só existem {existentes}, a usar {existentes}")
+                n = existentes
+            ids = list(Pedido.objects.order_by("-pk").values_list("pk", flat=True)[:n])
+
+            for nome, gerar in motores:
+                queryset = Pedido.objects.filter(pk__in=ids).order_by("pk")
+                if options["memoria"]:
+                    tracemalloc.start()
+                consultas = []
+                t0 = time.perf_counter()
+                with connection.execute_wrapper(lambda execute, *a: consultas.append(1) or execute(*a)):
+                    dados = gerar(queryset)
+                segundos = time.perf_counter() - t0
+                memoria = ""
+                if options["memoria"]:
+                    memoria = f", pico {tracemalloc.get_traced_memory()[1] / 1024 / 1024:.1f} MB"
+                    tracemalloc.stop()
+                self.stdout.write(
+                    f"{n} pedidos, {nome}: {segundos:.2f} s, {len(consultas)} consulta(s){memoria}, "
+                    f"{len(dados) / 1024:.0f} KB"
+                )
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from core.models import Pedido
+from core.recibo_imagem import AtivosRecibo, desenhar_recibo, desenhar_recibo_pbm, obter_ativos
+from core.recibos import CONSULTAS_RECIBO, texto_recibo
+
+
+class Command(BaseCommand):
+    help = (
+        "Mede o recibo térmico: consultas do contexto (falha se passarem de "
+        "CONSULTAS_RECIBO), carregamento dos ativos e tempo médio/tamanho de "
+        "cada formato de imagem (PNG a cores, PNG de 1 bit e PBM)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pedido", type=int, default=None, help="Pedido a usar (por omissão: o mais recente).")
+        parser.add_argument("--repeticoes", type=int, default=50)
+
+    def handle(self, *args, **options):
+        pedido = (
+            Pedido.objects.filter(pk=options["pedido"]).first() if options["pedido"]
+            else Pedido.objects.order_by("-pk").first()
+        )
+        if pedido is None:
+            raise CommandError("Nenhum pedido encontrado.")
+
+        with CaptureQueriesContext(connection) as consultas:
+            texto = texto_recibo(pedido.pk)
+        self.stdout.write(f"contexto: {len(consultas)} consulta(s) (máximo {CONSULTAS_RECIBO})")
+        if len(consultas) > CONSULTAS_RECIBO:
+            raise CommandError(f"O recibo do pedido {pedido.pk} fez {len(consultas)} consultas.")
+
+        repeticoes = max(1, options["repeticoes"])
+
+        t0 = time.perf_counter()
+        AtivosRecibo()
+        self.stdout.write(f"ativos (fonte, logo, métricas): {(time.perf_counter() - t0) * 1000:.1f} ms, uma vez por processo")
+
+        obter_ativos()
+        formatos = [
+            ("png RGB", lambda: desenhar_recibo(texto, "RGB")),
+            ("png 1 bit", lambda: desenhar_recibo(texto, "1")),
+            ("pbm", lambda: desenhar_recibo_pbm(texto)),
+        ]
+        for nome, desenhar in formatos:
+            t0 = time.perf_counter()
+            for _ in range(repeticoes):
+                dados = desenhar()
+            media = (time.perf_counter() - t0) * 1000 / repeticoes
+            self.stdout.write(
+                f"{nome}: {media:.1f} ms/recibo, {len(dados) / 1024:.1f} KB (pedido {pedido.pk}, {repeticoes}x)"
+            )
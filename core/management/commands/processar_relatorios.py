@@ -0,0 +1,65 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.relatorios_fechados import limpar_relatorios_antigos
+from core.tarefas import executar, limpar_tarefas_antigas, recuperar_tarefas_paradas, reservar
+
+# Manutenção (tarefas paradas e retenção) no máximo uma vez por este intervalo
+INTERVALO_MANUTENCAO = 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Worker da fila de relatórios (core/tarefas.py): gera os PDFs pedidos "
+        "no admin, um de cada vez. Para correr num dyno próprio (ver Procfile)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--intervalo", type=float, default=5,
+            help="Segundos de espera quando a fila está vazia (por omissão: 5).",
+        )
+        parser.add_argument(
+            "--uma-vez", action="store_true",
+            help="Processa as tarefas pendentes e termina.",
+        )
+
+    def handle(self, *args, **options):
+        self._parar = False
+        # o Heroku envia SIGTERM ao reiniciar: termina a tarefa em curso e sai
+        signal.signal(signal.SIGTERM, self._pedir_paragem)
+        signal.signal(signal.SIGINT, self._pedir_paragem)
+
+        manutencao_em = 0.0
+        while not self._parar:
+            close_old_connections()
+
+            if time.monotonic() - manutencao_em >= INTERVALO_MANUTENCAO:
+                manutencao_em = time.monotonic()
+                retomadas, falhadas = recuperar_tarefas_paradas()
+                apagadas = limpar_tarefas_antigas() + limpar_relatorios_antigos()
+                if retomadas or falhadas or apagadas:
+                    self.stdout.write(
+                        f"manutenção: {retomadas} retomada(s), {falhadas} falhada(s), {apagadas} apagada(s)"
+                    )
+
+            tarefa = reservar()
+            if tarefa is None:
+                if options["uma_vez"]:
+                    break
+                time.sleep(options["intervalo"])
+                continue
+
+            t0 = time.monotonic()
+            executar(tarefa)
+            tarefa.refresh_from_db(fields=["estado", "tamanho", "mensagem"])
+            self.stdout.write(
+                f"tarefa #{tarefa.pk} ({tarefa.tipo}): {tarefa.estado} em {time.monotonic() - t0:.1f}s"
+                + (f", {tarefa.tamanho / 1024:.0f} KB" if tarefa.estado == "concluido" else f": {tarefa.mensagem}")
+            )
+
+    def _pedir_paragem(self, signum, frame):
+        self._parar = True
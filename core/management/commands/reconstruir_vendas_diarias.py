@@ -0,0 +1,65 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from core import vendas_diarias
+from core.models import PagamentoPedido, Pedido
+
+# Dias verificados de cada vez (três consultas agrupadas por bloco)
+DIAS_POR_BLOCO = 31
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifica VendaDiaria contra os pedidos/pagamentos e reconstrói os dias com desvio "
+        "(também serve para preencher a tabela pela primeira vez). Correr fora de horas: "
+        "pagamentos gravados durante a reconstrução de um dia podem ficar de fora."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dias", type=int, default=None,
+            help="Só os últimos N dias (por omissão: desde o primeiro pedido).",
+        )
+        parser.add_argument(
+            "--verificar", action="store_true",
+            help="Apenas lista os dias com desvio, sem reconstruir.",
+        )
+
+    def handle(self, *args, **options):
+        hoje = timezone.localdate()
+        if options["dias"] is not None:
+            inicio = hoje - timedelta(days=options["dias"] - 1)
+        else:
+            primeiros = [
+                Pedido.objects.aggregate(m=Min("criado_em"))["m"],
+                PagamentoPedido.objects.aggregate(m=Min("pago_em"))["m"],
+            ]
+            primeiros = [vendas_diarias.dia_local(m) for m in primeiros if m is not None]
+            if not primeiros:
+                self.stdout.write(self.style.SUCCESS("Sem pedidos nem pagamentos."))
+                return
+            inicio = min(primeiros)
+
+        com_desvio = []
+        while inicio <= hoje:
+            fim = min(inicio + timedelta(days=DIAS_POR_BLOCO - 1), hoje)
+            with transaction.atomic():
+                calculado = vendas_diarias.calcular(inicio, fim)
+                chaves = vendas_diarias.diferencas(calculado, vendas_diarias.atuais(inicio, fim))
+                dias = sorted({dia for _, dia, _, _ in chaves})
+                if dias and not options["verificar"]:
+                    vendas_diarias.substituir_dias(calculado, dias)
+            com_desvio += dias
+            inicio = fim + timedelta(days=1)
+
+        if not com_desvio:
+            self.stdout.write(self.style.SUCCESS("Nenhum desvio encontrado."))
+            return
+
+        self.stdout.write(f"{len(com_desvio)} dia(s) com desvio: {[str(d) for d in com_desvio[:50]]}")
+        if not options["verificar"]:
+            self.stdout.write(self.style.SUCCESS(f"{len(com_desvio)} dia(s) reconstruídos."))
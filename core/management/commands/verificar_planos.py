@@ -0,0 +1,99 @@
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import LotePontos, MovimentacaoPontos, PagamentoPedido, Pedido
+
+# Leitura completa de uma tabela do core no plano de execução
+SEQ_SCAN = {
+    "postgresql": re.compile(r"Seq Scan on (core_\w+)"),
+    "sqlite": re.compile(r"\bSCAN (core_\w+)(?! USING (?:COVERING )?INDEX)"),
+}
+
+
+def consultas_quentes(lavandaria_id=1, cliente_id=1, pedido_id=1):
+    """
+    Formas das consultas usadas em views.py, admin.py e crm/views.py,
+    {nome: (índice que a deve servir, queryset)} (ver Meta.indexes em
+    core/models.py).
+    """
+    agora = timezone.now()
+    inicio = agora - timedelta(days=30)
+    return {
+        "pedidos da lavandaria (changelist)": (
+            "pedido_lav_criado_idx", Pedido.objects.filter(lavandaria_id=lavandaria_id)[:100],
+        ),
+        "pedidos em aberto do cliente (recibo)": (
+            "pedido_cli_aberto_idx",
+            Pedido.objects.filter(cliente_id=cliente_id).exclude(status_pagamento="pago").order_by("-criado_em")[:3],
+        ),
+        "pedidos do cliente por estado de pagamento": (
+            "pedido_cli_statuspag_idx", Pedido.objects.filter(cliente_id=cliente_id, status_pagamento="pago"),
+        ),
+        "pedidos por estado": (
+            "pedido_status_criado_idx", Pedido.objects.filter(status="pronto").order_by("-criado_em")[:100],
+        ),
+        "pedidos por período": ("pedido_criado_idx", Pedido.objects.filter(criado_em__gte=inicio)),
+        "último pagamento do pedido": (
+            "pagamento_pedido_pago_idx", PagamentoPedido.objects.filter(pedido_id=pedido_id).order_by("-pago_em")[:1],
+        ),
+        "pagamentos por período (relatório)": (
+            "pagamento_pago_em_idx",
+            PagamentoPedido.objects.filter(pago_em__gte=inicio, pago_em__lte=agora).order_by("pago_em", "id"),
+        ),
+        "movimentações do cliente por tipo": (
+            "movpontos_cli_tipo_idx",
+            MovimentacaoPontos.objects.filter(cliente_id=cliente_id, tipo="ganho", criado_em__gte=inicio),
+        ),
+        "movimentações do pedido por tipo": (
+            "movpontos_pedido_tipo_idx", MovimentacaoPontos.objects.filter(pedido_id=pedido_id, tipo="ganho"),
+        ),
+        "lotes de pontos válidos": (
+            "lotepontos_ativos_idx", LotePontos.objects.ativos(agora).filter(cliente_id=cliente_id),
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Corre EXPLAIN sobre as consultas mais frequentes e falha se o plano "
+        "de alguma não usar o índice previsto para ela. Para usar em CI; se "
+        "o planeador o escolhe com dados reais é verificado pelos testes "
+        "(core/tests.py, PlanosConsultasTests)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verbose-plano", action="store_true", help="Mostra o plano de cada consulta.")
+
+    def handle(self, *args, **options):
+        padrao = SEQ_SCAN.get(connection.vendor)
+        if padrao is None:
+            raise CommandError(f"Backend '{connection.vendor}' não suportado.")
+
+        falhas = []
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                # Numa base quase vazia o planeador prefere ler a tabela; com
+                # seqscan desligado o plano mostra se o índice previsto serve
+                # a forma da consulta (independente do volume de dados).
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+
+            for nome, (indice, queryset) in consultas_quentes().items():
+                plano = queryset.explain()
+                if options["verbose_plano"]:
+                    self.stdout.write(f"--- {nome}\n{plano}")
+                if indice in plano:
+                    self.stdout.write(f"ok        {nome} ({indice})")
+                    continue
+                falhas.append(nome)
+                tabelas = padrao.findall(plano)
+                lido = f"seq scan em {', '.join(sorted(set(tabelas)))}" if tabelas else "outro índice"
+                self.stdout.write(self.style.ERROR(f"FALHA     {nome}: esperado {indice}, {lido}"))
+
+        if falhas:
+            raise CommandError(f"{len(falhas)} consulta(s) sem o índice previsto: {', '.join(falhas)}")
+        self.stdout.write(self.style.SUCCESS("Todas as consultas usam o índice previsto."))
@@ -0,0 +1,76 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import DecimalField, F, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from core.models import ItemPedido, PagamentoPedido, Pedido
+
+DECIMAL = DecimalField(max_digits=12, decimal_places=2)
+ZERO = Value(Decimal("0.00"), output_field=DECIMAL)
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifica Pedido.total, soma_pagamentos, ultimo_pagamento_em e total_pago "
+        "contra os itens/pagamentos e, com --corrigir, re-agrega os pedidos com desvio "
+        "e os marcados com recalculo_pendente (recálculo depois do commit falhou)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dias", type=int, default=None,
+            help="Só pedidos criados nos últimos N dias (por omissão: todos).",
+        )
+        parser.add_argument(
+            "--corrigir", action="store_true",
+            help="Re-agrega os pedidos com desvio (senão apenas lista).",
+        )
+
+    def handle(self, *args, **options):
+        itens = ItemPedido.objects.filter(pedido=OuterRef("pk")).values("pedido")
+        pagamentos = PagamentoPedido.objects.filter(pedido=OuterRef("pk")).values("pedido")
+
+        pedidos = Pedido.objects.annotate(
+            total_calc=Coalesce(Subquery(itens.annotate(s=Sum("preco_total")).values("s")[:1]), ZERO),
+            soma_calc=Coalesce(Subquery(pagamentos.annotate(s=Sum("valor")).values("s")[:1]), ZERO),
+            ultimo_calc=Subquery(pagamentos.annotate(u=Max("pago_em")).values("u")[:1]),
+        ).annotate(
+            total_pago_calc=Least(
+                F("soma_calc"),
+                Greatest(F("total_calc") - F("desconto") - F("desconto_cabides"), ZERO),
+                output_field=DECIMAL,
+            ),
+        )
+
+        if options["dias"] is not None:
+            pedidos = pedidos.filter(criado_em__gte=timezone.now() - timedelta(days=options["dias"]))
+
+        desvio = (
+            Q(recalculo_pendente=True)
+            | ~Q(total=F("total_calc"))
+            | ~Q(soma_pagamentos=F("soma_calc"))
+            | ~Q(total_pago=F("total_pago_calc"))
+            | Q(ultimo_pagamento_em__isnull=True, ultimo_calc__isnull=False)
+            | Q(ultimo_pagamento_em__isnull=False, ultimo_calc__isnull=True)
+            | ~Q(ultimo_pagamento_em=F("ultimo_calc"))
+        )
+        com_desvio = list(pedidos.filter(desvio).values_list("pk", flat=True).order_by("pk"))
+
+        if not com_desvio:
+            self.stdout.write(self.style.SUCCESS("Nenhum desvio encontrado."))
+            return
+
+        self.stdout.write(f"{len(com_desvio)} pedido(s) com desvio: {com_desvio[:50]}")
+
+        if not options["corrigir"]:
+            return
+
+        for pk in com_desvio:
+            with transaction.atomic():
+                Pedido.objects.select_for_update().get(pk=pk).reagregar()
+
+        self.stdout.write(self.style.SUCCESS(f"{len(com_desvio)} pedido(s) re-agregados."))
@@ -0,0 +1,52 @@
+from django.utils.functional import SimpleLazyObject
+
+from .models import Funcionario
+
+
+def _resolver_funcionario(request):
+    if not hasattr(request, "_funcionario_cache"):
+        funcionario = None
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            funcionario = (
+                Funcionario.objects
+                .select_related("lavandaria", "user")
+                .filter(user=user)
+                .first()
+            )
+        request._funcionario_cache = funcionario
+    return request._funcionario_cache
+
+
+def obter_funcionario(request):
+    """
+    Funcionário (com a lavandaria já carregada) do utilizador do request.
+    A consulta é feita uma única vez por request.
+    Levanta Funcionario.DoesNotExist se o utilizador não for funcionário.
+    """
+    funcionario = _resolver_funcionario(request)
+    if funcionario is None:
+        raise Funcionario.DoesNotExist("O usuário logado não está associado a nenhum funcionário.")
+    return funcionario
+
+
+def _resolver_lavandaria(request):
+    funcionario = _resolver_funcionario(request)
+    return funcionario.lavandaria if funcionario else None
+
+
+class FuncionarioMiddleware:
+    """
+    Expõe request.funcionario e request.lavandaria, resolvidos só quando
+    usados e uma vez por request. Para utilizadores que não são funcionários
+    os objectos lazy embrulham None (avaliam como falso); no código use
+    obter_funcionario(request).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.funcionario = SimpleLazyObject(lambda: _resolver_funcionario(request))
+        request.lavandaria = SimpleLazyObject(lambda: _resolver_lavandaria(request))
+        return self.get_response(request)
@@ -0,0 +1,42 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def preencher(apps, schema_editor):
+    Pedido = apps.get_model("core", "Pedido")
+    PagamentoPedido = apps.get_model("core", "PagamentoPedido")
+
+    por_pedido = PagamentoPedido.objects.filter(pedido=OuterRef("pk")).values("pedido")
+
+    Pedido.objects.update(
+        soma_pagamentos=Coalesce(
+            Subquery(por_pedido.annotate(s=Sum("valor")).values("s")[:1]),
+            Value(Decimal("0.00")),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        ultimo_pagamento_em=Subquery(por_pedido.annotate(u=Max("pago_em")).values("u")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_cliente_pontos_movimentacaopontos'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='soma_pagamentos',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='pedido',
+            name='ultimo_pagamento_em',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(preencher, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+VALIDADE_PONTOS = timedelta(days=90)
+
+
+def _consumir(lotes, pontos, elegivel):
+    for lote in lotes:
+        if pontos <= 0:
+            break
+        if lote.saldo > 0 and elegivel(lote):
+            retirar = min(lote.saldo, pontos)
+            lote.saldo -= retirar
+            pontos -= retirar
+
+
+def criar_lotes(apps, schema_editor):
+    """
+    Reconstrói os lotes a partir do histórico: cada "ganho" abre um lote,
+    "uso" consome lotes válidos nessa data e "expiracao" consome lotes já
+    vencidos nessa data, sempre do mais antigo para o mais recente.
+    """
+    MovimentacaoPontos = apps.get_model("core", "MovimentacaoPontos")
+    LotePontos = apps.get_model("core", "LotePontos")
+
+    pendentes = []
+    lotes = []
+    cliente_atual = None
+
+    movimentacoes = MovimentacaoPontos.objects.order_by("cliente_id", "criado_em", "id")
+    for mov in movimentacoes.iterator(chunk_size=2000):
+        if mov.cliente_id != cliente_atual:
+            pendentes.extend(lotes)
+            lotes = []
+            cliente_atual = mov.cliente_id
+            if len(pendentes) >= 1000:
+                LotePontos.objects.bulk_create(pendentes)
+                pendentes = []
+
+        if mov.tipo == "ganho" and mov.pontos > 0:
+            lotes.append(LotePontos(
+                cliente_id=mov.cliente_id,
+                movimentacao_id=mov.id,
+                pontos=mov.pontos,
+                saldo=mov.pontos,
+                criado_em=mov.criado_em,
+                expira_em=mov.criado_em + VALIDADE_PONTOS,
+            ))
+        elif mov.tipo == "uso":
+            _consumir(lotes, abs(mov.pontos), lambda lote: lote.expira_em > mov.criado_em)
+        elif mov.tipo == "expiracao":
+            _consumir(lotes, abs(mov.pontos), lambda lote: lote.expira_em <= mov.criado_em)
+
+    pendentes.extend(lotes)
+    LotePontos.objects.bulk_create(pendentes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_pedido_soma_pagamentos_ultimo_pagamento_em'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LotePontos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pontos', models.PositiveIntegerField()),
+                ('saldo', models.PositiveIntegerField()),
+                ('criado_em', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expira_em', models.DateTimeField()),
+                ('cliente', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lotes_pontos', to='core.cliente')),
+                ('movimentacao', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lote', to='core.movimentacaopontos')),
+            ],
+            options={
+                'ordering': ['expira_em', 'id'],
+                'indexes': [models.Index(condition=models.Q(('saldo__gt', 0)), fields=['cliente', 'expira_em'], name='lotepontos_ativos_idx')],
+            },
+        ),
+        migrations.RunPython(criar_lotes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_lotepontos'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='movimentacaopontos',
+            index=models.Index(fields=['cliente', 'tipo', 'criado_em'], name='movpontos_cli_tipo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='movimentacaopontos',
+            index=models.Index(fields=['pedido', 'tipo'], name='movpontos_pedido_tipo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pagamentopedido',
+            index=models.Index(fields=['pedido', '-pago_em'], name='pagamento_pedido_pago_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pagamentopedido',
+            index=models.Index(fields=['pago_em'], name='pagamento_pago_em_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['lavandaria', '-criado_em'], name='pedido_lav_criado_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['cliente', 'status_pagamento'], name='pedido_cli_statuspag_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['status', '-criado_em'], name='pedido_status_criado_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['-criado_em'], name='pedido_criado_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(condition=models.Q(('status_pagamento', 'pago'), _negated=True), fields=['cliente', '-criado_em'], name='pedido_cli_aberto_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_indices_consultas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersaoDados',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chave', models.CharField(max_length=50, unique=True)),
+                ('versao', models.PositiveBigIntegerField(default=1)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Versão de dados',
+                'verbose_name_plural': 'Versões de dados',
+            },
+        ),
+    ]
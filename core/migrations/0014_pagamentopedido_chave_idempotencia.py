@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_versaodados'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pagamentopedido',
+            name='chave_idempotencia',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='pagamentopedido',
+            constraint=models.UniqueConstraint(condition=models.Q(('chave_idempotencia__isnull', False)), fields=('pedido', 'chave_idempotencia'), name='pagamento_chave_idempotencia_unica'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_pagamentopedido_chave_idempotencia'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='versao',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,40 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_pedido_atualizado_em'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TarefaRelatorio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('vendas', 'Relatório de vendas'), ('financeiro', 'Relatório financeiro')], max_length=20)),
+                ('estado', models.CharField(choices=[('pendente', 'Pendente'), ('em_curso', 'Em curso'), ('concluido', 'Concluído'), ('erro', 'Erro')], default='pendente', max_length=20)),
+                ('parametros', models.JSONField(blank=True, default=dict)),
+                ('progresso', models.PositiveSmallIntegerField(default=0, help_text='0 a 100')),
+                ('tentativas', models.PositiveSmallIntegerField(default=0)),
+                ('mensagem', models.TextField(blank=True, default='')),
+                ('nome_ficheiro', models.CharField(blank=True, default='', max_length=255)),
+                ('conteudo', models.BinaryField(blank=True, editable=False, null=True)),
+                ('tamanho', models.PositiveIntegerField(default=0)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('iniciado_em', models.DateTimeField(blank=True, null=True)),
+                ('concluido_em', models.DateTimeField(blank=True, null=True)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+                ('criado_por', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tarefas_relatorio', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Tarefa de relatório',
+                'verbose_name_plural': 'Tarefas de relatório',
+                'ordering': ['-criado_em'],
+                'indexes': [models.Index(fields=['estado', 'criado_em'], name='tarefa_estado_criado_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_tarefarelatorio'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendaDiaria',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia', models.DateField()),
+                ('metodo_pagamento', models.CharField(blank=True, default='', max_length=20)),
+                ('pedidos', models.IntegerField(default=0)),
+                ('pedidos_pagos', models.IntegerField(default=0)),
+                ('valor_pedidos', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('valor_pedidos_pagos', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('desconto', models.DecimalField(decimal_places=2, default=Decimal('0.00'), help_text='Desconto geral, incluindo o de fidelidade', max_digits=14)),
+                ('desconto_cabides', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('pontos_ganhos', models.BigIntegerField(default=0)),
+                ('pagamentos', models.IntegerField(default=0)),
+                ('valor_recebido', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('funcionario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='vendas_diarias', to='core.funcionario')),
+                ('lavandaria', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vendas_diarias', to='core.lavandaria')),
+            ],
+            options={
+                'verbose_name': 'Venda diária',
+                'verbose_name_plural': 'Vendas diárias',
+                'indexes': [models.Index(fields=['lavandaria', 'dia'], name='vendadiaria_lav_dia_idx'), models.Index(fields=['dia'], name='vendadiaria_dia_idx')],
+            },
+        ),
+    ]
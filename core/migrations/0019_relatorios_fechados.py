@@ -0,0 +1,50 @@
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_vendadiaria'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatorioDiario',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia', models.DateField()),
+                ('versao', models.PositiveBigIntegerField(default=0, help_text='VersaoDados do dia quando foi montado')),
+                ('movimentos', models.JSONField(blank=True, default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('criado_em', models.DateTimeField(auto_now=True)),
+                ('lavandaria', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relatorios_diarios', to='core.lavandaria')),
+            ],
+            options={
+                'verbose_name': 'Relatório diário',
+                'verbose_name_plural': 'Relatórios diários',
+                'constraints': [models.UniqueConstraint(fields=('lavandaria', 'dia'), name='relatoriodiario_lav_dia_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RelatorioFechado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dia_inicio', models.DateField()),
+                ('dia_fim', models.DateField()),
+                ('formato', models.CharField(max_length=10)),
+                ('chave', models.CharField(max_length=64)),
+                ('nome_ficheiro', models.CharField(max_length=255)),
+                ('conteudo', models.BinaryField(editable=False)),
+                ('tamanho', models.PositiveIntegerField(default=0)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('lavandaria', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relatorios_fechados', to='core.lavandaria')),
+            ],
+            options={
+                'verbose_name': 'Relatório fechado',
+                'verbose_name_plural': 'Relatórios fechados',
+                'ordering': ['-criado_em'],
+                'indexes': [models.Index(fields=['lavandaria', 'dia_inicio', 'dia_fim', 'formato'], name='relatoriofechado_periodo_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_relatorios_fechados'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pedido',
+            name='lavandaria',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='pedidos', to='core.lavandaria'),
+        ),
+    ]
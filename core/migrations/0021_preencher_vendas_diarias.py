@@ -0,0 +1,24 @@
+from django.core.management import call_command
+from django.db import migrations
+
+
+def preencher(apps, schema_editor):
+    """
+    VendaDiaria a partir dos pedidos e pagamentos que já existiam, com o
+    comando reconstruir_vendas_diarias (vendas_diarias.calcular). Usa os
+    modelos atuais e não os históricos: Pedido.desconto e desconto_cabides
+    vêm do esquema de produção (ver 0007) e não existem no estado das
+    migrações. Numa base sem pedidos nem pagamentos não lê nada.
+    """
+    call_command("reconstruir_vendas_diarias")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_pedido_lavandaria_sem_indice_fk'),
+    ]
+
+    operations = [
+        migrations.RunPython(preencher, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_preencher_vendas_diarias'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='recalculo_pendente',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,12 +1,27 @@
+import hashlib
+import json
+import logging
 from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
-from django.db.models import Sum
+from django.db.models import F, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from decimal import Decimal
 
+from .catalogo import obter_artigo
+from .recalculo import agendar_recalculo
+from . import vendas_diarias
+
+logger = logging.getLogger(__name__)
+
+# Pontos de fidelidade expiram 90 dias depois de ganhos
+VALIDADE_PONTOS = timedelta(days=90)
 
 
 # Modelo para Lavandarias
@@ -46,7 +61,13 @@ class Funcionario(models.Model):
 
         # Associa o usuário ao grupo correto
         if self.grupo:
-            grupo = Group.objects.get(name=self.grupo)
+            try:
+                grupo = Group.objects.get(name=self.grupo)
+            except Group.DoesNotExist:
+                # grupo apagado depois de a definição ter sido aplicada
+                # (a marca em cache não sabe disso): recria os grupos
+                criar_grupos_com_permissoes(forcar=True)
+                grupo = Group.objects.get(name=self.grupo)
             self.user.groups.set([grupo])
 
         self.user.is_staff = True
@@ -113,20 +134,56 @@ class Cliente(models.Model):
     )
 
     def pontos_validos(self):
-        tres_meses_atras = timezone.now() - timedelta(days=90)
+        """
+        Pontos ainda utilizáveis: saldo dos lotes não expirados.
+        Só lê lotes com saldo (índice parcial), não o histórico de movimentações.
+        """
+        return self.lotes_pontos.ativos().aggregate(total=Sum("saldo"))["total"] or 0
 
-        pontos_ganhos = self.movimentacoes_pontos.filter(
+    def creditar_pontos(self, pontos, pedido=None, criado_por=None):
+        """
+        Regista um ganho de pontos: movimentação "ganho" + lote com validade.
+        Actualiza self.pontos em memória; quem chama grava o cliente.
+        """
+        agora = timezone.now()
+        movimentacao = MovimentacaoPontos.objects.create(
+            cliente=self,
+            pedido=pedido,
             tipo="ganho",
-            criado_em__gte=tres_meses_atras
-        ).aggregate(total=Sum("pontos"))["total"] or 0
-
-        pontos_usados = abs(
-            self.movimentacoes_pontos.filter(
-                tipo="uso"
-            ).aggregate(total=Sum("pontos"))["total"] or 0
+            pontos=pontos,
+            criado_por=criado_por,
+        )
+        LotePontos.objects.create(
+            cliente=self,
+            movimentacao=movimentacao,
+            pontos=pontos,
+            saldo=pontos,
+            criado_em=agora,
+            expira_em=agora + VALIDADE_PONTOS,
         )
+        self.pontos += pontos
+        if pedido is not None:
+            vendas_diarias.registar_pontos(pedido, pontos)
+        return movimentacao
 
-        return max(0, pontos_ganhos + pontos_usados)
+    def consumir_pontos(self, pontos):
+        """
+        Desconta `pontos` dos lotes válidos, do que expira primeiro para o
+        último (FIFO). Devolve quantos pontos foram efectivamente retirados
+        dos lotes.
+        """
+        restante = pontos
+        alterados = []
+        for lote in self.lotes_pontos.ativos().select_for_update().order_by("expira_em", "id"):
+            if restante <= 0:
+                break
+            retirar = min(lote.saldo, restante)
+            lote.saldo -= retirar
+            restante -= retirar
+            alterados.append(lote)
+
+        LotePontos.objects.bulk_update(alterados, ["saldo"])
+        return pontos - restante
 
     def aplicar_desconto_fidelidade(self, valor_gasto=None):
         """
@@ -158,8 +215,9 @@ class Cliente(models.Model):
 
             # Verifica se tem pontos suficientes
             if self.pontos >= pontos_a_consumir:
-                # CONSONE os pontos
+                # CONSONE os pontos (lotes mais antigos primeiro)
                 self.pontos -= pontos_a_consumir
+                self.consumir_pontos(pontos_a_consumir)
 
                 # Registra a movimentação de consumo
                 MovimentacaoPontos.objects.create(
@@ -182,44 +240,9 @@ class Cliente(models.Model):
         return Decimal("0.00")
 
     def expirar_pontos(self):
-        from django.utils import timezone
-        from datetime import timedelta
-        from django.db.models import Sum
-        from .models import MovimentacaoPontos
-
-        limite = timezone.now() - timedelta(days=90)
-
-        # Pontos ganhos há mais de 90 dias
-        pontos_antigos = self.movimentacoes_pontos.filter(
-            tipo="ganho",
-            criado_em__lt=limite
-        ).aggregate(total=Sum("pontos"))["total"] or 0
-
-        if pontos_antigos <= 0:
-            return
-
-        # Evitar expirar duas vezes os mesmos pontos
-        pontos_ja_expirados = abs(
-            self.movimentacoes_pontos.filter(
-                tipo="expiracao"
-            ).aggregate(total=Sum("pontos"))["total"] or 0
-        )
-
-        pontos_para_expirar = pontos_antigos - pontos_ja_expirados
-
-        if pontos_para_expirar <= 0:
-            return
-
-        # Atualizar saldo do cliente
-        self.pontos = max(0, self.pontos - pontos_para_expirar)
-        self.save(update_fields=["pontos"])
-
-        # Registrar movimentação
-        MovimentacaoPontos.objects.create(
-            cliente=self,
-            tipo="expiracao",
-            pontos=-pontos_para_expirar
-        )
+        expirados = expirar_pontos_clientes([self.pk], timezone.now())
+        if expirados:
+            self.refresh_from_db(fields=["pontos"])
 
     def __str__(self):
         return f"{self.nome} - {self.telefone}"
@@ -261,6 +284,107 @@ class MovimentacaoPontos(models.Model):
     def __str__(self):
         return f"{self.cliente} - {self.tipo} - {self.pontos} pts"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["cliente", "tipo", "criado_em"], name="movpontos_cli_tipo_idx"),
+            # "já gerou pontos?" / recibo: movimentações de um pedido por tipo
+            models.Index(fields=["pedido", "tipo"], name="movpontos_pedido_tipo_idx"),
+        ]
+
+
+class LotePontosQuerySet(models.QuerySet):
+
+    def ativos(self, agora=None):
+        """Lotes com saldo e ainda dentro da validade."""
+        return self.filter(saldo__gt=0, expira_em__gt=agora or timezone.now())
+
+    def a_expirar(self, agora=None):
+        """Lotes vencidos que ainda têm saldo."""
+        return self.filter(saldo__gt=0, expira_em__lte=agora or timezone.now())
+
+
+# Modelo para lotes de pontos ganhos (saldo restante e validade)
+class LotePontos(models.Model):
+    """
+    Cada ganho de pontos gera um lote com a sua data de expiração.
+    Uso e expiração consomem os lotes por ordem de expiração (FIFO), pelo que
+    o saldo válido de um cliente é a soma dos lotes activos.
+    """
+    cliente = models.ForeignKey(
+        "Cliente",
+        on_delete=models.CASCADE,
+        related_name="lotes_pontos"
+    )
+    movimentacao = models.OneToOneField(
+        "MovimentacaoPontos",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="lote"
+    )
+    pontos = models.PositiveIntegerField()
+    saldo = models.PositiveIntegerField()
+    criado_em = models.DateTimeField(default=timezone.now)
+    expira_em = models.DateTimeField()
+
+    objects = LotePontosQuerySet.as_manager()
+
+    class Meta:
+        ordering = ["expira_em", "id"]
+        indexes = [
+            # Só lotes com saldo entram no índice: consultas de saldo válido e
+            # de expiração não crescem com o histórico do cliente.
+            models.Index(
+                fields=["cliente", "expira_em"],
+                condition=models.Q(saldo__gt=0),
+                name="lotepontos_ativos_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.cliente} - {self.saldo}/{self.pontos} pts até {self.expira_em:%d/%m/%Y}"
+
+@transaction.atomic
+def expirar_pontos_clientes(cliente_ids, agora):
+    """
+    Expira os lotes vencidos de um conjunto de clientes com operações em lote:
+    um agregado agrupado por cliente, um UPDATE aos lotes, um bulk_update
+    de Cliente.pontos e um bulk_create das movimentações "expiracao".
+    Devolve {cliente_id: pontos_expirados}. Lotes expirados ficam com saldo 0,
+    por isso voltar a correr não expira nada duas vezes.
+    """
+    # Bloqueia os clientes (mesma ordem sempre) antes de mexer nos pontos
+    clientes = list(
+        Cliente.objects.select_for_update()
+        .filter(pk__in=cliente_ids)
+        .order_by("pk")
+        .only("pk", "pontos")
+    )
+
+    lotes = LotePontos.objects.a_expirar(agora).filter(cliente_id__in=cliente_ids)
+    por_cliente = dict(
+        lotes.order_by().values("cliente_id").annotate(total=Sum("saldo")).values_list("cliente_id", "total")
+    )
+    if not por_cliente:
+        return {}
+
+    lotes.update(saldo=0)
+
+    alterados = []
+    movimentacoes = []
+    for cliente in clientes:
+        pontos = por_cliente.get(cliente.pk)
+        if not pontos:
+            continue
+        cliente.pontos = max(0, cliente.pontos - pontos)
+        alterados.append(cliente)
+        movimentacoes.append(MovimentacaoPontos(cliente=cliente, tipo="expiracao", pontos=-pontos))
+
+    Cliente.objects.bulk_update(alterados, ["pontos"])
+    MovimentacaoPontos.objects.bulk_create(movimentacoes)
+    return por_cliente
+
+
 # Modelo para Pedidos
 class Pedido(models.Model):
 
@@ -283,10 +407,13 @@ class Pedido(models.Model):
         related_name="pedidos"
     )
 
+    # servido por pedido_lav_criado_idx (lavandaria à cabeça); um índice só
+    # da FK tirava-lhe as consultas da lavandaria sem ordenar
     lavandaria = models.ForeignKey(
         "Lavandaria",
         on_delete=models.CASCADE,
-        related_name="pedidos"
+        related_name="pedidos",
+        db_index=False,
     )
 
     funcionario = models.ForeignKey(
@@ -344,6 +471,24 @@ class Pedido(models.Model):
         help_text="Desconto aplicado por cabides (140 Mts por 20 cabides)"
     )
 
+    # Mantidos por deltas (ver totais_incrementais): soma bruta dos pagamentos
+    # e data do pagamento mais recente, para não re-agregar a cada evento.
+    soma_pagamentos = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=Decimal("0.00")
+    )
+    ultimo_pagamento_em = models.DateTimeField(null=True, blank=True)
+
+    # Incrementada a cada gravação do pedido (itens e pagamentos acabam sempre
+    # por gravar o pedido no recálculo). Usada como chave da cache de recibos.
+    versao = models.PositiveIntegerField(default=1, editable=False)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    # O recálculo depois do commit (core.recalculo) falhou: total_pago e o
+    # estado de pagamento podem ter ficado para trás até ao próximo recálculo
+    # ou ao `verificar_totais_pedidos --corrigir`.
+    recalculo_pendente = models.BooleanField(default=False, editable=False)
 
 
     # =============================
@@ -372,6 +517,31 @@ class Pedido(models.Model):
         saldo = self.total_final - (self.total_pago or Decimal("0.00"))
         return max(saldo, Decimal("0.00"))
 
+    def calcular_saldo_atual(self):
+        """
+        Saldo a usar nas validações de pagamento.
+
+        total_pago só é recalculado no commit (ver core.recalculo), por isso
+        o saldo é total_final - soma_pagamentos, lidos da base (mantidos por
+        deltas dentro da transação), ou a partir dos itens e pagamentos sem
+        os totais incrementais. Dentro de uma transação a leitura bloqueia o
+        pedido até ao fim: um segundo pagamento espera e já vê o primeiro.
+        """
+        pedidos = Pedido.objects.filter(pk=self.pk)
+        if transaction.get_connection().in_atomic_block:
+            pedidos = pedidos.select_for_update()
+
+        if totais_incrementais():
+            total, pago = pedidos.values_list("total", "soma_pagamentos").get()
+        else:
+            list(pedidos.values_list("pk", flat=True))  # só o lock
+            total = self.itens.aggregate(s=Sum("preco_total"))["s"] or Decimal("0.00")
+            pago = self.pagamentos.aggregate(s=Sum("valor"))["s"] or Decimal("0.00")
+
+        desconto_total = (self.desconto or Decimal("0.00")) + (self.desconto_cabides or Decimal("0.00"))
+        total_final = max(total - desconto_total, Decimal("0.00"))
+        return max(total_final - pago, Decimal("0.00"))
+
     # =============================
     # VALIDAÇÕES
     # =============================
@@ -400,6 +570,184 @@ class Pedido(models.Model):
         self.save(update_fields=["total"])
         self.recalcular_pagamentos()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # valores como estão na base, para os deltas de VendaDiaria
+        instance._original_vendas = instance._valores_vendas()
+        return instance
+
+    def _valores_vendas(self):
+        return {campo: self.__dict__.get(campo) for campo in vendas_diarias.CAMPOS_PEDIDO}
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        # o que foi relido é o que está na base
+        original = getattr(self, "_original_vendas", None)
+        if original is not None:
+            fields = kwargs.get("fields")
+            atuais = self._valores_vendas()
+            for campo in vendas_diarias.CAMPOS_PEDIDO:
+                if fields is None or campo in fields or campo.removesuffix("_id") in fields:
+                    original[campo] = atuais[campo]
+
+    # Mantidos por deltas e pelo recálculo (ver totais_incrementais e
+    # core.recalculo). Um save() sem update_fields de uma instância lida há
+    # algum tempo (ex.: o formulário do admin) gravava por cima deles os
+    # valores de então, perdendo os pagamentos e itens gravados entretanto.
+    CAMPOS_CALCULADOS = (
+        "total", "soma_pagamentos", "ultimo_pagamento_em",
+        "total_pago", "status_pagamento", "pago", "data_pagamento", "recalculo_pendente",
+    )
+
+    def save(self, *args, **kwargs):
+        novo = self._state.adding
+        if not novo:
+            # incremento atómico; o valor novo só é relido se for usado
+            self.versao = F("versao") + 1
+            if kwargs.get("update_fields") is None:
+                kwargs["update_fields"] = [
+                    campo.name for campo in self._meta.concrete_fields
+                    if not campo.primary_key and campo.name not in self.CAMPOS_CALCULADOS
+                ]
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "versao", "atualizado_em"}
+        super().save(*args, **kwargs)
+        if not isinstance(self.versao, int):
+            self.__dict__.pop("versao", None)
+        vendas_diarias.registar_pedido(self, novo=novo, update_fields=kwargs.get("update_fields"))
+
+    # =============================
+    # TOTAIS INCREMENTAIS (DELTAS)
+    # =============================
+
+    def aplicar_delta_total(self, delta):
+        """Soma `delta` ao total do pedido com um UPDATE atómico (F())."""
+        if not delta:
+            return
+        Pedido.objects.filter(pk=self.pk).update(
+            total=F("total") + delta, versao=F("versao") + 1, atualizado_em=timezone.now()
+        )
+        self.total = (self.total or Decimal("0.00")) + delta
+        self.__dict__.pop("versao", None)
+        vendas_diarias.registar_delta_total(self, delta)
+
+    def aplicar_delta_pagamento(self, delta, pago_em=None, recalcular_ultimo=False):
+        """
+        Soma `delta` a soma_pagamentos e actualiza ultimo_pagamento_em.
+
+        pago_em: data de um pagamento novo/alterado (mantém o máximo).
+        recalcular_ultimo: o pagamento mais recente pode ter sido removido ou
+        recuado; relê o máximo pelo índice (pedido, pago_em).
+        """
+        campos = {}
+        if delta:
+            campos["soma_pagamentos"] = F("soma_pagamentos") + delta
+
+        if recalcular_ultimo:
+            campos["ultimo_pagamento_em"] = Subquery(
+                PagamentoPedido.objects
+                .filter(pedido=OuterRef("pk"))
+                .order_by("-pago_em")
+                .values("pago_em")[:1]
+            )
+        elif pago_em is not None:
+            campos["ultimo_pagamento_em"] = Greatest(
+                Coalesce("ultimo_pagamento_em", Value(pago_em)),
+                Value(pago_em),
+            )
+
+        if campos:
+            Pedido.objects.filter(pk=self.pk).update(
+                versao=F("versao") + 1, atualizado_em=timezone.now(), **campos
+            )
+            self.__dict__.pop("versao", None)
+
+    def reagregar(self):
+        """
+        Recalcula tudo a partir das linhas (total, soma_pagamentos,
+        ultimo_pagamento_em) e depois o estado de pagamento.
+        Usado pelo verificador quando detecta desvio nos valores incrementais.
+        """
+        pagamentos = self.pagamentos.aggregate(s=Sum("valor"), ultimo=Max("pago_em"))
+        self.soma_pagamentos = pagamentos["s"] or Decimal("0.00")
+        self.ultimo_pagamento_em = pagamentos["ultimo"]
+        self.recalculo_pendente = False
+        self.save(update_fields=["soma_pagamentos", "ultimo_pagamento_em", "recalculo_pendente"])
+        self.atualizar_total()
+
+    # =============================
+    # ADICIONAR ITENS EM LOTE
+    # =============================
+
+    @transaction.atomic
+    def adicionar_itens(self, itens):
+        """
+        Adiciona vários itens ao pedido de uma só vez (balcão).
+
+        `itens` é uma lista de dicts com as chaves:
+            item_de_servico (ItemServico ou id), quantidade,
+            descricao (opcional), servico (Servico ou id, opcional)
+
+        Os preços são calculados a partir do catálogo em memória
+        (core.catalogo), as linhas são gravadas com um único bulk_create e o total/pagamentos
+        do pedido são recalculados uma única vez, independentemente do
+        número de linhas.
+
+        Levanta ValidationError (sem gravar nada) se um artigo não existir ou
+        não estiver disponível, ou se um serviço não existir ou não estiver
+        activo.
+        """
+        if not itens:
+            return []
+
+        novos = []
+        for item in itens:
+            artigo_id = getattr(item.get("item_de_servico"), "pk", item.get("item_de_servico"))
+            artigo = obter_artigo(artigo_id)
+            if artigo is None:
+                raise ValidationError(f"Artigo {artigo_id} não existe.")
+            if not artigo.disponivel:
+                raise ValidationError(f"Artigo {artigo.nome} não está disponível.")
+
+            try:
+                quantidade = int(item.get("quantidade") or 0)
+            except (TypeError, ValueError):
+                raise ValidationError(f"Quantidade inválida para o artigo {artigo_id}.")
+            if quantidade <= 0:
+                raise ValidationError(f"Quantidade inválida para o artigo {artigo_id}.")
+
+            servico_id = getattr(item.get("servico"), "pk", item.get("servico"))
+            if servico_id is not None:
+                try:
+                    servico_id = int(servico_id)
+                except (TypeError, ValueError):
+                    raise ValidationError(f"Serviço {servico_id} não existe.")
+            novos.append(ItemPedido(
+                pedido=self,
+                servico_id=servico_id,
+                item_de_servico_id=artigo.id,
+                quantidade=quantidade,
+                preco_total=artigo.preco_base * quantidade,
+                descricao=item.get("descricao") or None,
+            ))
+
+        # os serviços não estão no catálogo: uma consulta, só se algum foi indicado
+        servicos = {item.servico_id for item in novos} - {None}
+        if servicos:
+            invalidos = servicos - set(Servico.objects.filter(pk__in=servicos, ativo=True).values_list("pk", flat=True))
+            if invalidos:
+                raise ValidationError(f"Serviço {min(invalidos)} não existe ou não está activo.")
+
+        # bulk_create não passa por ItemPedido.save(), logo não há recálculo por linha
+        criados = ItemPedido.objects.bulk_create(novos)
+        if totais_incrementais():
+            self.aplicar_delta_total(sum(item.preco_total for item in criados))
+            agendar_recalculo(self)
+        else:
+            agendar_recalculo(self, total=True)
+        return criados
+
     # No momento de finalizar o pedido (antes de calcular o total)
     def calcular_total_com_desconto(self):
         # Verifica se o cliente quer usar o desconto
@@ -414,9 +762,13 @@ class Pedido(models.Model):
 
     def recalcular_pagamentos(self):
 
-        soma = self.pagamentos.aggregate(
-            s=Sum("valor")
-        )["s"] or Decimal("0.00")
+        if totais_incrementais():
+            self.refresh_from_db(fields=["soma_pagamentos", "ultimo_pagamento_em"])
+            soma = self.soma_pagamentos or Decimal("0.00")
+        else:
+            soma = self.pagamentos.aggregate(
+                s=Sum("valor")
+            )["s"] or Decimal("0.00")
 
         soma = Decimal(soma)
 
@@ -437,16 +789,12 @@ class Pedido(models.Model):
         elif self.total_pago < total_final:
             self.status_pagamento = "parcial"
             self.pago = False
-
-            ultimo = self.pagamentos.order_by("-pago_em").first()
-            self.data_pagamento = ultimo.pago_em if ultimo else None
+            self.data_pagamento = self._ultimo_pago_em()
 
         else:
             self.status_pagamento = "pago"
             self.pago = True
-
-            ultimo = self.pagamentos.order_by("-pago_em").first()
-            self.data_pagamento = ultimo.pago_em if ultimo else timezone.now()
+            self.data_pagamento = self._ultimo_pago_em() or timezone.now()
 
         self.save(update_fields=[
             "total_pago",
@@ -463,24 +811,27 @@ class Pedido(models.Model):
 
         if self.status_pagamento == "pago":
 
-            # evitar duplicação
-            if not MovimentacaoPontos.objects.filter(
-                    pedido=self,
-                    tipo="ganho"
-            ).exists():
+            pagamento_real = min(self.total_pago, self.total_final)
 
-                pagamento_real = min(self.total_pago, self.total_final)
+            if pagamento_real > 0:
+                with transaction.atomic():
+                    # Locks sempre pela mesma ordem: pedido e depois cliente
+                    # (a de registrar_pagamento), para não haver deadlocks.
+                    list(Pedido.objects.select_for_update().filter(pk=self.pk).values_list("pk", flat=True))
 
-                if pagamento_real > 0:
-                    pontos_ganhos = int(pagamento_real * 10)  # 10 pontos por Mts
+                    # evitar duplicação (verificado com o pedido bloqueado)
+                    if not MovimentacaoPontos.objects.filter(
+                            pedido=self,
+                            tipo="ganho"
+                    ).exists():
+                        pontos_ganhos = int(pagamento_real * 10)  # 10 pontos por Mts
 
-                    with transaction.atomic():
                         cliente = type(self.cliente).objects.select_for_update().get(
-                            pk=self.cliente.pk
+                            pk=self.cliente_id
                         )
 
-                        # Adiciona pontos
-                        cliente.pontos += pontos_ganhos
+                        # Adiciona pontos (movimentação "ganho" + lote com validade)
+                        cliente.creditar_pontos(pontos_ganhos, pedido=self)
 
                         # Verifica se já foi aplicado desconto para este pedido
                         if not hasattr(self, '_desconto_aplicado') or not self._desconto_aplicado:
@@ -497,48 +848,91 @@ class Pedido(models.Model):
 
                         cliente.save(update_fields=["pontos"])
 
-                        MovimentacaoPontos.objects.create(
-                            cliente=cliente,
-                            pedido=self,
-                            tipo="ganho",
-                            pontos=pontos_ganhos,
-                        )
+    def _ultimo_pago_em(self):
+        if totais_incrementais():
+            return self.ultimo_pagamento_em
+        ultimo = self.pagamentos.order_by("-pago_em").first()
+        return ultimo.pago_em if ultimo else None
 
     # =============================
     # REGISTRAR PAGAMENTO
     # =============================
 
     @transaction.atomic
-    def registrar_pagamento(self, *, valor, metodo_pagamento, funcionario=None, referencia=None):
-
+    def registrar_pagamento(self, *, valor, metodo_pagamento, funcionario=None, referencia=None,
+                            chave_idempotencia=None):
+        """
+        Regista um pagamento no pedido e devolve o PagamentoPedido (antes
+        devolvia o Pedido; quem precisar dele tem pagamento.pedido).
+
+        Com `chave_idempotencia` (ex.: id da transação M-Pesa, ou um token
+        gerado pelo POS por cada toque no botão), repetir a chamada devolve
+        o pagamento original em vez de criar outro: a repetição é resolvida
+        com uma leitura, sem locks. A mesma chave com outro valor levanta
+        ValidationError. Locks: pedido e depois cliente (no recálculo),
+        sempre por esta ordem.
+        """
         valor = Decimal(valor)
 
         if valor <= 0:
             raise ValidationError("Valor do pagamento deve ser maior que zero.")
 
+        if chave_idempotencia:
+            existente = self._pagamento_por_chave(chave_idempotencia, valor)
+            if existente:
+                return existente
+
         pedido = Pedido.objects.select_for_update().get(pk=self.pk)
 
-        saldo_atual = pedido.saldo
+        if chave_idempotencia:
+            # outra chamada com a mesma chave pode ter feito commit enquanto
+            # esperávamos pelo lock
+            existente = self._pagamento_por_chave(chave_idempotencia, valor)
+            if existente:
+                return existente
+
+        saldo_atual = pedido.calcular_saldo_atual()
 
         if valor > saldo_atual:
             raise ValidationError(f"Pagamento excede o saldo atual ({saldo_atual}).")
 
-        PagamentoPedido.objects.create(
+        # O save do pagamento agenda o recálculo do pedido para o commit
+        return PagamentoPedido.objects.create(
             pedido=pedido,
             valor=valor,
             metodo_pagamento=metodo_pagamento,
             referencia=referencia,
+            chave_idempotencia=chave_idempotencia or None,
             criado_por=funcionario,
         )
 
-        pedido.recalcular_pagamentos()
-        return pedido
+    def _pagamento_por_chave(self, chave, valor):
+        pagamento = PagamentoPedido.objects.filter(pedido_id=self.pk, chave_idempotencia=chave).first()
+        if pagamento and pagamento.valor != valor:
+            raise ValidationError(
+                f"A chave {chave} já foi usada neste pedido com outro valor ({pagamento.valor})."
+            )
+        return pagamento
 
     def __str__(self):
         return f"Pedido {self.id} - {self.cliente}"
 
     class Meta:
         ordering = ["-criado_em"]
+        indexes = [
+            # changelist do admin / CRM: pedidos da lavandaria, mais recentes primeiro
+            models.Index(fields=["lavandaria", "-criado_em"], name="pedido_lav_criado_idx"),
+            models.Index(fields=["cliente", "status_pagamento"], name="pedido_cli_statuspag_idx"),
+            models.Index(fields=["status", "-criado_em"], name="pedido_status_criado_idx"),
+            # ordering por omissão e filtros por período (dashboard)
+            models.Index(fields=["-criado_em"], name="pedido_criado_idx"),
+            # recibo: pedidos em aberto do cliente (só pedidos não pagos no índice)
+            models.Index(
+                fields=["cliente", "-criado_em"],
+                condition=~models.Q(status_pagamento="pago"),
+                name="pedido_cli_aberto_idx",
+            ),
+        ]
 
 
 # Modelo para Itens do Pedido
@@ -554,21 +948,56 @@ class ItemPedido(models.Model):
     preco_total = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     descricao = models.TextField(blank=True, null=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # valores como estão na base, para calcular deltas no save/delete
+        instance._original = (instance.__dict__.get("pedido_id"), instance.__dict__.get("preco_total"))
+        return instance
+
     def save(self, *args, **kwargs):
-        if self.item_de_servico and self.quantidade:
-            self.preco_total = self.item_de_servico.preco_base * self.quantidade
+        # preço vem do catálogo em memória (sem consultar ItemServico)
+        artigo = obter_artigo(self.item_de_servico_id)
+        if artigo and self.quantidade:
+            self.preco_total = artigo.preco_base * self.quantidade
         else:
             self.preco_total = 0
+
+        novo = self._state.adding
         super().save(*args, **kwargs)
-        self.pedido.atualizar_total()
+
+        if not totais_incrementais() or (not novo and getattr(self, "_original", None) is None):
+            agendar_recalculo(self.pedido, total=True)
+            return
+
+        pedido_original_id, preco_original = (None, None) if novo else self._original
+        preco_original = preco_original or Decimal("0.00")
+
+        if not novo and pedido_original_id != self.pedido_id:
+            # item mudou de pedido: sai do antigo, entra no novo
+            antigo = Pedido.objects.get(pk=pedido_original_id)
+            antigo.aplicar_delta_total(-preco_original)
+            agendar_recalculo(antigo)
+            preco_original = Decimal("0.00")
+
+        self.pedido.aplicar_delta_total(Decimal(self.preco_total) - preco_original)
+        self._original = (self.pedido_id, self.preco_total)
+        agendar_recalculo(self.pedido)
 
     def delete(self, *args, **kwargs):
         pedido = self.pedido
+        _, preco_original = getattr(self, "_original", (None, self.preco_total))
         super().delete(*args, **kwargs)
-        pedido.atualizar_total()
+
+        if totais_incrementais():
+            pedido.aplicar_delta_total(-(preco_original or Decimal("0.00")))
+            agendar_recalculo(pedido)
+        else:
+            agendar_recalculo(pedido, total=True)
 
     def __str__(self):
-        item_nome = self.item_de_servico.nome if self.item_de_servico else "Item Desconhecido"
+        artigo = obter_artigo(self.item_de_servico_id)
+        item_nome = artigo.nome if artigo else "Item Desconhecido"
         return f"{item_nome} - {self.quantidade}x - Total: {self.preco_total}"
 
 
@@ -612,6 +1041,15 @@ class PagamentoPedido(models.Model):
         blank=True
     )
 
+    # Repetições do mesmo pagamento (duplo toque no POS, callback reenviado)
+    # trazem a mesma chave e não criam um segundo registo
+    chave_idempotencia = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False
+    )
+
     pago_em = models.DateTimeField(default=timezone.now)
 
     criado_por = models.ForeignKey(
@@ -639,12 +1077,15 @@ class PagamentoPedido(models.Model):
             return
 
         # Bloquear pagamento acima do saldo
-        saldo_atual = self.pedido.saldo
+        saldo_atual = self.pedido.calcular_saldo_atual()
 
         # Se estiver a editar pagamento existente
         if self.pk:
-            pagamento_original = PagamentoPedido.objects.get(pk=self.pk)
-            saldo_atual += pagamento_original.valor
+            if getattr(self, "_original", None) is not None:
+                saldo_atual += self._original[1]
+            else:
+                pagamento_original = PagamentoPedido.objects.get(pk=self.pk)
+                saldo_atual += pagamento_original.valor
 
         if self.valor > saldo_atual:
             raise ValidationError(
@@ -655,15 +1096,65 @@ class PagamentoPedido(models.Model):
     # SAVE SEGURO
     # =============================
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # valores como estão na base, para calcular deltas no save/delete
+        instance._original = (
+            instance.__dict__.get("pedido_id"),
+            instance.__dict__.get("valor"),
+            instance.__dict__.get("pago_em"),
+        )
+        instance._original_vendas = (
+            instance.__dict__.get("pedido_id"),
+            instance.__dict__.get("pago_em"),
+            instance.__dict__.get("metodo_pagamento"),
+            instance.__dict__.get("criado_por_id"),
+            instance.__dict__.get("valor"),
+        )
+        return instance
+
     @transaction.atomic
     def save(self, *args, **kwargs):
 
         self.full_clean()  # executa clean()
 
+        novo = self._state.adding
         super().save(*args, **kwargs)
 
-        # Recalcular pagamentos do pedido
-        self.pedido.recalcular_pagamentos()
+        if totais_incrementais():
+            self._aplicar_deltas(novo)
+        vendas_diarias.registar_pagamento(self, novo=novo)
+
+        # Recalcular pagamentos do pedido (uma vez, no commit)
+        agendar_recalculo(self.pedido)
+
+    def _aplicar_deltas(self, novo):
+        original = None if novo else getattr(self, "_original", None)
+
+        if not novo and original is None:
+            # sem valores originais conhecidos: relê tudo
+            self.pedido.reagregar()
+            return
+
+        if original is None:
+            self.pedido.aplicar_delta_pagamento(self.valor, pago_em=self.pago_em)
+        else:
+            pedido_original_id, valor_original, pago_em_original = original
+            if pedido_original_id != self.pedido_id:
+                antigo = Pedido.objects.get(pk=pedido_original_id)
+                antigo.aplicar_delta_pagamento(-valor_original, recalcular_ultimo=True)
+                agendar_recalculo(antigo)
+                self.pedido.aplicar_delta_pagamento(self.valor, pago_em=self.pago_em)
+            else:
+                self.pedido.aplicar_delta_pagamento(
+                    self.valor - valor_original,
+                    pago_em=self.pago_em,
+                    # recuar a data pode tirar a este pagamento o lugar de mais recente
+                    recalcular_ultimo=self.pago_em < pago_em_original,
+                )
+
+        self._original = (self.pedido_id, self.valor, self.pago_em)
 
     # =============================
     # DELETE SEGURO
@@ -673,49 +1164,271 @@ class PagamentoPedido(models.Model):
     def delete(self, *args, **kwargs):
 
         pedido = self.pedido
+        _, valor_original, _ = getattr(self, "_original", (None, self.valor, None))
         super().delete(*args, **kwargs)
-        pedido.recalcular_pagamentos()
+
+        if totais_incrementais():
+            pedido.aplicar_delta_pagamento(-valor_original, recalcular_ultimo=True)
+
+        agendar_recalculo(pedido)
 
     def __str__(self):
         return f"Pagamento {self.id} - Pedido {self.pedido.id} - {self.valor} MZN"
 
     class Meta:
         ordering = ["-pago_em"]
+        indexes = [
+            # pagamentos de um pedido / último pagamento
+            models.Index(fields=["pedido", "-pago_em"], name="pagamento_pedido_pago_idx"),
+            # relatório financeiro por período
+            models.Index(fields=["pago_em"], name="pagamento_pago_em_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["pedido", "chave_idempotencia"],
+                condition=models.Q(chave_idempotencia__isnull=False),
+                name="pagamento_chave_idempotencia_unica",
+            ),
+        ]
+
+
+@transaction.atomic
+def quitar_pedidos(pedido_ids, *, funcionario=None, metodo_pagamento="numerario"):
+    """
+    Paga o saldo de vários pedidos de uma só vez (fecho do dia).
+
+    Uma consulta bloqueia os pedidos (por pk) e soma o que já foi pago; os
+    pagamentos são gravados com um bulk_create, o estado de pagamento dos
+    pedidos com um bulk_update e os pontos/descontos de fidelidade são
+    atribuídos em lote por cliente. Tudo numa transação.
+
+    Devolve uma lista (por pk) com o resultado de cada pedido:
+        {"pedido", "estado" ("quitado", "sem_saldo" ou "inexistente"),
+         "valor", "pagamento", "pontos", "desconto"}
+    """
+    agora = timezone.now()
+    ids = sorted(set(pedido_ids))
+    resultado = {
+        pk: {"pedido": pk, "estado": "inexistente", "valor": Decimal("0.00"),
+             "pagamento": None, "pontos": 0, "desconto": Decimal("0.00")}
+        for pk in ids
+    }
+
+    ja_pago = (
+        PagamentoPedido.objects.filter(pedido=OuterRef("pk"))
+        .order_by().values("pedido").annotate(s=Sum("valor")).values("s")
+    )
+    pedidos = (
+        Pedido.objects.select_for_update()
+        .filter(pk__in=ids)
+        .order_by("pk")
+        .annotate(ja_pago=Coalesce(
+            Subquery(ja_pago[:1]), Value(Decimal("0.00")),
+            output_field=models.DecimalField(max_digits=12, decimal_places=2),
+        ))
+    )
+
+    novos = []
+    quitados = []
+    for pedido in pedidos:
+        saldo = max(pedido.total_final - pedido.ja_pago, Decimal("0.00"))
+        linha = resultado[pedido.pk]
+        if saldo <= 0:
+            linha["estado"] = "sem_saldo"
+            continue
+
+        linha.update(estado="quitado", valor=saldo)
+        novos.append(PagamentoPedido(
+            pedido=pedido,
+            valor=saldo,
+            metodo_pagamento=metodo_pagamento,
+            criado_por=funcionario,
+            pago_em=agora,
+        ))
+
+        # o mesmo estado que recalcular_pagamentos() daria depois deste pagamento
+        pedido.soma_pagamentos = pedido.ja_pago + saldo
+        pedido.ultimo_pagamento_em = max(pedido.ultimo_pagamento_em or agora, agora)
+        pedido.total_pago = pedido.total_final
+        pedido.status_pagamento = "pago"
+        pedido.pago = True
+        pedido.data_pagamento = pedido.ultimo_pagamento_em
+        pedido.versao = F("versao") + 1
+        pedido.atualizado_em = agora
+        quitados.append(pedido)
+
+    if not quitados:
+        return list(resultado.values())
+
+    # bulk_create/bulk_update não passam por save(): sem full_clean nem recálculo por pedido
+    campos = [
+        "soma_pagamentos", "ultimo_pagamento_em", "total_pago",
+        "status_pagamento", "pago", "data_pagamento", "versao", "atualizado_em",
+    ]
+    deltas = vendas_diarias.Deltas()
+    for pagamento in PagamentoPedido.objects.bulk_create(novos):
+        resultado[pagamento.pedido_id]["pagamento"] = pagamento.pk
+        vendas_diarias.registar_pagamento(pagamento, novo=True, deltas=deltas)
+    Pedido.objects.bulk_update(quitados, campos, batch_size=500)
+    for pedido in quitados:
+        pedido.__dict__.pop("versao", None)
+        vendas_diarias.registar_pedido(pedido, update_fields=campos, deltas=deltas)
+
+    _fidelidade_pedidos_quitados(quitados, resultado, agora, deltas)
+    deltas.aplicar()
+    return list(resultado.values())
+
+
+def _fidelidade_pedidos_quitados(pedidos, resultado, agora, deltas):
+    """
+    Pontos (10 por Mt pago) e desconto de fidelidade dos pedidos acabados de
+    quitar, com as mesmas regras de recalcular_pagamentos(), mas com uma
+    consulta por tipo de registo em vez de várias por pedido.
+    """
+    ja_pontuados = set(
+        MovimentacaoPontos.objects.filter(pedido__in=pedidos, tipo="ganho").values_list("pedido_id", flat=True)
+    )
+    a_pontuar = [p for p in pedidos if p.pk not in ja_pontuados and p.total_pago > 0]
+    if not a_pontuar:
+        return
+
+    # pedidos já estão bloqueados; clientes a seguir, sempre por pk
+    clientes = {
+        cliente.pk: cliente
+        for cliente in Cliente.objects.select_for_update()
+        .filter(pk__in={p.cliente_id for p in a_pontuar})
+        .order_by("pk")
+    }
+
+    movimentacoes = MovimentacaoPontos.objects.bulk_create([
+        MovimentacaoPontos(cliente_id=p.cliente_id, pedido=p, tipo="ganho", pontos=int(p.total_pago * 10))
+        for p in a_pontuar
+    ])
+    LotePontos.objects.bulk_create([
+        LotePontos(
+            cliente_id=mov.cliente_id,
+            movimentacao=mov,
+            pontos=mov.pontos,
+            saldo=mov.pontos,
+            criado_em=agora,
+            expira_em=agora + VALIDADE_PONTOS,
+        )
+        for mov in movimentacoes
+    ])
+
+    com_desconto = []
+    for pedido, mov in zip(a_pontuar, movimentacoes):
+        cliente = clientes[pedido.cliente_id]
+        cliente.pontos += mov.pontos
+        cliente.total_gasto_acumulado += pedido.total_pago
+        resultado[pedido.pk]["pontos"] = mov.pontos
+        vendas_diarias.registar_pontos(pedido, mov.pontos, deltas)
+
+        # só faz consultas quando o cliente passa um marco de 5000 Mts
+        desconto = cliente.aplicar_desconto_fidelidade()
+        if desconto > 0:
+            pedido.desconto += desconto
+            resultado[pedido.pk]["desconto"] = desconto
+            com_desconto.append(pedido)
+
+    Cliente.objects.bulk_update(list(clientes.values()), ["pontos", "total_gasto_acumulado"])
+    for pedido in com_desconto:
+        pedido.versao = F("versao") + 1
+        pedido.atualizado_em = agora
+    Pedido.objects.bulk_update(com_desconto, ["desconto", "versao", "atualizado_em"])
+    for pedido in com_desconto:
+        pedido.__dict__.pop("versao", None)
+        vendas_diarias.registar_pedido(pedido, update_fields=["desconto"], deltas=deltas)
+
+
+def totais_incrementais():
+    """
+    Modo incremental (settings.PEDIDO_TOTAIS_INCREMENTAIS, activo por omissão):
+    Pedido.total, soma_pagamentos e ultimo_pagamento_em são mantidos por deltas
+    atómicos em vez de re-agregar itens/pagamentos a cada gravação.
+    O comando `verificar_totais_pedidos` corrige eventuais desvios.
+    """
+    return getattr(settings, "PEDIDO_TOTAIS_INCREMENTAIS", True)
+
+
+# Permissões (codenames do app core) de cada grupo de funcionários
+GRUPOS_PERMISSOES = {
+    "gerente": [
+        "view_funcionario",
+        "add_itemservico", "change_itemservico", "delete_itemservico", "view_itemservico",
+        "add_servico", "change_servico", "delete_servico", "view_servico",
+        "add_pedido", "change_pedido", "delete_pedido", "view_pedido",
+        "add_cliente", "change_cliente", "delete_cliente", "view_cliente",
+        "add_itempedido", "change_itempedido", "delete_itempedido", "view_itempedido",
+        "add_pagamentopedido", "change_pagamentopedido", "delete_pagamentopedido", "view_pagamentopedido",
+    ],
+    "caixa": [
+        "add_pedido", "change_pedido", "delete_pedido", "view_pedido",
+        "add_cliente", "change_cliente", "delete_cliente", "view_cliente",
+        "add_itempedido", "change_itempedido", "delete_itempedido", "view_itempedido",
+    ],
+}
+
+CHAVE_CACHE_GRUPOS = "core:grupos_permissoes"
+
+# Impressão digital da definição já aplicada neste processo
+_grupos_aplicados = None
+
+
+def _impressao_digital_grupos():
+    definicao = json.dumps(GRUPOS_PERMISSOES, sort_keys=True)
+    return hashlib.sha256(definicao.encode()).hexdigest()
 
 
 # Função para criar grupos e associar permissões
-def criar_grupos_com_permissoes():
+def criar_grupos_com_permissoes(forcar=False):
     """
     Cria grupos predefinidos (gerente, caixa) e associa as permissões específicas.
+
+    Resolve todas as permissões numa consulta, compara com as que os grupos já
+    têm e só grava as que faltam (em lote). As permissões dadas à mão pelo
+    admin não são removidas. Se a definição (GRUPOS_PERMISSOES) já foi
+    aplicada, não faz nenhuma consulta, salvo com forcar=True.
     """
-    grupos_permissoes = {
-        "gerente": [
-            "view_funcionario",
-            "add_itemservico", "change_itemservico", "delete_itemservico", "view_itemservico",
-            "add_servico", "change_servico", "delete_servico", "view_servico",
-            "add_pedido", "change_pedido", "delete_pedido", "view_pedido",
-            "add_cliente", "change_cliente", "delete_cliente", "view_cliente",
-            "add_itempedido", "change_itempedido", "delete_itempedido", "view_itempedido",
-            "add_pagamentopedido", "change_pagamentopedido", "delete_pagamentopedido", "view_pagamentopedido",
-        ],
-        "caixa": [
-            "add_pedido", "change_pedido", "delete_pedido", "view_pedido",
-            "add_cliente", "change_cliente", "delete_cliente", "view_cliente",
-            "add_itempedido", "change_itempedido", "delete_itempedido", "view_itempedido",
-        ],
-    }
+    global _grupos_aplicados
 
-    for grupo_nome, permissoes_codigos in grupos_permissoes.items():
-        grupo, criado = Group.objects.get_or_create(name=grupo_nome)
-        if criado:
-            print(f"Grupo '{grupo_nome}' criado.")
+    impressao = _impressao_digital_grupos()
+    if not forcar and impressao in (_grupos_aplicados, cache.get(CHAVE_CACHE_GRUPOS)):
+        _grupos_aplicados = impressao
+        return
 
-        for permissao_codigo in permissoes_codigos:
-            permissao = Permission.objects.filter(codename=permissao_codigo).first()
-            if permissao:
-                grupo.permissions.add(permissao)
+    nomes = list(GRUPOS_PERMISSOES)
+    Group.objects.bulk_create([Group(name=nome) for nome in nomes], ignore_conflicts=True)
+    grupos = dict(Group.objects.filter(name__in=nomes).values_list("name", "id"))
 
-        print(f"Permissões associadas ao grupo '{grupo_nome}': {permissoes_codigos}")
+    codigos = {codigo for codigos in GRUPOS_PERMISSOES.values() for codigo in codigos}
+    permissoes = dict(
+        Permission.objects.filter(codename__in=codigos, content_type__app_label="core")
+        .values_list("codename", "id")
+    )
+
+    GrupoPermissao = Group.permissions.through
+    existentes = set(
+        GrupoPermissao.objects.filter(group_id__in=grupos.values())
+        .values_list("group_id", "permission_id")
+    )
+
+    em_falta = [
+        GrupoPermissao(group_id=grupos[nome], permission_id=permissoes[codigo])
+        for nome, codigos_grupo in GRUPOS_PERMISSOES.items()
+        for codigo in codigos_grupo
+        if codigo in permissoes and (grupos[nome], permissoes[codigo]) not in existentes
+    ]
+    GrupoPermissao.objects.bulk_create(em_falta, ignore_conflicts=True)
+
+    if em_falta:
+        logger.info("Grupos de funcionários: %d permissão(ões) associadas.", len(em_falta))
+
+    # Só marca como aplicada se todas as permissões já existem (no primeiro
+    # migrate podem ainda não ter sido criadas)
+    if codigos <= set(permissoes):
+        _grupos_aplicados = impressao
+        cache.set(CHAVE_CACHE_GRUPOS, impressao, None)
 
 
 class Recibo(models.Model):
@@ -741,5 +1454,191 @@ class Recibo(models.Model):
         return f"Recibo {self.id} - Pedido {self.pedido_id} - Total: {self.total_pago}"
 
 
+# Versão de conjuntos de dados cacheados em memória (partilhada entre workers)
+class VersaoDados(models.Model):
+    """
+    Contador por chave (ex.: "catalogo"). Quem altera os dados incrementa a
+    versão; cada processo compara a versão que tem em cache com esta linha
+    para saber se tem de recarregar.
+    """
+    chave = models.CharField(max_length=50, unique=True)
+    versao = models.PositiveBigIntegerField(default=1)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Versão de dados"
+        verbose_name_plural = "Versões de dados"
+
+    def __str__(self):
+        return f"{self.chave} v{self.versao}"
+
+    @classmethod
+    def atual(cls, chave):
+        return cls.objects.filter(chave=chave).values_list("versao", flat=True).first() or 0
+
+    @classmethod
+    def atuais(cls, chaves):
+        """{chave: versão} numa consulta (0 para as chaves sem linha)."""
+        versoes = dict.fromkeys(chaves, 0)
+        versoes.update(cls.objects.filter(chave__in=versoes).values_list("chave", "versao"))
+        return versoes
+
+    @classmethod
+    def incrementar(cls, chave):
+        atualizados = cls.objects.filter(chave=chave).update(
+            versao=F("versao") + 1, atualizado_em=timezone.now()
+        )
+        if not atualizados:
+            cls.objects.get_or_create(chave=chave)
+
+
+# Relatórios gerados fora do pedido HTTP (ver core/tarefas.py)
+class TarefaRelatorio(models.Model):
+    """
+    Relatório pedido no admin e gerado pelo comando processar_relatorios
+    (dyno worker). O ficheiro fica na própria base de dados, partilhada
+    entre os dynos web e worker, até ser apagado pela política de retenção
+    (RELATORIO_RETENCAO_HORAS).
+    """
+    TIPO_CHOICES = [
+        ("vendas", "Relatório de vendas"),
+        ("financeiro", "Relatório financeiro"),
+    ]
+    ESTADO_CHOICES = [
+        ("pendente", "Pendente"),
+        ("em_curso", "Em curso"),
+        ("concluido", "Concluído"),
+        ("erro", "Erro"),
+    ]
+
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES)
+    estado = models.CharField(max_length=20, choices=ESTADO_CHOICES, default="pendente")
+    parametros = models.JSONField(default=dict, blank=True)
+    progresso = models.PositiveSmallIntegerField(default=0, help_text="0 a 100")
+    tentativas = models.PositiveSmallIntegerField(default=0)
+    mensagem = models.TextField(blank=True, default="")
+
+    nome_ficheiro = models.CharField(max_length=255, blank=True, default="")
+    conteudo = models.BinaryField(null=True, blank=True, editable=False)
+    tamanho = models.PositiveIntegerField(default=0)
+
+    criado_por = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name="tarefas_relatorio"
+    )
+    criado_em = models.DateTimeField(auto_now_add=True)
+    iniciado_em = models.DateTimeField(null=True, blank=True)
+    concluido_em = models.DateTimeField(null=True, blank=True)
+    # também marca que o worker continua vivo (ver recuperar_tarefas_paradas)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["-criado_em"]
+        verbose_name = "Tarefa de relatório"
+        verbose_name_plural = "Tarefas de relatório"
+        indexes = [
+            # próxima tarefa pendente / tarefas paradas / retenção
+            models.Index(fields=["estado", "criado_em"], name="tarefa_estado_criado_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.get_tipo_display()} #{self.pk} ({self.get_estado_display()})"
 
 
+# Totais de vendas por dia (ver core/vendas_diarias.py)
+class VendaDiaria(models.Model):
+    """
+    Agregado diário por (lavandaria, dia, método de pagamento, funcionário),
+    lido pelo dashboard e pelo CRM em vez de somar pedidos/pagamentos.
+
+    Linhas com metodo_pagamento vazio são do lado dos pedidos (dia de
+    criação, funcionário do pedido); as restantes são dos pagamentos (dia
+    do pagamento, funcionário que o registou). Mantido por deltas quando um pedido ou pagamento muda (pode haver mais
+    do que uma linha por chave: quem lê soma sempre); o comando
+    `reconstruir_vendas_diarias` verifica e reconstrói a partir das tabelas.
+    """
+    lavandaria = models.ForeignKey(Lavandaria, on_delete=models.CASCADE, related_name="vendas_diarias")
+    dia = models.DateField()
+    metodo_pagamento = models.CharField(max_length=20, blank=True, default="")
+    funcionario = models.ForeignKey(
+        Funcionario, on_delete=models.SET_NULL, null=True, blank=True, related_name="vendas_diarias"
+    )
+
+    # pedidos criados no dia
+    pedidos = models.IntegerField(default=0)
+    pedidos_pagos = models.IntegerField(default=0)
+    valor_pedidos = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+    valor_pedidos_pagos = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+    desconto = models.DecimalField(
+        max_digits=14, decimal_places=2, default=Decimal("0.00"),
+        help_text="Desconto geral, incluindo o de fidelidade",
+    )
+    desconto_cabides = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+    pontos_ganhos = models.BigIntegerField(default=0)
+
+    # pagamentos recebidos no dia
+    pagamentos = models.IntegerField(default=0)
+    valor_recebido = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal("0.00"))
+
+    class Meta:
+        verbose_name = "Venda diária"
+        verbose_name_plural = "Vendas diárias"
+        indexes = [
+            models.Index(fields=["lavandaria", "dia"], name="vendadiaria_lav_dia_idx"),
+            models.Index(fields=["dia"], name="vendadiaria_dia_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.lavandaria_id} {self.dia} {self.metodo_pagamento or 'pedidos'}"
+
+
+# Relatórios financeiros de dias fechados (ver core/relatorios_fechados.py)
+class RelatorioDiario(models.Model):
+    """
+    Movimentos (pagamentos) de um dia já fechado de uma lavandaria, lidos
+    uma vez e reutilizados pelos relatórios de qualquer período que inclua
+    o dia. Só serve enquanto `versao` for a versão actual do dia.
+    """
+    lavandaria = models.ForeignKey(Lavandaria, on_delete=models.CASCADE, related_name="relatorios_diarios")
+    dia = models.DateField()
+    versao = models.PositiveBigIntegerField(default=0, help_text="VersaoDados do dia quando foi montado")
+    movimentos = models.JSONField(default=list, blank=True, encoder=DjangoJSONEncoder)
+    criado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Relatório diário"
+        verbose_name_plural = "Relatórios diários"
+        constraints = [
+            models.UniqueConstraint(fields=["lavandaria", "dia"], name="relatoriodiario_lav_dia_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.lavandaria} {self.dia} v{self.versao}"
+
+
+class RelatorioFechado(models.Model):
+    """
+    Relatório financeiro (PDF/XLSX) de um período fechado, já gerado.
+    Devolvido enquanto a chave (versões dos dias e dos pedidos do período)
+    for a mesma; apagado pela retenção (RELATORIO_FECHADO_RETENCAO_DIAS).
+    """
+    lavandaria = models.ForeignKey(Lavandaria, on_delete=models.CASCADE, related_name="relatorios_fechados")
+    dia_inicio = models.DateField()
+    dia_fim = models.DateField()
+    formato = models.CharField(max_length=10)
+    chave = models.CharField(max_length=64)
+
+    nome_ficheiro = models.CharField(max_length=255)
+    conteudo = models.BinaryField(editable=False)
+    tamanho = models.PositiveIntegerField(default=0)
+    criado_em = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-criado_em"]
+        verbose_name = "Relatório fechado"
+        verbose_name_plural = "Relatórios fechados"
+        indexes = [
+            models.Index(fields=["lavandaria", "dia_inicio", "dia_fim", "formato"], name="relatoriofechado_periodo_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.nome_ficheiro} ({self.chave[:8]})"
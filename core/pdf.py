@@ -0,0 +1,395 @@
+"""
+PDFs (relatórios de vendas/financeiro e recibo) desenhados directamente
+com o reportlab (platypus), sem passar por HTML.
+
+- fontes e estilos são preparados uma vez por processo (obter_recursos);
+- as tabelas grandes são partidas em blocos de LINHAS_POR_BLOCO linhas,
+  gerados à medida que o reportlab precisa deles (FluxoFlowables): a
+  paginação não recalcula tabelas inteiras e os pedidos/pagamentos são
+  lidos da base de dados aos poucos;
+- o PDF é escrito num ficheiro temporário (pdf_em_bytes); os relatórios
+  são gerados pelo worker da fila de relatórios (core/tarefas.py).
+"""
+import tempfile
+import threading
+
+from django.template.defaultfilters import date as formatar_data
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from .catalogo import obter_artigo
+from .templatetags.custom_filters import currency_mzn
+
+# Vera: família TrueType distribuída com o reportlab (acentos incluídos)
+FONTE = "Vera"
+FONTE_NEGRITO = "Vera-Bold"
+FONTES = ((FONTE, "Vera.ttf"), (FONTE_NEGRITO, "VeraBd.ttf"))
+
+AZUL = colors.HexColor("#007bff")
+CINZENTO = colors.HexColor("#f8f9fa")
+LINHA = colors.HexColor("#e0e0e0")
+MUTED = colors.HexColor("#777777")
+
+MARGEM = 1.5 * cm
+LARGURA_UTIL = A4[0] - 2 * MARGEM
+
+# Linhas por tabela: o reportlab mede a tabela inteira a cada quebra de
+# página, por isso tabelas de milhares de linhas são partidas em blocos
+LINHAS_POR_BLOCO = 100
+
+# Textos maiores do que isto numa célula passam a Paragraph (com quebra
+# de linha); os restantes ficam como texto simples, muito mais rápido
+MAX_TEXTO_SIMPLES = 45
+
+
+class RecursosPDF:
+    """
+    Fontes registadas no reportlab e estilos de parágrafo/tabela.
+    Preparados uma vez por processo (ver obter_recursos).
+    """
+
+    def __init__(self):
+        for nome, ficheiro in FONTES:
+            pdfmetrics.registerFont(TTFont(nome, ficheiro))
+        pdfmetrics.registerFontFamily(FONTE, normal=FONTE, bold=FONTE_NEGRITO)
+
+        self.empresa = ParagraphStyle("empresa", fontName=FONTE_NEGRITO, fontSize=12, leading=15, textColor=AZUL)
+        self.subtitulo = ParagraphStyle("subtitulo", fontName=FONTE, fontSize=9, leading=12, textColor=colors.HexColor("#555555"))
+        self.titulo = ParagraphStyle("titulo", fontName=FONTE_NEGRITO, fontSize=16, leading=20, alignment=TA_CENTER)
+        self.secao = ParagraphStyle(
+            "secao", fontName=FONTE_NEGRITO, fontSize=9, leading=12, backColor=CINZENTO,
+            borderColor=AZUL, borderPadding=(5, 4, 5, 6), spaceBefore=14, spaceAfter=8,
+        )
+        self.texto = ParagraphStyle("texto", fontName=FONTE, fontSize=10, leading=13)
+        self.celula = ParagraphStyle("celula", fontName=FONTE, fontSize=8, leading=10)
+        self.rodape = ParagraphStyle("rodape", fontName=FONTE, fontSize=8, leading=10, textColor=MUTED, alignment=TA_CENTER)
+
+        self.tabela = [
+            ("FONTNAME", (0, 0), (-1, -1), FONTE),
+            ("FONTSIZE", (0, 0), (-1, -1), 8),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("LINEBELOW", (0, 0), (-1, -1), 0.5, LINHA),
+            ("FONTNAME", (0, 0), (-1, 0), FONTE_NEGRITO),
+            ("BACKGROUND", (0, 0), (-1, 0), CINZENTO),
+            ("LINEBELOW", (0, 0), (-1, 0), 1, AZUL),
+        ]
+
+
+_recursos = None
+_recursos_lock = threading.Lock()
+
+
+def obter_recursos():
+    global _recursos
+    if _recursos is None:
+        with _recursos_lock:
+            if _recursos is None:
+                _recursos = RecursosPDF()
+    return _recursos
+
+
+class FluxoFlowables(list):
+    """
+    Lista de flowables alimentada por um gerador. O reportlab consome a
+    lista pela frente e pergunta sempre len() antes: só os próximos
+    flowables existem em memória de cada vez.
+    """
+
+    def __init__(self, gerador):
+        super().__init__()
+        self._gerador = iter(gerador)
+
+    def __len__(self):
+        while self._gerador is not None and list.__len__(self) < 2:
+            try:
+                self.append(next(self._gerador))
+            except StopIteration:
+                self._gerador = None
+        return list.__len__(self)
+
+
+def escapar(texto):
+    """Texto livre (nomes, descrições) para dentro de um Paragraph."""
+    return str(texto).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def celula(texto):
+    texto = "" if texto is None else str(texto)
+    if len(texto) <= MAX_TEXTO_SIMPLES:
+        return texto
+    return Paragraph(escapar(texto), obter_recursos().celula)
+
+
+def tabela_em_blocos(cabecalho, linhas, larguras, estilo=(), estilos_linha=None):
+    """
+    Gera Tables de até LINHAS_POR_BLOCO linhas, cada uma com o cabeçalho
+    (repetido também nas quebras de página).
+
+    `linhas`: iterável de (celulas, tipo). `estilos_linha`: {tipo: [comandos
+    de TableStyle com coordenadas de coluna]} aplicados às linhas desse tipo.
+    """
+    recursos = obter_recursos()
+    estilos_linha = estilos_linha or {}
+    bloco, comandos = [cabecalho], []
+
+    def fechar():
+        tabela = Table(bloco, colWidths=larguras, repeatRows=1)
+        tabela.setStyle(TableStyle(recursos.tabela + list(estilo) + comandos))
+        return tabela
+
+    for celulas, tipo in linhas:
+        for cmd, inicio, fim, *args in estilos_linha.get(tipo, ()):
+            n = len(bloco)
+            comandos.append((cmd, (inicio, n), (fim, n), *args))
+        bloco.append(celulas)
+        if len(bloco) > LINHAS_POR_BLOCO:
+            yield fechar()
+            bloco, comandos = [cabecalho], []
+
+    if len(bloco) > 1:
+        yield fechar()
+
+
+def construir_pdf(ficheiro, flowables, titulo=""):
+    """Desenha os flowables (lista ou gerador) em A4 no ficheiro dado."""
+    obter_recursos()
+    doc = SimpleDocTemplate(
+        ficheiro, pagesize=A4, title=titulo,
+        leftMargin=MARGEM, rightMargin=MARGEM, topMargin=MARGEM, bottomMargin=MARGEM,
+    )
+    doc.build(FluxoFlowables(flowables), onFirstPage=_numerar_pagina, onLaterPages=_numerar_pagina)
+
+
+def _numerar_pagina(canvas, doc):
+    canvas.saveState()
+    canvas.setFont(FONTE, 7)
+    canvas.setFillColor(MUTED)
+    canvas.drawRightString(A4[0] - MARGEM, MARGEM / 2, f"Página {doc.page}")
+    canvas.restoreState()
+
+
+def pdf_em_bytes(flowables, titulo=""):
+    """PDF completo em bytes (recibo em cache, tarefas de relatório)."""
+    with tempfile.SpooledTemporaryFile() as ficheiro:
+        construir_pdf(ficheiro, flowables, titulo)
+        ficheiro.seek(0)
+        return ficheiro.read()
+
+
+def _cabecalho(*linhas):
+    recursos = obter_recursos()
+    yield Paragraph("POWER WASHING, LDA", recursos.empresa)
+    yield Paragraph("<br/>".join(linhas), recursos.subtitulo)
+    yield Spacer(1, 12)
+
+
+# ===== RELATÓRIO DE VENDAS (Entidade/Artigo) =====
+
+def relatorio_vendas(pedidos, start_date, end_date, quantidade_total):
+    """
+    Flowables do relatório de vendas: por pedido, os itens (artigo,
+    quantidade, descrição) e o subtotal de unidades; no fim o total.
+    `pedidos`: iterável de core.relatorios.pedidos_vendas();
+    `quantidade_total`: core.relatorios.quantidade_total().
+    """
+    yield from _cabecalho(f"Vendas: Entidade/Artigo ({start_date} até {end_date})")
+
+    def linhas():
+        for pedido in pedidos:
+            yield [f"{pedido.cliente.nome} - {pedido.id}", "", ""], "pedido"
+            for item in pedido.itens.all():
+                artigo = obter_artigo(item.item_de_servico_id)
+                yield [celula(artigo.nome if artigo else ""), f"{item.quantidade} UN", celula(item.descricao or "")], None
+            yield ["Subtotal", "", f"{pedido.quantidade_itens} UN"], "subtotal"
+
+    larguras = [LARGURA_UTIL * 0.45, LARGURA_UTIL * 0.15, LARGURA_UTIL * 0.40]
+    yield from tabela_em_blocos(
+        ["ITEM", "QUANT.", "DESC."],
+        linhas(),
+        larguras,
+        estilo=[("ALIGN", (1, 0), (1, -1), "CENTER")],
+        estilos_linha={
+            "pedido": [("SPAN", 0, -1), ("BACKGROUND", 0, -1, CINZENTO), ("FONTNAME", 0, -1, FONTE_NEGRITO)],
+            "subtotal": [("SPAN", 0, 1), ("FONTNAME", 0, -1, FONTE_NEGRITO), ("ALIGN", 2, 2, "CENTER")],
+        },
+    )
+
+    total = Table([["Total de Itens", f"{quantidade_total} UN"]], colWidths=[LARGURA_UTIL * 0.6, LARGURA_UTIL * 0.4])
+    total.setStyle(TableStyle([
+        ("FONTNAME", (0, 0), (0, 0), FONTE_NEGRITO),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("LINEABOVE", (0, 0), (-1, 0), 1, LINHA),
+    ]))
+    yield Spacer(1, 10)
+    yield total
+
+
+# ===== RELATÓRIO FINANCEIRO (Caixa) =====
+
+def _tabela_resumo(titulo_coluna, linhas, campo, formatar=str, total=None):
+    """Tabela de resumo (nome, quantidade, total) de um values().annotate()."""
+    dados = [[titulo_coluna.upper(), "QTD", "TOTAL RECEBIDO"]]
+    for row in linhas:
+        dados.append([celula(formatar(row[campo])), row["qtd"], currency_mzn(row["total"])])
+    vazio = len(dados) == 1
+    if vazio:
+        dados.append(["Sem movimentos.", "", ""])
+    if total is not None:
+        dados.append(["Total", "", currency_mzn(total)])
+
+    tabela = Table(dados, colWidths=[LARGURA_UTIL * 0.5, LARGURA_UTIL * 0.15, LARGURA_UTIL * 0.35], repeatRows=1)
+    estilo = obter_recursos().tabela + [
+        ("ALIGN", (1, 0), (1, -1), "CENTER"),
+        ("ALIGN", (2, 0), (2, -1), "RIGHT"),
+    ]
+    if vazio:
+        estilo.append(("TEXTCOLOR", (0, 1), (0, 1), MUTED))
+    if total is not None:
+        estilo += [
+            ("FONTNAME", (0, -1), (-1, -1), FONTE_NEGRITO),
+            ("BACKGROUND", (0, -1), (-1, -1), CINZENTO),
+            ("LINEABOVE", (0, -1), (-1, -1), 1, LINHA),
+        ]
+    tabela.setStyle(TableStyle(estilo))
+    return tabela
+
+
+def relatorio_financeiro(contexto):
+    """
+    Flowables do relatório financeiro (caixa). `contexto`: o mesmo dicionário
+    que o modelo core/relatorio_financeiro.html recebia.
+    """
+    recursos = obter_recursos()
+    lavandaria = contexto["lavandaria"]
+    yield from _cabecalho(
+        "Relatório Financeiro (Caixa) - Recebimentos",
+        f"Período: <b>{contexto['start_date']}</b> até <b>{contexto['end_date']}</b>",
+        escapar(f"{lavandaria} - {lavandaria.endereco}") if lavandaria else "Lavandaria: (não definida)",
+    )
+
+    kpis = Table(
+        [
+            ["TOTAL FATURADO (PEDIDOS)", "TOTAL RECEBIDO (PAGAMENTOS)", "SALDO EM ABERTO"],
+            [currency_mzn(contexto["total_faturado"]), currency_mzn(contexto["total_recebido"]),
+             currency_mzn(contexto["saldo_total"])],
+        ],
+        colWidths=[LARGURA_UTIL / 3] * 3,
+    )
+    kpis.setStyle(TableStyle([
+        ("BOX", (0, 0), (-1, -1), 0.5, LINHA),
+        ("INNERGRID", (0, 0), (-1, -1), 0.5, LINHA),
+        ("LINEBELOW", (0, 0), (-1, 0), 0, colors.white),
+        ("FONTNAME", (0, 0), (-1, 0), FONTE),
+        ("FONTSIZE", (0, 0), (-1, 0), 7),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.HexColor("#666666")),
+        ("FONTNAME", (0, 1), (-1, 1), FONTE_NEGRITO),
+        ("FONTSIZE", (0, 1), (-1, 1), 11),
+    ]))
+    yield kpis
+
+    total_recebido = contexto["total_recebido"]
+    yield Paragraph("Resumo por Método de Pagamento", recursos.secao)
+    yield _tabela_resumo(
+        "Método", contexto["resumo_por_metodo"], "metodo_pagamento",
+        lambda m: (m or "-").title(), total=total_recebido,
+    )
+    yield Paragraph("Resumo por Dia (Data de Pagamento)", recursos.secao)
+    yield _tabela_resumo("Dia", contexto["resumo_por_dia"], "pago_em__date", lambda d: formatar_data(d, "d/m/Y"))
+    yield Paragraph("Resumo por Caixa (Operador)", recursos.secao)
+    yield _tabela_resumo("Caixa", contexto["resumo_por_caixa"], "criado_por__user__username", lambda u: u or "-")
+    yield Paragraph("Resumo por Lavandaria", recursos.secao)
+    yield _tabela_resumo("Lavandaria", contexto["resumo_por_lavandaria"], "pedido__lavandaria__nome", lambda n: n or "-")
+
+    yield Paragraph("Movimentos (Pagamentos)", recursos.secao)
+    # core.relatorios.Movimento, lidos aos poucos ou das partes de dias fechados
+    pagamentos = contexto["pagamentos"]
+
+    def linhas():
+        vazio = True
+        for p in pagamentos:
+            vazio = False
+            yield [
+                p.id,
+                p.pedido_id,
+                celula(p.cliente),
+                formatar_data(p.pedido_criado_em, "d/m/Y"),
+                formatar_data(p.pago_em, "d/m/Y H:i"),
+                p.metodo_pagamento.title(),
+                p.caixa or "-",
+                currency_mzn(p.valor),
+            ], None
+        if vazio:
+            yield ["Nenhum pagamento encontrado.", "", "", "", "", "", "", ""], "vazio"
+        yield ["Total Recebido", "", "", "", "", "", "", currency_mzn(total_recebido)], "total"
+
+    fracoes = [0.06, 0.08, 0.23, 0.11, 0.17, 0.11, 0.10, 0.14]
+    yield from tabela_em_blocos(
+        ["#", "#PEDIDO", "CLIENTE", "DATA DO\nPEDIDO", "DATA DO\nPAGAMENTO", "MÉTODO", "CAIXA", "VALOR"],
+        linhas(),
+        [LARGURA_UTIL * f for f in fracoes],
+        estilo=[("FONTSIZE", (0, 0), (-1, 0), 6.5), ("ALIGN", (-1, 0), (-1, -1), "RIGHT")],
+        estilos_linha={
+            "vazio": [("SPAN", 0, -1), ("TEXTCOLOR", 0, 0, MUTED)],
+            "total": [
+                ("SPAN", 0, -2), ("FONTNAME", 0, -1, FONTE_NEGRITO),
+                ("BACKGROUND", 0, -1, CINZENTO), ("LINEABOVE", 0, -1, 1, LINHA),
+            ],
+        },
+    )
+
+
+# ===== RECIBO (A4) =====
+
+def recibo(contexto):
+    """Flowables do recibo A4 do pedido. `contexto`: core.recibos.ReciboContexto."""
+    recursos = obter_recursos()
+    pedido = contexto.pedido
+
+    yield Paragraph(f"Recibo #{pedido.id}", recursos.titulo)
+    yield Spacer(1, 12)
+    yield Paragraph(f"Data: {formatar_data(pedido.criado_em, 'd-m-Y')}", recursos.texto)
+    yield Paragraph(f"Cliente: {escapar(pedido.cliente.nome)}", recursos.texto)
+    yield Paragraph(f"Lavandaria: {escapar(pedido.lavandaria.nome)}", recursos.texto)
+    yield Spacer(1, 12)
+
+    def linhas():
+        for item in pedido.itens.all():
+            artigo = obter_artigo(item.item_de_servico_id)
+            yield [
+                celula(artigo.nome if artigo else ""),
+                celula(item.servico.nome if item.servico else ""),
+                item.quantidade,
+                f"{item.preco_total} MZN",
+            ], None
+        yield ["Total:", "", "", f"{pedido.total} MZN"], "total"
+
+    larguras = [LARGURA_UTIL * f for f in (0.35, 0.3, 0.15, 0.2)]
+    yield from tabela_em_blocos(
+        ["ITEM", "SERVIÇO", "QUANTIDADE", "PREÇO"],
+        linhas(),
+        larguras,
+        estilo=[
+            ("FONTSIZE", (0, 0), (-1, -1), 9),
+            ("TOPPADDING", (0, 0), (-1, -1), 6),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ],
+        estilos_linha={
+            "total": [
+                ("SPAN", 0, 2), ("ALIGN", 0, 2, "RIGHT"), ("FONTNAME", 0, -1, FONTE_NEGRITO),
+                ("BACKGROUND", 0, -1, CINZENTO),
+            ],
+        },
+    )
+
+    cor = "#4CAF50" if pedido.pago else "#e74c3c"
+    estado = "Pago" if pedido.pago else "Não Pago"
+    yield Spacer(1, 16)
+    yield Paragraph(f'<font color="{cor}"><b>{estado}</b></font>', ParagraphStyle("estado", parent=recursos.titulo, fontSize=12))
+    yield Spacer(1, 30)
+    yield Paragraph("Obrigado por confiar em nossos serviços!", recursos.rodape)
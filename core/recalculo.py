@@ -0,0 +1,117 @@
+"""
+Recálculo agendado de pedidos.
+
+Gravar um ItemPedido ou um PagamentoPedido não recalcula o pedido na hora:
+o pedido é marcado como pendente e o recálculo (total e/ou pagamentos) corre
+uma única vez por pedido quando a transação faz commit. Fora de uma
+transação o recálculo é imediato, como antes.
+
+O que se valida dentro da transação (o saldo em Pedido.calcular_saldo_atual)
+lê total e soma_pagamentos, que no modo incremental já vão certos por deltas,
+ou os itens e pagamentos; o que fica para o commit é derivado: total_pago,
+estado de pagamento, pontos e desconto de fidelidade. Cada pedido é
+recalculado na sua própria transação, com o pedido bloqueado. Um erro num
+pedido não impede os outros nem chega a quem gravou (a gravação já fez
+commit): fica no log e o pedido fica com recalculo_pendente, que o próximo
+recálculo ou o `verificar_totais_pedidos --corrigir` limpam.
+"""
+import functools
+import logging
+import threading
+import weakref
+from collections import Counter
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_estado = threading.local()
+
+# Número de recálculos executados por pedido (pk). Útil em testes:
+#   reiniciar_contador(); ...; assert contador_recalculos[pedido.pk] == 1
+contador_recalculos = Counter()
+
+
+def reiniciar_contador():
+    contador_recalculos.clear()
+
+
+def _pendentes():
+    if not hasattr(_estado, "pendentes"):
+        _estado.pendentes = {}
+    return _estado.pendentes
+
+
+def _callback_registado():
+    # _estado.callback só guarda uma referência fraca ao callback registado,
+    # e é limpo quando ele corre. Se a transação (ou o savepoint) onde foi
+    # registado fez rollback, o Django larga o callback, a referência morre
+    # e os pendentes antigos deixam de valer.
+    callback = getattr(_estado, "callback", None)
+    return callback is not None and callback() is not None
+
+
+def agendar_recalculo(pedido, total=False):
+    """
+    Marca o pedido para recálculo no commit da transação actual.
+
+    total=True recalcula também o total a partir dos itens
+    (Pedido.atualizar_total); caso contrário só os pagamentos
+    (Pedido.recalcular_pagamentos).
+    """
+    conexao = transaction.get_connection()
+    if not conexao.in_atomic_block:
+        _executar(pedido, total)
+        return
+
+    pendentes = _pendentes()
+    if not _callback_registado():
+        pendentes.clear()
+        callback = functools.partial(_executar_pendentes)
+        _estado.callback = weakref.ref(callback)
+        transaction.on_commit(callback)
+
+    if pedido.pk in pendentes:
+        instancia, total_anterior = pendentes[pedido.pk]
+        pendentes[pedido.pk] = (instancia, total_anterior or total)
+    else:
+        pendentes[pedido.pk] = (pedido, total)
+
+
+def _executar_pendentes():
+    _estado.callback = None
+    pendentes = _pendentes()
+    lote = list(pendentes.values())
+    pendentes.clear()
+    for pedido, total in lote:
+        try:
+            _executar(pedido, total)
+        except Exception:
+            logger.exception("Recálculo do pedido %s falhou", pedido.pk)
+            _marcar_pendente(pedido)
+
+
+def _marcar_pendente(pedido):
+    try:
+        type(pedido).objects.filter(pk=pedido.pk).update(recalculo_pendente=True)
+    except Exception:
+        logger.exception("Não foi possível marcar o pedido %s para recálculo", pedido.pk)
+
+
+def _executar(pedido, total):
+    with transaction.atomic():
+        # o mesmo lock de registrar_pagamento: dois recálculos do mesmo pedido
+        # (ou um recálculo e um pagamento) não se cruzam
+        if not list(type(pedido).objects.select_for_update().filter(pk=pedido.pk).values_list("pk", flat=True)):
+            # Pedido apagado na mesma transação
+            return
+        pedido.refresh_from_db()
+
+        if total:
+            pedido.atualizar_total()
+        else:
+            pedido.recalcular_pagamentos()
+        if pedido.recalculo_pendente:
+            pedido.recalculo_pendente = False
+            pedido.save(update_fields=["recalculo_pendente"])
+    contador_recalculos[pedido.pk] += 1
@@ -0,0 +1,122 @@
+"""
+Desenho da imagem do recibo térmico (Pillow).
+
+Não depende dos modelos: é importado pelos processos que desenham
+recibos em lote (ver core.recibos.recibos_png_em_lote).
+"""
+import io
+import os
+import threading
+
+from django.conf import settings
+from django.utils.functional import cached_property
+from PIL import Image, ImageDraw, ImageFont
+
+from . import escpos
+
+# Geometria da imagem do recibo (px)
+LARGURA_RECIBO = 400
+ESPACO_LOGO = 100
+ESPACAMENTO_LINHAS = 4
+
+
+class AtivosRecibo:
+    """
+    Fonte, logótipo já redimensionado e métricas de linha do recibo.
+    Carregados uma vez por processo (ver obter_ativos).
+    """
+
+    def __init__(self):
+        try:
+            self.fonte = ImageFont.load_default(size=18)
+        except IOError:
+            self.fonte = ImageFont.load_default(size=21)
+
+        self.logo = None
+        try:
+            logo_path = os.path.join(settings.BASE_DIR, "static/img/local/logo.jpg")
+            with Image.open(logo_path) as logo:
+                self.logo = logo.convert("RGBA").resize((160, 100))
+        except Exception:
+            pass
+
+        # O mesmo passo entre linhas que o ImageDraw.multiline_text usa
+        # (altura de "A" + espaçamento), e a descida da última linha.
+        medidor = ImageDraw.Draw(Image.new("1", (1, 1)))
+        self.passo_linha = medidor.textbbox((0, 0), "A", font=self.fonte)[3] + ESPACAMENTO_LINHAS
+        self.descida = self.fonte.getmetrics()[1]
+
+    @cached_property
+    def logo_escpos(self):
+        # logótipo em raster de 1 bit para ESC/POS, convertido só uma vez
+        return escpos.raster_logo(self.logo) if self.logo is not None else b""
+
+    @cached_property
+    def logo_1bit(self):
+        # logótipo sobre fundo branco, já com dithering, para imagens de 1 bit
+        if self.logo is None:
+            return None
+        fundo = Image.new("RGBA", self.logo.size, "white")
+        return Image.alpha_composite(fundo, self.logo).convert("L").convert("1")
+
+    def altura_texto(self, texto):
+        return (texto.count("\n") + 1) * self.passo_linha + self.descida
+
+
+_ativos = None
+_ativos_lock = threading.Lock()
+
+
+def obter_ativos():
+    global _ativos
+    if _ativos is None:
+        with _ativos_lock:
+            if _ativos is None:
+                _ativos = AtivosRecibo()
+    return _ativos
+
+
+def _modo_padrao():
+    # "1": preto e branco, como a impressora térmica; "RGB": imagem a cores
+    return getattr(settings, "RECIBO_MODO_IMAGEM", "1")
+
+
+def imagem_recibo(recibo_texto, modo=None):
+    """Texto do recibo -> imagem Pillow (400px de largura, logo no topo)."""
+    modo = modo or _modo_padrao()
+    ativos = obter_ativos()
+    altura = max(ativos.altura_texto(recibo_texto) + ESPACO_LOGO, 200)
+
+    img = Image.new(modo, (LARGURA_RECIBO, altura), "white")
+    draw = ImageDraw.Draw(img)
+
+    if modo == "1":
+        logo = ativos.logo_1bit
+        if logo is not None:
+            img.paste(logo, ((LARGURA_RECIBO - logo.width) // 2, 10))
+    elif ativos.logo is not None:
+        x_logo = (LARGURA_RECIBO - ativos.logo.width) // 2
+        img.paste(ativos.logo, (x_logo, 10), ativos.logo)
+
+    draw.multiline_text(
+        (10, ESPACO_LOGO),
+        recibo_texto,
+        fill="black",
+        font=ativos.fonte,
+        spacing=ESPACAMENTO_LINHAS
+    )
+    return img
+
+
+def desenhar_recibo(recibo_texto, modo=None):
+    """Texto do recibo -> bytes PNG (de 1 bit por omissão)."""
+    buffer = io.BytesIO()
+    imagem_recibo(recibo_texto, modo).save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def desenhar_recibo_pbm(recibo_texto):
+    """Texto do recibo -> PBM binário (P4): bitmap bruto de 1 bit, sem compressão."""
+    buffer = io.BytesIO()
+    imagem_recibo(recibo_texto, "1").save(buffer, format="PPM")
+    return buffer.getvalue()
@@ -0,0 +1,332 @@
+"""
+Recibo do pedido: contexto, texto térmico, imagem (PNG/PBM de 1 bit),
+ESC/POS e PDF.
+
+As reimpressões do mesmo pedido são muito frequentes no balcão, por isso a
+imagem fica numa cache em memória (por processo, limitada em bytes) com uma
+chave que muda sempre que muda algo impresso no recibo: versão do pedido,
+dados/pontos do cliente, pedidos em aberto do cliente e versão do catálogo.
+A chave custa uma consulta; com a chave na cache não há mais consultas nem
+desenho com o Pillow.
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, DecimalField, F, OuterRef, Prefetch, Subquery, Sum, Value, Window
+from django.db.models.functions import Coalesce
+from django.template.loader import render_to_string
+
+from . import escpos, pdf
+from .catalogo import versao_catalogo
+from .models import ItemPedido, MovimentacaoPontos, PagamentoPedido, Pedido
+from .recibo_imagem import desenhar_recibo, desenhar_recibo_pbm, obter_ativos
+
+
+class CacheRecibos:
+    """LRU de imagens de recibo limitada pelo total de bytes guardados."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._itens = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            valor = self._itens.get(chave)
+            if valor is not None:
+                self._itens.move_to_end(chave)
+            return valor
+
+    def guardar(self, chave, valor):
+        if len(valor) > self.max_bytes:
+            return
+        with self._lock:
+            antigo = self._itens.pop(chave, None)
+            if antigo is not None:
+                self._bytes -= len(antigo)
+            self._itens[chave] = valor
+            self._bytes += len(valor)
+            while self._bytes > self.max_bytes:
+                _, removido = self._itens.popitem(last=False)
+                self._bytes -= len(removido)
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+            self._bytes = 0
+
+
+cache_recibos = CacheRecibos(getattr(settings, "RECIBO_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+
+def versao_recibo(pedido_id):
+    """
+    (chave, atualizado_em) da versão actual do recibo do pedido, ou None se
+    o pedido não existir. Uma consulta: linha do pedido + cliente/lavandaria/
+    vendedor + resumo dos pedidos em aberto do cliente (que também aparecem
+    no recibo).
+    """
+    abertos = (
+        Pedido.objects
+        .filter(cliente=OuterRef("cliente"))
+        .exclude(status_pagamento="pago")
+        .order_by()
+        .values("cliente")
+    )
+    linha = (
+        Pedido.objects
+        .filter(pk=pedido_id)
+        .annotate(
+            abertos_n=Subquery(abertos.annotate(n=Count("pk")).values("n")[:1]),
+            abertos_ids=Subquery(abertos.annotate(s=Sum("pk")).values("s")[:1]),
+            abertos_versoes=Subquery(abertos.annotate(v=Sum("versao")).values("v")[:1]),
+        )
+        .values_list(
+            "atualizado_em", "versao", "cliente_id", "cliente__nome", "cliente__telefone", "cliente__pontos",
+            "lavandaria__endereco", "lavandaria__telefone", "funcionario__user__username",
+            "abertos_n", "abertos_ids", "abertos_versoes",
+        )
+        .first()
+    )
+    if linha is None:
+        return None
+    dados = repr((pedido_id, versao_catalogo(), linha)).encode()
+    return hashlib.sha1(dados).hexdigest(), linha[0]
+
+
+def chave_recibo(pedido_id):
+    """Chave da versão actual do recibo do pedido (None se não existir)."""
+    versao = versao_recibo(pedido_id)
+    return versao[0] if versao else None
+
+
+# Consultas feitas por ReciboContexto, independentemente do número de itens,
+# pagamentos ou pedidos em aberto (verificado pelo comando medir_recibos)
+CONSULTAS_RECIBO = 5
+
+
+class ReciboContexto:
+    """
+    Tudo o que o recibo mostra, lido de uma vez com um número fixo de
+    consultas (CONSULTAS_RECIBO), para as saídas PNG/PBM, ESC/POS e PDF:
+
+      1. pedido + cliente + lavandaria + vendedor (select_related)
+      2-4. itens (com artigo), pagamentos e movimentações de pontos do
+           pedido (prefetch_related), lidos já pela ordem do recibo
+      5. últimos 3 pedidos em aberto do cliente, com o total em dívida
+         calculado na mesma consulta (soma em janela sobre todos)
+    """
+
+    def __init__(self, pedido_id):
+        self.pedido = (
+            Pedido.objects
+            .select_related("cliente", "lavandaria", "funcionario__user")
+            .prefetch_related(
+                Prefetch("itens", queryset=ItemPedido.objects.select_related("item_de_servico", "servico").order_by("pk")),
+                Prefetch("pagamentos", queryset=PagamentoPedido.objects.order_by("-pago_em", "-id")),
+                Prefetch(
+                    "movimentacaopontos_set",
+                    queryset=MovimentacaoPontos.objects.filter(tipo__in=["uso", "ganho"]).order_by("pk"),
+                    to_attr="movimentacoes_recibo",
+                ),
+            )
+            .get(pk=pedido_id)
+        )
+        pedido = self.pedido
+
+        pagamentos = list(pedido.pagamentos.all())
+        self.valor_pago = sum((p.valor for p in pagamentos), Decimal("0.00"))
+        self.ultimo_metodo_pagamento = pagamentos[0].metodo_pagamento if pagamentos else None
+
+        movimentacoes = {}
+        for mov in pedido.movimentacoes_recibo:
+            movimentacoes.setdefault(mov.tipo, mov)
+
+        # O desconto já está no campo 'desconto' do pedido
+        self.desconto_aplicado = pedido.desconto or Decimal("0.00")
+        # Se houve consumo de pontos neste pedido, é desconto de fidelidade
+        if "uso" in movimentacoes and self.desconto_aplicado > 0:
+            self.desconto_fidelidade = self.desconto_aplicado
+        else:
+            self.desconto_fidelidade = Decimal("0.00")
+        self.pontos_ganhos = movimentacoes["ganho"].pontos if "ganho" in movimentacoes else 0
+
+        # total_final já é total - desconto (propriedade do modelo Pedido)
+        self.saldo = max(pedido.total_final - self.valor_pago, Decimal("0.00"))
+
+        self.pedidos_nao_pagos = self._pedidos_nao_pagos()
+        self.total_em_divida = (
+            self.pedidos_nao_pagos[0].total_em_divida if self.pedidos_nao_pagos else Decimal("0.00")
+        )
+
+    def _pedidos_nao_pagos(self):
+        # Subquery: soma pagamentos por pedido
+        pagos_subq = (
+            PagamentoPedido.objects
+            .filter(pedido=OuterRef("pk"))
+            .values("pedido")
+            .annotate(s=Sum("valor"))
+            .values("s")[:1]
+        )
+        decimal = DecimalField(max_digits=12, decimal_places=2)
+        saldo = Coalesce(
+            F("total") - Coalesce(Subquery(pagos_subq), Value(Decimal("0.00")), output_field=decimal),
+            Value(Decimal("0.00")),
+            output_field=decimal,
+        )
+        # A janela é calculada sobre todos os pedidos em aberto antes do
+        # LIMIT 3, por isso cada linha traz também o total em dívida
+        return list(
+            Pedido.objects
+            .filter(cliente_id=self.pedido.cliente_id)
+            .exclude(status_pagamento="pago")
+            .annotate(saldo_calc=saldo, total_em_divida=Window(Sum(saldo), output_field=decimal))
+            .only("pk", "criado_em")
+            .order_by("-criado_em")[:3]
+        )
+
+    def dados(self):
+        """Contexto para os modelos do recibo."""
+        pedido = self.pedido
+        pontos_totais = pedido.cliente.pontos
+        ultimo_metodo = self.ultimo_metodo_pagamento
+        return {
+            "pedido": pedido,
+            "pedidos_nao_pagos": self.pedidos_nao_pagos,
+            "total_em_divida": self.total_em_divida,
+            "valor_pago": self.valor_pago,
+            "saldo": self.saldo,
+            "ultimo_metodo_pagamento": ultimo_metodo,
+            "ultimo_metodo_pagamento_label": ultimo_metodo.replace("_", " ").title() if ultimo_metodo else None,
+
+            # 🎁 pontos
+            "pontos_ganhos": self.pontos_ganhos,
+            "pontos_totais": pontos_totais,
+            "equivalente_mzn": Decimal(pontos_totais) * Decimal("0.10"),
+
+            # 🎁 desconto
+            "desconto_aplicado": self.desconto_aplicado,
+            "desconto_fidelidade": self.desconto_fidelidade,
+
+            # 🎁 total com desconto (já incluso no pedido.total_final)
+            "total_final": pedido.total_final,
+        }
+
+
+def texto_recibo(pedido_id):
+    return render_to_string("core/recibo_termico.txt", ReciboContexto(pedido_id).dados())
+
+
+def _recibo_em_cache(pedido_id, formato, gerar, chave=None):
+    # a chave é lida antes do conteúdo: o que fica na cache nunca é mais
+    # antigo do que a versão da chave
+    chave = chave or chave_recibo(pedido_id)
+    if chave is None:
+        raise Pedido.DoesNotExist(f"Pedido {pedido_id} não existe.")
+
+    chave = f"{chave}:{formato}"
+    dados = cache_recibos.obter(chave)
+    if dados is None:
+        dados = gerar(pedido_id)
+        cache_recibos.guardar(chave, dados)
+    return dados
+
+
+def recibo_png(pedido_id, chave=None):
+    """
+    PNG do recibo do pedido, da cache quando o pedido não mudou desde a
+    última impressão. `chave`: a de versao_recibo(), se já foi lida.
+    Levanta Pedido.DoesNotExist.
+    """
+    return _recibo_em_cache(pedido_id, "png", lambda pid: desenhar_recibo(texto_recibo(pid)), chave)
+
+
+def recibo_pbm(pedido_id, chave=None):
+    """Recibo do pedido como bitmap PBM de 1 bit (mesma cache e chave que o PNG)."""
+    return _recibo_em_cache(pedido_id, "pbm", lambda pid: desenhar_recibo_pbm(texto_recibo(pid)), chave)
+
+
+def recibo_escpos(pedido_id):
+    """Recibo do pedido em bytes ESC/POS (mesma cache e chave que o PNG)."""
+    return _recibo_em_cache(
+        pedido_id, "escpos", lambda pid: escpos.gerar_escpos(texto_recibo(pid), obter_ativos().logo_escpos)
+    )
+
+
+def recibo_pdf(pedido_id, chave=None):
+    """Recibo A4 do pedido em PDF (reportlab, ver core.pdf; mesma cache e chave)."""
+    return _recibo_em_cache(
+        pedido_id, "pdf",
+        lambda pid: pdf.pdf_em_bytes(pdf.recibo(ReciboContexto(pid)), titulo=f"Recibo #{pid}"),
+        chave,
+    )
+
+
+# Processos que desenham recibos em lote. Criados com "spawn" (não herdam
+# a ligação à base de dados nem locks de outras threads do worker web) e
+# reutilizados: cada um carrega a fonte e o logótipo uma vez, no arranque.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class _ExecutorLocal:
+    """Desenha no próprio processo, com a mesma interface do pool (RECIBO_PROCESSOS = 0)."""
+
+    def submit(self, funcao, *args):
+        futuro = Future()
+        try:
+            futuro.set_result(funcao(*args))
+        except Exception as e:
+            futuro.set_exception(e)
+        return futuro
+
+
+def _pool_recibos():
+    global _pool
+    processos = getattr(settings, "RECIBO_PROCESSOS", None)
+    if processos == 0:
+        return _ExecutorLocal()
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                processos = processos or min(4, os.cpu_count() or 1)
+                _pool = ProcessPoolExecutor(
+                    max_workers=processos,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=obter_ativos,
+                )
+    return _pool
+
+
+def recibos_png_em_lote(pedido_ids, lote=8):
+    """
+    Gera (pedido_id, png) para vários pedidos, pela ordem dada, à medida que
+    ficam prontos. Contexto/texto são lidos aqui (CONSULTAS_RECIBO por
+    pedido, ou 1 se estiver na cache); o desenho corre no pool de processos.
+    Só `lote` recibos estão em memória de cada vez.
+    """
+    pedido_ids = list(pedido_ids)
+    for i in range(0, len(pedido_ids), lote):
+        pendentes = []
+        for pedido_id in pedido_ids[i:i + lote]:
+            chave = chave_recibo(pedido_id)
+            if chave is None:
+                continue
+            chave = f"{chave}:png"
+            png = cache_recibos.obter(chave)
+            if png is None:
+                png = _pool_recibos().submit(desenhar_recibo, texto_recibo(pedido_id))
+            pendentes.append((pedido_id, chave, png))
+
+        for pedido_id, chave, png in pendentes:
+            if not isinstance(png, bytes):
+                png = png.result()
+                cache_recibos.guardar(chave, png)
+            yield pedido_id, png
@@ -0,0 +1,347 @@
+"""
+Dados dos relatórios (o desenho dos PDFs está em core/pdf.py).
+
+O relatório de vendas lê as datas (Min/Max), as quantidades por pedido
+(anotação) e o total (um aggregate) na base; os itens vêm num Prefetch só
+com as colunas usadas e o nome do artigo do catálogo em memória.
+
+O relatório financeiro é montado com um número fixo de consultas, seja qual
+for o período ou o número de pedidos/pagamentos:
+
+  1. totais dos pedidos com pagamentos no período (faturado, em aberto)
+  2. pedidos em aberto, com o pago histórico e o pago no período anotados
+  3. resumos por método, dia, lavandaria e caixa, e o total recebido: dos
+     totais diários (VendaDiaria) quando o período são dias inteiros e não
+     há seleção de pedidos; senão num só GROUP BY GROUPING SETS no
+     PostgreSQL (5 consultas noutras bases)
+  4. movimentos (pagamentos), lidos aos poucos ao desenhar o PDF
+
+Os períodos já fechados são montados a partir de partes diárias guardadas
+(ver core/relatorios_fechados.py).
+"""
+from collections import defaultdict, namedtuple
+from datetime import time
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Count, DecimalField, F, Max, Min, OuterRef, Prefetch, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
+
+from .models import ItemPedido, PagamentoPedido, Pedido, VendaDiaria
+
+DECIMAL = DecimalField(max_digits=12, decimal_places=2)
+DECIMAL_0 = Value(Decimal("0.00"), output_field=DECIMAL)
+
+# Saldos até este valor são arredondamentos, não dívida
+TOLERANCIA_SALDO = Decimal("0.01")
+
+# (chave no contexto, campo do resumo, ordenação)
+RESUMOS = (
+    ("resumo_por_metodo", "metodo_pagamento", "-total"),
+    ("resumo_por_dia", "pago_em__date", "pago_em__date"),
+    ("resumo_por_lavandaria", "pedido__lavandaria__nome", "-total"),
+    ("resumo_por_caixa", "criado_por__user__username", "-total"),
+)
+
+# Uma linha da tabela de movimentos (PDF, CSV e XLSX)
+Movimento = namedtuple("Movimento", [
+    "id", "pedido_id", "cliente", "pedido_criado_em", "pago_em", "metodo_pagamento", "caixa", "lavandaria", "valor",
+])
+CAMPOS_MOVIMENTO = (
+    "id", "pedido_id", "pedido__cliente__nome", "pedido__criado_em", "pago_em",
+    "metodo_pagamento", "criado_por__user__username", "pedido__lavandaria__nome", "valor",
+)
+
+
+# ===== RELATÓRIO DE VENDAS =====
+
+def periodo_pedidos(pedidos):
+    """(primeira, última) data de criação dos pedidos, numa consulta; (None, None) sem pedidos."""
+    datas = pedidos.order_by().aggregate(inicio=Min("criado_em"), fim=Max("criado_em"))
+    return datas["inicio"], datas["fim"]
+
+
+def pedidos_vendas(pedidos):
+    """
+    Pedidos com cliente, quantidade_itens (soma das quantidades, em SQL) e
+    os itens (só artigo, quantidade e descrição), pela ordem de `pedidos`.
+    """
+    return (
+        pedidos
+        .select_related("cliente")
+        .annotate(quantidade_itens=Coalesce(Sum("itens__quantidade"), 0))
+        .prefetch_related(Prefetch(
+            "itens",
+            queryset=ItemPedido.objects.only("pedido", "item_de_servico", "quantidade", "descricao").order_by("pk"),
+        ))
+    )
+
+
+def quantidade_total(pedidos):
+    """Soma das quantidades dos itens de todos os pedidos (um aggregate)."""
+    return ItemPedido.objects.filter(
+        pedido__in=pedidos.order_by().values("pk"),
+    ).aggregate(q=Coalesce(Sum("quantidade"), 0))["q"]
+
+
+# ===== RELATÓRIO FINANCEIRO =====
+
+def pagamentos_periodo(lavandaria, start_dt, end_dt, pedidos=None):
+    """Pagamentos da lavandaria no período (e dos pedidos dados, se houver)."""
+    pagamentos = PagamentoPedido.objects.filter(
+        pago_em__gte=start_dt, pago_em__lte=end_dt, pedido__lavandaria=lavandaria,
+    )
+    if pedidos is not None:
+        pagamentos = pagamentos.filter(pedido__in=pedidos.filter(lavandaria=lavandaria))
+    return pagamentos
+
+
+def movimentos(pagamentos):
+    """Pagamentos por ordem de pagamento."""
+    return pagamentos.order_by("pago_em", "id")
+
+
+def ler_movimentos(pagamentos):
+    """
+    Um Movimento por pagamento de movimentos(), lidos em blocos com
+    values_list() (sem criar modelos).
+    """
+    for valores in pagamentos.values_list(*CAMPOS_MOVIMENTO).iterator(chunk_size=2000):
+        yield Movimento(*valores)
+
+
+def _soma_por_pedido(pagamentos):
+    return Coalesce(
+        Subquery(
+            pagamentos.filter(pedido=OuterRef("pk")).order_by().values("pedido").annotate(s=Sum("valor")).values("s")
+        ),
+        DECIMAL_0,
+    )
+
+
+def pedidos_com_saldos(pagamentos, lavandaria):
+    """
+    Pedidos com pagamentos no período, anotados com total_final_calc (o
+    mesmo que Pedido.total_final), total_pago_historico, pago_no_periodo
+    e saldo_calc, tudo em SQL.
+    """
+    total_final = Greatest(
+        Coalesce(F("total"), DECIMAL_0) - Coalesce(F("desconto"), DECIMAL_0) - Coalesce(F("desconto_cabides"), DECIMAL_0),
+        DECIMAL_0,
+        output_field=DECIMAL,
+    )
+    return (
+        Pedido.objects
+        .filter(pk__in=pagamentos.values("pedido_id"), lavandaria=lavandaria)
+        .annotate(
+            total_final_calc=total_final,
+            total_pago_historico=_soma_por_pedido(PagamentoPedido.objects.all()),
+            pago_no_periodo=_soma_por_pedido(pagamentos),
+        )
+        .annotate(saldo_calc=F("total_final_calc") - F("total_pago_historico"))
+    )
+
+
+def _resumos_grouping_sets(pagamentos):
+    """
+    Os quatro resumos e o total recebido numa consulta (PostgreSQL).
+    Devolve ({chave: [linhas]}, total_recebido).
+    """
+    linhas = pagamentos.order_by().annotate(
+        r_metodo=F("metodo_pagamento"),
+        r_dia=TruncDate("pago_em"),
+        r_lavandaria=F("pedido__lavandaria__nome"),
+        r_caixa=F("criado_por__user__username"),
+        r_valor=F("valor"),
+    ).values("r_metodo", "r_dia", "r_lavandaria", "r_caixa", "r_valor")
+    sql, params = linhas.query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT metodo, dia, lavandaria, caixa,
+                   GROUPING(metodo), GROUPING(dia), GROUPING(lavandaria), GROUPING(caixa),
+                   COUNT(*), COALESCE(SUM(valor), 0)
+            FROM ({sql}) AS pagamentos (metodo, dia, lavandaria, caixa, valor)
+            GROUP BY GROUPING SETS ((metodo), (dia), (lavandaria), (caixa), ())
+            """,
+            params,
+        )
+        resultado = cursor.fetchall()
+
+    resumos = {chave: [] for chave, _, _ in RESUMOS}
+    total_recebido = Decimal("0.00")
+    for *valores, g_metodo, g_dia, g_lavandaria, g_caixa, qtd, total in resultado:
+        agrupados = (g_metodo, g_dia, g_lavandaria, g_caixa)
+        if all(agrupados):
+            total_recebido = total
+            continue
+        # o único campo não agregado (GROUPING = 0) diz a que resumo pertence
+        i = agrupados.index(0)
+        chave, campo, _ = RESUMOS[i]
+        resumos[chave].append({campo: valores[i], "qtd": qtd, "total": total})
+
+    _ordenar_resumos(resumos)
+    return resumos, total_recebido
+
+
+def _ordenar_resumos(resumos):
+    """A mesma ordenação dos order_by() de _resumos_separados."""
+    for chave, campo, ordem in RESUMOS:
+        resumos[chave].sort(
+            key=lambda row: (row[campo] is None, row[campo]) if ordem == campo else -row["total"]
+        )
+
+
+def _somar_resumos(linhas):
+    """
+    Os resumos somados em Python a partir de (valores, qtd, total), com
+    valores = {campo do resumo: valor}.
+    """
+    somas = {chave: defaultdict(lambda: [0, Decimal("0.00")]) for chave, _, _ in RESUMOS}
+    total_recebido = Decimal("0.00")
+    for valores, qtd, total in linhas:
+        if not qtd:
+            continue
+        total_recebido += total
+        for chave, campo, _ in RESUMOS:
+            soma = somas[chave][valores[campo]]
+            soma[0] += qtd
+            soma[1] += total
+
+    resumos = {
+        chave: [{campo: valor, "qtd": qtd, "total": total} for valor, (qtd, total) in somas[chave].items()]
+        for chave, campo, _ in RESUMOS
+    }
+    _ordenar_resumos(resumos)
+    return resumos, total_recebido
+
+
+def _resumos_vendas_diarias(lavandaria, dia_inicio, dia_fim):
+    """
+    Os mesmos resumos a partir de VendaDiaria (uma consulta, com uma linha
+    por dia, método e caixa em vez de uma por pagamento).
+    """
+    linhas = (
+        VendaDiaria.objects
+        .filter(lavandaria=lavandaria, dia__gte=dia_inicio, dia__lte=dia_fim)
+        .exclude(metodo_pagamento="")
+        .values_list("dia", "metodo_pagamento", "funcionario__user__username")
+        .annotate(qtd=Sum("pagamentos"), total=Sum("valor_recebido"))
+        .order_by()
+    )
+    return _somar_resumos(
+        (
+            {
+                "metodo_pagamento": metodo, "pago_em__date": dia,
+                "pedido__lavandaria__nome": lavandaria.nome, "criado_por__user__username": caixa,
+            },
+            qtd, total,
+        )
+        for dia, metodo, caixa, qtd, total in linhas
+    )
+
+
+def resumos_movimentos(movimentos):
+    """Os mesmos resumos a partir de Movimentos já lidos (partes de dias fechados)."""
+    return _somar_resumos(
+        (
+            {
+                "metodo_pagamento": m.metodo_pagamento, "pago_em__date": timezone.localdate(m.pago_em),
+                "pedido__lavandaria__nome": m.lavandaria, "criado_por__user__username": m.caixa,
+            },
+            1, m.valor,
+        )
+        for m in movimentos
+    )
+
+
+def dias_completos(start_dt, end_dt):
+    """
+    (primeiro dia, último dia) se o período vai das 00:00:00 às 23:59:59 (hora
+    local), como o filtro de datas do admin; None se não são dias inteiros.
+    """
+    inicio, fim = timezone.localtime(start_dt), timezone.localtime(end_dt)
+    if inicio.time() != time.min or fim.time().replace(microsecond=0) != time(23, 59, 59):
+        return None
+    return inicio.date(), fim.date()
+
+
+def _resumos_separados(pagamentos):
+    """Os mesmos resumos com uma consulta cada (bases sem GROUPING SETS)."""
+    resumos = {
+        chave: list(
+            pagamentos.values(campo)
+            .annotate(qtd=Count("id"), total=Coalesce(Sum("valor"), DECIMAL_0))
+            .order_by(ordem)
+        )
+        for chave, campo, ordem in RESUMOS
+    }
+    total_recebido = pagamentos.aggregate(t=Coalesce(Sum("valor"), DECIMAL_0))["t"]
+    return resumos, total_recebido
+
+
+def resumos_pagamentos(pagamentos):
+    if connection.vendor == "postgresql":
+        return _resumos_grouping_sets(pagamentos)
+    return _resumos_separados(pagamentos)
+
+
+def dados_relatorio_financeiro(lavandaria, start_dt, end_dt, pedidos=None):
+    """
+    Contexto do relatório financeiro (caixa) da lavandaria no período.
+    `pedidos`: limita aos pagamentos destes pedidos (seleção no admin).
+    """
+    dias = dias_completos(start_dt, end_dt)
+    if dias is not None:
+        # até ao fim do último segundo, como os totais diários
+        end_dt = end_dt.replace(microsecond=999999)
+
+    pagamentos = pagamentos_periodo(lavandaria, start_dt, end_dt, pedidos)
+
+    if dias is not None and pedidos is None:
+        resumos, total_recebido = _resumos_vendas_diarias(lavandaria, *dias)
+    else:
+        resumos, total_recebido = resumos_pagamentos(pagamentos)
+
+    return {
+        "lavandaria": lavandaria,
+        **dados_pedidos(pagamentos, lavandaria),
+        "total_recebido": total_recebido,
+        **resumos,
+        # movimentos: lidos em blocos por core.pdf.relatorio_financeiro
+        "pagamentos": ler_movimentos(movimentos(pagamentos)),
+        "metodos_pagamento_dict": dict(PagamentoPedido.METODO_PAGAMENTO_CHOICES),
+    }
+
+
+def dados_pedidos(pagamentos, lavandaria):
+    """
+    Total faturado, saldo em aberto e pedidos em aberto dos pedidos com
+    `pagamentos`, com os valores de agora (pagos depois do período incluídos).
+    """
+    qs_pedidos = pedidos_com_saldos(pagamentos, lavandaria)
+
+    totais = qs_pedidos.aggregate(
+        total_faturado=Coalesce(Sum("total_final_calc"), DECIMAL_0),
+        saldo_total=Coalesce(Sum("saldo_calc", filter=Q(saldo_calc__gt=TOLERANCIA_SALDO)), DECIMAL_0),
+    )
+
+    pedidos_em_aberto = [
+        {
+            "pedido": p,
+            "total_final": p.total_final_calc,
+            "total_pago_historico": p.total_pago_historico,
+            "pago_no_periodo": p.pago_no_periodo,
+            "saldo": p.saldo_calc,
+        }
+        for p in qs_pedidos.filter(saldo_calc__gt=TOLERANCIA_SALDO).select_related("cliente").order_by("pk")
+    ]
+
+    return {
+        "total_faturado": totais["total_faturado"],
+        "saldo_total": totais["saldo_total"],
+        "pedidos_em_aberto": pedidos_em_aberto,
+        "pedidos": qs_pedidos,
+    }
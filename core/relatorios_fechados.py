@@ -0,0 +1,255 @@
+"""
+Relatórios financeiros de períodos fechados (dias antes de hoje, no fuso
+local), guardados já gerados.
+
+Cada dia fechado de uma lavandaria tem uma parte (RelatorioDiario) com os
+movimentos do dia, lida da base uma vez e guardada com a versão do dia
+(VersaoDados "caixa:<lavandaria>:<dia>"). Só quem altera um pagamento de
+um dia já fechado (data, valor, método ou caixa, ou o pedido mudar de
+lavandaria) incrementa essa versão; os pagamentos de hoje não custam nada
+a mais. Um mês ou um trimestre é montado a partir das partes dos seus
+dias, e só os dias com versão nova voltam a ser lidos dos pagamentos.
+
+O ficheiro gerado (RelatorioFechado) fica guardado com uma chave que junta
+as versões dos dias, a seleção de pedidos, a versão (Pedido.versao) dos
+pedidos com pagamentos no período, porque o total, o pago histórico e o
+saldo dos pedidos em aberto são sempre os de agora, e os nomes atuais dos
+clientes e caixas desses pagamentos. Enquanto a chave não muda, o relatório
+é devolvido sem ler os movimentos nem voltar a desenhar.
+
+As partes guardam o id do cliente e do caixa de cada movimento; os nomes
+são os lidos para a chave, pelo que mudar o nome de um cliente não obriga
+a remontar as partes. A data do pedido fica como estava quando a parte do
+dia foi montada.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import PagamentoPedido, Pedido, RelatorioDiario, RelatorioFechado, VersaoDados
+from .relatorios import (
+    CAMPOS_MOVIMENTO, Movimento, dados_pedidos, dias_completos, movimentos, pagamentos_periodo, resumos_movimentos,
+)
+from .vendas_diarias import dia_local, intervalo_dias
+
+# Incrementar quando o desenho do PDF/XLSX muda (os ficheiros guardados deixam de servir)
+VERSAO_DESENHO = 1
+
+# Cada linha de RelatorioDiario.movimentos: um Movimento, o cliente e o caixa (Funcionario)
+CAMPOS_PARTE = CAMPOS_MOVIMENTO + ("pedido__cliente_id", "criado_por_id")
+
+
+def chave_versao(lavandaria_id, dia):
+    return f"caixa:{lavandaria_id}:{dia.isoformat()}"
+
+
+def periodo_fechado(start_dt, end_dt):
+    """
+    (primeiro dia, último dia) se o período são dias inteiros já fechados;
+    None se não. Um dia só fecha RELATORIO_FECHO_MINUTOS depois da
+    meia-noite, para os pagamentos gravados mesmo antes terem chegado à base.
+    """
+    dias = dias_completos(start_dt, end_dt)
+    minutos = getattr(settings, "RELATORIO_FECHO_MINUTOS", 10)
+    if dias is None or dias[1] >= timezone.localdate(timezone.now() - timedelta(minutes=minutos)):
+        return None
+    return dias
+
+
+# ===== INVALIDAÇÃO =====
+
+def invalidar(lavandaria_id, momentos):
+    """Pagamentos da lavandaria feitos em `momentos` (pago_em) mudaram: nova versão dos dias já passados."""
+    hoje = timezone.localdate()
+    for dia in sorted({dia_local(momento) for momento in momentos if momento is not None}):
+        if dia < hoje:
+            VersaoDados.incrementar(chave_versao(lavandaria_id, dia))
+
+
+# ===== PARTES DIÁRIAS =====
+
+def versoes_dias(lavandaria, dia_inicio, dia_fim):
+    """{dia: versão} dos dias do período (uma consulta)."""
+    dias = [dia_inicio + timedelta(days=i) for i in range((dia_fim - dia_inicio).days + 1)]
+    versoes = VersaoDados.atuais([chave_versao(lavandaria.pk, dia) for dia in dias])
+    return {dia: versoes[chave_versao(lavandaria.pk, dia)] for dia in dias}
+
+
+def _data(texto):
+    return datetime.fromisoformat(texto) if texto else None
+
+
+def _movimento(linha):
+    """(Movimento, cliente_id, caixa_id) a partir de uma linha guardada em RelatorioDiario.movimentos (JSON)."""
+    *campos, cliente_id, caixa_id = linha
+    m = Movimento(*campos)
+    m = m._replace(pedido_criado_em=_data(m.pedido_criado_em), pago_em=_data(m.pago_em), valor=Decimal(m.valor))
+    return m, cliente_id, caixa_id
+
+
+def _intervalos(dias):
+    """Dias seguidos juntos num só intervalo [início, fim[ (menos condições na consulta)."""
+    blocos = []
+    for dia in sorted(dias):
+        if blocos and blocos[-1][1] + timedelta(days=1) == dia:
+            blocos[-1][1] = dia
+        else:
+            blocos.append([dia, dia])
+    return [intervalo_dias(inicio, fim) for inicio, fim in blocos]
+
+
+def _montar(lavandaria, versoes):
+    """Lê os movimentos dos dias em `versoes` ({dia: versão}) numa consulta e guarda as partes."""
+    filtro = Q()
+    for inicio, fim in _intervalos(versoes):
+        filtro |= Q(pago_em__gte=inicio, pago_em__lt=fim)
+    por_dia = {dia: [] for dia in versoes}
+    pagamentos = movimentos(PagamentoPedido.objects.filter(filtro, pedido__lavandaria=lavandaria))
+    for *campos, cliente_id, caixa_id in pagamentos.values_list(*CAMPOS_PARTE).iterator(chunk_size=2000):
+        m = Movimento(*campos)
+        por_dia[dia_local(m.pago_em)].append((m, cliente_id, caixa_id))
+
+    with transaction.atomic():
+        RelatorioDiario.objects.filter(lavandaria=lavandaria, dia__in=list(versoes)).delete()
+        # outro worker pode ter guardado o mesmo dia entretanto: fica a dele
+        RelatorioDiario.objects.bulk_create(
+            [
+                RelatorioDiario(
+                    lavandaria=lavandaria, dia=dia, versao=versoes[dia],
+                    movimentos=[[*m, cliente_id, caixa_id] for m, cliente_id, caixa_id in linhas],
+                )
+                for dia, linhas in por_dia.items()
+            ],
+            ignore_conflicts=True,
+        )
+    return por_dia
+
+
+def movimentos_dias(lavandaria, versoes, nomes):
+    """
+    Movimentos dos dias em `versoes` ({dia: versão}, ver versoes_dias()),
+    por ordem de pagamento, com os nomes de `nomes` (ver nomes_periodo()):
+    das partes guardadas com a mesma versão; os outros dias são lidos dos
+    pagamentos e guardados.
+    """
+    # a versão foi lida antes dos pagamentos: uma alteração entretanto deixa
+    # a parte guardada já desatualizada, e é relida da próxima vez
+    por_dia = {}
+    for dia, versao, linhas in RelatorioDiario.objects.filter(
+        lavandaria=lavandaria, dia__in=list(versoes),
+    ).values_list("dia", "versao", "movimentos"):
+        # partes guardadas noutro formato são remontadas
+        if versao == versoes[dia] and all(len(linha) == len(CAMPOS_PARTE) for linha in linhas):
+            por_dia[dia] = [_movimento(linha) for linha in linhas]
+
+    em_falta = {dia: versao for dia, versao in versoes.items() if dia not in por_dia}
+    if em_falta:
+        por_dia.update(_montar(lavandaria, em_falta))
+
+    clientes, caixas = nomes
+    return [
+        m._replace(
+            cliente=clientes.get(cliente_id, m.cliente),
+            caixa=caixas.get(caixa_id, m.caixa) if caixa_id is not None else m.caixa,
+            lavandaria=lavandaria.nome,
+        )
+        for dia in sorted(por_dia)
+        for m, cliente_id, caixa_id in por_dia[dia]
+    ]
+
+
+# ===== RELATÓRIO =====
+
+def _pagamentos(lavandaria, dia_inicio, dia_fim, pedidos):
+    inicio, fim = intervalo_dias(dia_inicio, dia_fim)
+    return pagamentos_periodo(lavandaria, inicio, fim - timedelta(microseconds=1), pedidos)
+
+
+def nomes_periodo(lavandaria, dia_inicio, dia_fim, pedidos=None):
+    """({cliente_id: nome}, {funcionario_id: username}) atuais dos pagamentos do período (uma consulta)."""
+    clientes, caixas = {}, {}
+    for cliente_id, cliente, caixa_id, caixa in _pagamentos(lavandaria, dia_inicio, dia_fim, pedidos).values_list(
+        "pedido__cliente_id", "pedido__cliente__nome", "criado_por_id", "criado_por__user__username",
+    ).order_by().distinct():
+        clientes[cliente_id] = cliente
+        if caixa_id is not None:
+            caixas[caixa_id] = caixa
+    return clientes, caixas
+
+
+def _chave(lavandaria, dia_inicio, dia_fim, formato, versoes, pedidos, nomes):
+    """Hash de tudo o que muda o ficheiro: desenho, lavandaria, dias, seleção, pedidos e nomes do período."""
+    selecao = None
+    if pedidos is not None:
+        selecao = hashlib.sha256(
+            ",".join(map(str, pedidos.filter(lavandaria=lavandaria).order_by("pk").values_list("pk", flat=True))).encode()
+        ).hexdigest()
+    # as versões só crescem: com o mesmo conjunto de pedidos (dado pelos
+    # dias e pela seleção), a soma muda sempre que um deles muda
+    estado_pedidos = Pedido.objects.filter(
+        pk__in=_pagamentos(lavandaria, dia_inicio, dia_fim, pedidos).values("pedido_id"),
+    ).aggregate(n=Count("pk"), versoes=Sum("versao"))
+    dados = [
+        VERSAO_DESENHO, formato, lavandaria.pk, lavandaria.nome, lavandaria.endereco,
+        dia_inicio.isoformat(), dia_fim.isoformat(), sorted((dia.isoformat(), v) for dia, v in versoes.items()),
+        selecao, estado_pedidos["n"], estado_pedidos["versoes"],
+        sorted(nomes[0].items()), sorted(nomes[1].items()),
+    ]
+    return hashlib.sha256(json.dumps(dados).encode()).hexdigest()
+
+
+def dados_relatorio(lavandaria, dia_inicio, dia_fim, versoes, pedidos=None, nomes=None):
+    """O contexto de core.relatorios.dados_relatorio_financeiro, com os movimentos das partes diárias."""
+    if nomes is None:
+        nomes = nomes_periodo(lavandaria, dia_inicio, dia_fim, pedidos)
+    lista = movimentos_dias(lavandaria, versoes, nomes)
+    if pedidos is not None:
+        ids = set(pedidos.filter(lavandaria=lavandaria).values_list("pk", flat=True))
+        lista = [m for m in lista if m.pedido_id in ids]
+    resumos, total_recebido = resumos_movimentos(lista)
+
+    return {
+        "lavandaria": lavandaria,
+        **dados_pedidos(_pagamentos(lavandaria, dia_inicio, dia_fim, pedidos), lavandaria),
+        "total_recebido": total_recebido,
+        **resumos,
+        "pagamentos": lista,
+        "metodos_pagamento_dict": dict(PagamentoPedido.METODO_PAGAMENTO_CHOICES),
+    }
+
+
+def relatorio(lavandaria, dia_inicio, dia_fim, formato, gerar, pedidos=None):
+    """
+    (nome do ficheiro, bytes) do relatório do período fechado: o guardado,
+    se a chave é a mesma; senão gerar(contexto), que fica guardado.
+    """
+    versoes = versoes_dias(lavandaria, dia_inicio, dia_fim)
+    nomes = nomes_periodo(lavandaria, dia_inicio, dia_fim, pedidos)
+    chave = _chave(lavandaria, dia_inicio, dia_fim, formato, versoes, pedidos, nomes)
+    periodo = {"lavandaria": lavandaria, "dia_inicio": dia_inicio, "dia_fim": dia_fim, "formato": formato}
+
+    guardado = RelatorioFechado.objects.filter(**periodo, chave=chave).values_list("nome_ficheiro", "conteudo").first()
+    if guardado is not None:
+        nome_ficheiro, conteudo = guardado
+        return nome_ficheiro, bytes(conteudo)
+
+    nome_ficheiro, conteudo = gerar(dados_relatorio(lavandaria, dia_inicio, dia_fim, versoes, pedidos, nomes))
+    with transaction.atomic():
+        RelatorioFechado.objects.filter(**periodo).delete()
+        RelatorioFechado.objects.create(
+            **periodo, chave=chave, nome_ficheiro=nome_ficheiro, conteudo=conteudo, tamanho=len(conteudo),
+        )
+    return nome_ficheiro, conteudo
+
+
+def limpar_relatorios_antigos():
+    """Apaga os ficheiros guardados há mais de RELATORIO_FECHADO_RETENCAO_DIAS."""
+    dias = getattr(settings, "RELATORIO_FECHADO_RETENCAO_DIAS", 30)
+    apagados, _ = RelatorioFechado.objects.filter(criado_em__lt=timezone.now() - timedelta(days=dias)).delete()
+    return apagados
@@ -1,8 +1,48 @@
-from django.db.models.signals import post_migrate
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
 from django.dispatch import receiver
-from .models import criar_grupos_com_permissoes
+from . import vendas_diarias
+from .catalogo import invalidar_catalogo
+from .models import ItemServico, Lavandaria, PagamentoPedido, Pedido, VendaDiaria, criar_grupos_com_permissoes
 
 
 @receiver(post_migrate)
 def criar_grupos_apos_migracao(sender, **kwargs):
-    criar_grupos_com_permissoes()
+    # post_migrate é enviado por cada app; as permissões do core só existem
+    # depois do migrate do próprio core.
+    if sender.label != "core":
+        return
+    # forcar: a base pode ter sido recriada (flush/testes) neste processo
+    criar_grupos_com_permissoes(forcar=True)
+
+
+@receiver(post_save, sender=ItemServico)
+@receiver(post_delete, sender=ItemServico)
+def invalidar_catalogo_artigos(sender, **kwargs):
+    invalidar_catalogo()
+
+
+# Apagar também chega aqui em cascata e pelas ações em massa do admin,
+# que não passam por delete() dos modelos.
+@receiver(pre_delete, sender=Pedido)
+def guardar_pontos_do_pedido(sender, instance, **kwargs):
+    # as movimentações ficam sem pedido (SET_NULL) antes do post_delete
+    instance._pontos_vendas = vendas_diarias.pontos_do_pedido(instance.pk)
+
+
+@receiver(post_delete, sender=Pedido)
+def tirar_pedido_das_vendas_diarias(sender, instance, **kwargs):
+    vendas_diarias.registar_pedido(instance, apagado=True)
+
+
+@receiver(post_delete, sender=PagamentoPedido)
+def tirar_pagamento_das_vendas_diarias(sender, instance, **kwargs):
+    vendas_diarias.registar_pagamento(instance, apagado=True)
+
+
+@receiver(post_delete, sender=Lavandaria)
+def tirar_lavandaria_das_vendas_diarias(sender, instance, **kwargs):
+    # Os pedidos e pagamentos apagados em cascata saem das vendas diárias
+    # depois de as linhas da lavandaria já terem sido apagadas, e voltavam
+    # a criá-las (a apontar para a lavandaria apagada); saem agora, ainda
+    # na transação do delete.
+    VendaDiaria.objects.filter(lavandaria_id=instance.pk).delete()
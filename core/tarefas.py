@@ -0,0 +1,244 @@
+"""
+Fila de relatórios na base de dados (sem broker externo).
+
+O admin cria uma TarefaRelatorio "pendente" e responde logo; o comando
+processar_relatorios (dyno worker, ver Procfile) reserva a tarefa pendente
+mais antiga com SELECT ... FOR UPDATE SKIP LOCKED (vários workers não
+apanham a mesma), gera o PDF e guarda-o na tarefa, de onde é descarregado
+pelo admin. Os relatórios financeiros de dias já fechados são reutilizados
+(core/relatorios_fechados.py). O progresso é gravado à medida que as linhas do relatório são
+lidas; uma tarefa "em curso" sem actualizações há mais do que
+RELATORIO_TAREFA_PARADA_MINUTOS (worker reiniciado a meio) volta à fila.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import exportacao, pdf, relatorios_fechados
+from .models import Lavandaria, Pedido, TarefaRelatorio
+from .relatorios import RESUMOS, dados_relatorio_financeiro, pedidos_vendas, quantidade_total
+
+logger = logging.getLogger(__name__)
+
+# Tentativas por tarefa (contando as retomadas depois de um worker parar)
+MAX_TENTATIVAS = 3
+
+# Intervalo mínimo, em segundos, entre gravações do progresso
+INTERVALO_PROGRESSO = 2
+
+GERADORES = {}
+
+
+def gerador(tipo):
+    """
+    Regista a função que gera o relatório `tipo`: (parametros, progresso) -> (nome, bytes).
+    parametros["formato"]: "pdf" (por omissão) ou "xlsx".
+    """
+    def registar(funcao):
+        GERADORES[tipo] = funcao
+        return funcao
+    return registar
+
+
+def _em_segundo_plano():
+    return getattr(settings, "RELATORIOS_EM_SEGUNDO_PLANO", True)
+
+
+def enfileirar(tipo, parametros, user=None):
+    """
+    Cria a tarefa. Com RELATORIOS_EM_SEGUNDO_PLANO = False (desenvolvimento,
+    sem worker) o relatório é gerado já, neste processo.
+    """
+    tarefa = TarefaRelatorio.objects.create(
+        tipo=tipo, parametros=parametros, criado_por=user if user and user.is_authenticated else None,
+    )
+    if not _em_segundo_plano():
+        executar(reservar(tarefa.pk))
+        tarefa.refresh_from_db(fields=["estado", "progresso", "mensagem", "nome_ficheiro", "tamanho"])
+    return tarefa
+
+
+def reservar(tarefa_id=None):
+    """
+    Marca como "em curso" a tarefa pendente mais antiga (ou a indicada) e
+    devolve-a, sem o conteúdo; None se não houver nenhuma livre.
+    """
+    with transaction.atomic():
+        pendentes = TarefaRelatorio.objects.filter(estado="pendente")
+        if tarefa_id is not None:
+            pendentes = pendentes.filter(pk=tarefa_id)
+        tarefa = (
+            pendentes
+            .select_for_update(skip_locked=True)
+            .defer("conteudo")
+            .order_by("criado_em", "pk")
+            .first()
+        )
+        if tarefa is None:
+            return None
+        agora = timezone.now()
+        TarefaRelatorio.objects.filter(pk=tarefa.pk).update(
+            estado="em_curso", iniciado_em=agora, atualizado_em=agora,
+            progresso=0, tentativas=F("tentativas") + 1,
+        )
+    tarefa.estado = "em_curso"
+    return tarefa
+
+
+class Progresso:
+    """Grava TarefaRelatorio.progresso (0-99) no máximo a cada INTERVALO_PROGRESSO segundos."""
+
+    def __init__(self, tarefa_id):
+        self.tarefa_id = tarefa_id
+        self._gravado_em = 0.0
+
+    def definir(self, percentagem):
+        agora = time.monotonic()
+        if agora - self._gravado_em < INTERVALO_PROGRESSO:
+            return
+        self._gravado_em = agora
+        TarefaRelatorio.objects.filter(pk=self.tarefa_id).update(
+            progresso=max(0, min(99, int(percentagem))), atualizado_em=timezone.now(),
+        )
+
+    def acompanhar(self, iteravel, total):
+        """Percorre `iteravel` (com `total` elementos) gravando o progresso."""
+        total = max(total, 1)
+        for i, elemento in enumerate(iteravel):
+            if i % 50 == 0:
+                self.definir(i * 100 / total)
+            yield elemento
+
+
+def executar(tarefa):
+    """Gera o relatório da tarefa (já reservada) e grava o resultado ou o erro."""
+    if tarefa is None:
+        return
+    try:
+        nome_ficheiro, conteudo = GERADORES[tarefa.tipo](tarefa.parametros, Progresso(tarefa.pk))
+    except Exception as e:
+        logger.exception("Tarefa de relatório %s falhou", tarefa.pk)
+        TarefaRelatorio.objects.filter(pk=tarefa.pk).update(
+            estado="erro", mensagem=str(e)[:2000], concluido_em=timezone.now(), atualizado_em=timezone.now(),
+        )
+        return
+
+    TarefaRelatorio.objects.filter(pk=tarefa.pk).update(
+        estado="concluido", progresso=100, nome_ficheiro=nome_ficheiro, conteudo=conteudo,
+        tamanho=len(conteudo), mensagem="", concluido_em=timezone.now(), atualizado_em=timezone.now(),
+    )
+
+
+def recuperar_tarefas_paradas():
+    """
+    Tarefas "em curso" sem progresso há muito tempo (worker reiniciado a
+    meio): voltam a pendente, ou passam a erro depois de MAX_TENTATIVAS.
+    """
+    minutos = getattr(settings, "RELATORIO_TAREFA_PARADA_MINUTOS", 15)
+    limite = timezone.now() - timedelta(minutes=minutos)
+    paradas = TarefaRelatorio.objects.filter(estado="em_curso", atualizado_em__lt=limite)
+    falhadas = paradas.filter(tentativas__gte=MAX_TENTATIVAS).update(
+        estado="erro", mensagem="O worker parou a meio do relatório.", concluido_em=timezone.now(),
+    )
+    retomadas = paradas.update(estado="pendente")
+    return retomadas, falhadas
+
+
+def limpar_tarefas_antigas():
+    """Apaga tarefas terminadas (e os seus ficheiros) há mais de RELATORIO_RETENCAO_HORAS."""
+    horas = getattr(settings, "RELATORIO_RETENCAO_HORAS", 72)
+    limite = timezone.now() - timedelta(hours=horas)
+    apagadas, _ = TarefaRelatorio.objects.filter(
+        estado__in=["concluido", "erro"], concluido_em__lt=limite,
+    ).delete()
+    return apagadas
+
+
+# ===== GERADORES =====
+
+@gerador("vendas")
+def relatorio_vendas(parametros, progresso):
+    ids = parametros["pedido_ids"]
+    ordem = parametros.get("ordem") or Pedido._meta.ordering
+    pedidos = Pedido.objects.filter(pk__in=ids).order_by(*ordem)
+    start_date, end_date = parametros["start_date"], parametros["end_date"]
+    nome = f"relatorio_vendas_{start_date}_a_{end_date}".replace("/", "-")
+
+    if parametros.get("formato") == "xlsx":
+        itens = exportacao.itens_para_exportar(pedidos)
+        linhas = progresso.acompanhar(exportacao.linhas_vendas(itens), itens.count())
+        return f"{nome}.xlsx", exportacao.xlsx_em_bytes([("Vendas", exportacao.CABECALHO_VENDAS, linhas)])
+
+    total = quantidade_total(pedidos)
+    pedidos = pedidos_vendas(pedidos).iterator(chunk_size=500)
+    conteudo = pdf.pdf_em_bytes(
+        pdf.relatorio_vendas(progresso.acompanhar(pedidos, len(ids)), start_date, end_date, total),
+        titulo="Relatório de Vendas",
+    )
+    return f"{nome}.pdf", conteudo
+
+
+def _folhas_financeiro(contexto, progresso):
+    """Folhas do XLSX financeiro: movimentos, pedidos em aberto e resumos."""
+    yield "Movimentos", exportacao.CABECALHO_MOVIMENTOS, progresso.acompanhar(
+        exportacao.linhas_movimentos(contexto["pagamentos"]), _quantidade_pagamentos(contexto),
+    )
+
+    yield "Pedidos em aberto", ["Pedido", "Cliente", "Total", "Pago (histórico)", "Pago no período", "Saldo"], (
+        [
+            linha["pedido"].id, linha["pedido"].cliente.nome, linha["total_final"],
+            linha["total_pago_historico"], linha["pago_no_periodo"], linha["saldo"],
+        ]
+        for linha in contexto["pedidos_em_aberto"]
+    )
+
+    def resumos():
+        yield ["Total faturado", "", None, contexto["total_faturado"]]
+        yield ["Total recebido", "", None, contexto["total_recebido"]]
+        yield ["Saldo em aberto", "", None, contexto["saldo_total"]]
+        metodos = contexto["metodos_pagamento_dict"]
+        for chave, campo, _ in RESUMOS:
+            for row in contexto[chave]:
+                valor = row[campo]
+                if chave == "resumo_por_metodo":
+                    valor = metodos.get(valor, valor)
+                yield [chave.replace("resumo_", "").replace("_", " "), valor if valor is not None else "-", row["qtd"], row["total"]]
+
+    yield "Resumo", ["Resumo", "", "Qtd", "Total"], resumos()
+
+
+def _quantidade_pagamentos(contexto):
+    return sum(row["qtd"] for row in contexto["resumo_por_dia"])
+
+
+@gerador("financeiro")
+def relatorio_financeiro(parametros, progresso):
+    lavandaria = Lavandaria.objects.get(pk=parametros["lavandaria_id"])
+    start_dt = datetime.fromisoformat(parametros["start_dt"])
+    end_dt = datetime.fromisoformat(parametros["end_dt"])
+    pedido_ids = parametros.get("pedido_ids")
+    pedidos = Pedido.objects.filter(pk__in=pedido_ids) if pedido_ids is not None else None
+    formato = parametros.get("formato") or "pdf"
+
+    start_date = timezone.localtime(start_dt).strftime("%d/%m/%Y")
+    end_date = timezone.localtime(end_dt).strftime("%d/%m/%Y")
+    nome = f"relatorio_financeiro_{lavandaria.nome}_{start_date}_a_{end_date}".replace("/", "-")
+
+    def gerar(contexto):
+        contexto.update(start_date=start_date, end_date=end_date)
+        if formato == "xlsx":
+            return f"{nome}.xlsx", exportacao.xlsx_em_bytes(_folhas_financeiro(contexto, progresso))
+
+        contexto["pagamentos"] = progresso.acompanhar(contexto["pagamentos"], _quantidade_pagamentos(contexto))
+        conteudo = pdf.pdf_em_bytes(pdf.relatorio_financeiro(contexto), titulo="Relatório Financeiro (Caixa)")
+        return f"{nome}.pdf", conteudo
+
+    dias = relatorios_fechados.periodo_fechado(start_dt, end_dt)
+    if dias is not None:
+        return relatorios_fechados.relatorio(lavandaria, *dias, formato, gerar, pedidos=pedidos)
+    return gerar(dados_relatorio_financeiro(lavandaria, start_dt, end_dt, pedidos=pedidos))
@@ -1 +1,1382 @@
-from django.test import TestCase
+import csv
+import importlib
+import json
+import random
+import threading
+import time
+from contextlib import nullcontext, redirect_stdout
+from datetime import datetime, time as hora, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from django.apps import apps
+from django.contrib.auth.models import Group, User
+from django.contrib.messages import get_messages
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.db.models import ExpressionWrapper, F, OuterRef, Subquery, Value
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
+from PIL import Image
+
+from . import escpos, exportacao, relatorios_fechados, tarefas, vendas_diarias
+from .admin import _parametros_financeiro, exportar_vendas_csv
+from .catalogo import CHAVE_VERSAO, obter_artigo, obter_catalogo
+from .management.commands.verificar_planos import consultas_quentes
+from .middleware import FuncionarioMiddleware, obter_funcionario
+from .models import (
+    Cliente, Funcionario, ItemPedido, ItemServico, Lavandaria, LotePontos, MovimentacaoPontos, PagamentoPedido, Pedido,
+    RelatorioFechado, Servico, TarefaRelatorio, VendaDiaria, VersaoDados, expirar_pontos_clientes, quitar_pedidos,
+)
+from .recalculo import contador_recalculos, reiniciar_contador
+from .recibo_imagem import LARGURA_RECIBO
+from .relatorios import pedidos_vendas, quantidade_total
+from .recibos import (
+    CONSULTAS_RECIBO, CacheRecibos, ReciboContexto, cache_recibos, chave_recibo, recibo_escpos, recibo_pbm, recibo_pdf,
+    recibo_png, recibos_png_em_lote, texto_recibo,
+)
+
+
+class DadosBase:
+    """Lavandaria, cliente e três artigos (10, 20 e 30 Mts)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lavandaria = Lavandaria.objects.create(nome="Lavandaria Central", endereco="Av. 24 de Julho", telefone="841000000")
+        cls.cliente = Cliente.objects.create(nome="Ana", telefone="842000000")
+        cls.artigos = [
+            ItemServico.objects.create(nome=nome, preco_base=Decimal(preco))
+            for nome, preco in (("Camisa", "10.00"), ("Calça", "20.00"), ("Fato", "30.00"))
+        ]
+
+    def no_commit(self):
+        """Corre os callbacks on_commit no fim do bloco (num TestCase não há commit)."""
+        if isinstance(self, TestCase):
+            return self.captureOnCommitCallbacks(execute=True)
+        return nullcontext()
+
+    def novo_pedido(self, **campos):
+        return Pedido.objects.create(cliente=self.cliente, lavandaria=self.lavandaria, **campos)
+
+    def pedido_com_itens(self, *quantidades):
+        """Pedido com `quantidades[i]` unidades do artigo i, já recalculado."""
+        pedido = self.novo_pedido()
+        with self.no_commit():
+            pedido.adicionar_itens([
+                {"item_de_servico": artigo, "quantidade": quantidade}
+                for artigo, quantidade in zip(self.artigos, quantidades) if quantidade
+            ])
+        pedido.refresh_from_db()
+        return pedido
+
+
+class AdicionarItensTests(DadosBase, TestCase):
+
+    def setUp(self):
+        obter_catalogo(forcar=True)
+
+    def linhas(self, n):
+        return [{"item_de_servico": self.artigos[i % 3].pk, "quantidade": 1 + i % 2} for i in range(n)]
+
+    def consultas_em_lote(self, n):
+        pedido = self.novo_pedido()
+        with CaptureQueriesContext(connection) as consultas, self.captureOnCommitCallbacks(execute=True):
+            pedido.adicionar_itens(self.linhas(n))
+        return len(consultas), pedido
+
+    def test_consultas_nao_crescem_com_as_linhas(self):
+        contagens = {n: self.consultas_em_lote(n)[0] for n in (1, 10, 40)}
+        self.assertEqual(len(set(contagens.values())), 1, contagens)
+
+        # antes: um ItemPedido.save() por linha
+        pedido = self.novo_pedido()
+        with CaptureQueriesContext(connection) as por_linha, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for linha in self.linhas(10):
+                    ItemPedido.objects.create(
+                        pedido=pedido, item_de_servico_id=linha["item_de_servico"], quantidade=linha["quantidade"],
+                    )
+        self.assertGreater(len(por_linha), 2 * contagens[10])
+
+    def test_total_e_itens(self):
+        _, pedido = self.consultas_em_lote(4)
+        pedido.refresh_from_db()
+        # 10x1 + 20x2 + 30x1 + 10x2
+        self.assertEqual(pedido.total, Decimal("100.00"))
+        self.assertEqual(pedido.itens.count(), 4)
+        self.assertEqual(pedido.status_pagamento, "nao_pago")
+
+    def test_artigo_inexistente_nao_grava_nada(self):
+        pedido = self.novo_pedido()
+        with self.assertRaises(ValidationError):
+            pedido.adicionar_itens([{"item_de_servico": self.artigos[0].pk, "quantidade": 1}, {"item_de_servico": 999999, "quantidade": 1}])
+        self.assertFalse(pedido.itens.exists())
+
+    def test_artigo_indisponivel_e_recusado(self):
+        artigo = ItemServico.objects.create(nome="Tapete", preco_base=Decimal("200.00"), disponivel=False)
+        pedido = self.novo_pedido()
+        with self.assertRaisesMessage(ValidationError, "Tapete não está disponível"):
+            pedido.adicionar_itens([{"item_de_servico": self.artigos[0].pk, "quantidade": 1}, {"item_de_servico": artigo.pk, "quantidade": 1}])
+        self.assertFalse(pedido.itens.exists())
+
+    def test_servico_desconhecido_ou_inativo_e_recusado(self):
+        lavagem = Servico.objects.create(lavandaria=self.lavandaria, nome="Lavagem")
+        inativo = Servico.objects.create(lavandaria=self.lavandaria, nome="Tingimento", ativo=False)
+        pedido = self.novo_pedido()
+
+        for servico in (999999, inativo.pk, "abc"):
+            with self.subTest(servico=servico), self.assertRaises(ValidationError):
+                pedido.adicionar_itens([
+                    {"item_de_servico": self.artigos[0].pk, "quantidade": 1, "servico": lavagem.pk},
+                    {"item_de_servico": self.artigos[1].pk, "quantidade": 1, "servico": servico},
+                ])
+        self.assertFalse(pedido.itens.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            item, = pedido.adicionar_itens([{"item_de_servico": self.artigos[0].pk, "quantidade": 1, "servico": lavagem}])
+        self.assertEqual(item.servico_id, lavagem.pk)
+
+    def test_endpoint_responde_400_a_ids_invalidos(self):
+        pedido = self.novo_pedido()
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+        url = reverse("core:adicionar_itens_pedido", args=[pedido.pk])
+
+        for linha in ({"item_de_servico": 999999, "quantidade": 1}, {"item_de_servico": self.artigos[0].pk, "quantidade": 1, "servico": 999999}):
+            with self.subTest(linha=linha):
+                resposta = self.client.post(url, json.dumps({"itens": [linha]}), content_type="application/json")
+                self.assertEqual(resposta.status_code, 400)
+                self.assertIn("999999", resposta.json()["erro"])
+        self.assertFalse(pedido.itens.exists())
+
+    def test_endpoint(self):
+        pedido = self.novo_pedido()
+        self.client.force_login(User.objects.create_superuser("admin", password="x"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            resposta = self.client.post(
+                reverse("core:adicionar_itens_pedido", args=[pedido.pk]),
+                json.dumps({"itens": self.linhas(3)}),
+                content_type="application/json",
+            )
+
+        self.assertEqual(resposta.status_code, 201)
+        self.assertEqual(resposta.json(), {
+            "pedido": pedido.pk, "itens_criados": 3, "total": "80.00", "total_final": "80.00", "saldo": "80.00",
+        })
+
+
+class RecalculoTests(DadosBase, TestCase):
+
+    def setUp(self):
+        reiniciar_contador()
+
+    def test_um_recalculo_por_pedido_por_transacao(self):
+        pedido = self.novo_pedido()
+        outro = self.novo_pedido()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                pedido.adicionar_itens([{"item_de_servico": self.artigos[0], "quantidade": 3}])
+                ItemPedido.objects.create(pedido=pedido, item_de_servico=self.artigos[1], quantidade=2)
+                ItemPedido.objects.create(pedido=outro, item_de_servico=self.artigos[2], quantidade=1)
+                PagamentoPedido.objects.create(pedido=pedido, valor=Decimal("20.00"), metodo_pagamento="numerario")
+                pedido.registrar_pagamento(valor=Decimal("30.00"), metodo_pagamento="mpesa")
+                self.assertEqual(contador_recalculos[pedido.pk], 0)
+
+        self.assertEqual(contador_recalculos[pedido.pk], 1)
+        self.assertEqual(contador_recalculos[outro.pk], 1)
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.total, Decimal("70.00"))
+        self.assertEqual(pedido.total_pago, Decimal("50.00"))
+        self.assertEqual(pedido.status_pagamento, "parcial")
+
+    def test_saldo_certo_antes_do_commit(self):
+        pedido = self.pedido_com_itens(0, 0, 10)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                pedido.registrar_pagamento(valor=Decimal("200.00"), metodo_pagamento="numerario")
+                self.assertEqual(Pedido.objects.get(pk=pedido.pk).calcular_saldo_atual(), Decimal("100.00"))
+
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.saldo, Decimal("100.00"))
+
+    def test_erro_num_pedido_nao_impede_os_outros(self):
+        pedido = self.novo_pedido()
+        outro = self.novo_pedido()
+        recalcular = Pedido.recalcular_pagamentos
+
+        def falhar_no_primeiro(instancia):
+            if instancia.pk == pedido.pk:
+                raise RuntimeError("falhou")
+            return recalcular(instancia)
+
+        with mock.patch.object(Pedido, "recalcular_pagamentos", falhar_no_primeiro):
+            # a gravação já fez commit: o erro fica no log, não chega a quem gravou
+            with self.assertLogs("core.recalculo", "ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    with transaction.atomic():
+                        ItemPedido.objects.create(pedido=pedido, item_de_servico=self.artigos[0], quantidade=1)
+                        ItemPedido.objects.create(pedido=outro, item_de_servico=self.artigos[0], quantidade=1)
+
+        self.assertEqual(contador_recalculos[pedido.pk], 0)
+        self.assertEqual(contador_recalculos[outro.pk], 1)
+        self.assertTrue(Pedido.objects.get(pk=pedido.pk).recalculo_pendente)
+        self.assertFalse(Pedido.objects.get(pk=outro.pk).recalculo_pendente)
+
+        # o próximo recálculo do pedido acerta-o e tira a marca
+        with self.captureOnCommitCallbacks(execute=True):
+            ItemPedido.objects.create(pedido=pedido, item_de_servico=self.artigos[1], quantidade=1)
+        pedido.refresh_from_db()
+        self.assertFalse(pedido.recalculo_pendente)
+        self.assertEqual(pedido.total, Decimal("30.00"))
+
+    def test_verificador_corrige_os_marcados(self):
+        pedido = self.pedido_com_itens(1)
+        Pedido.objects.filter(pk=pedido.pk).update(recalculo_pendente=True)
+
+        call_command("verificar_totais_pedidos", "--corrigir", stdout=StringIO())
+
+        self.assertFalse(Pedido.objects.get(pk=pedido.pk).recalculo_pendente)
+
+    def test_rollback_descarta_o_callback(self):
+        pedido = self.novo_pedido()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    ItemPedido.objects.create(pedido=pedido, item_de_servico=self.artigos[0], quantidade=1)
+                    raise RuntimeError("desfeito")
+            except RuntimeError:
+                pass
+            # nova transação: tem de registar outro callback
+            with transaction.atomic():
+                ItemPedido.objects.create(pedido=pedido, item_de_servico=self.artigos[1], quantidade=2)
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(contador_recalculos[pedido.pk], 1)
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.total, Decimal("40.00"))
+
+
+class PedidoSaveTests(DadosBase, TestCase):
+
+    def test_save_sem_update_fields_nao_apaga_deltas(self):
+        pedido = self.pedido_com_itens(2, 1)
+        # o formulário do admin abre com o pedido como estava
+        aberto = Pedido.objects.get(pk=pedido.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.registrar_pagamento(valor=Decimal("15.00"), metodo_pagamento="pos")
+            ItemPedido.objects.create(pedido=pedido, item_de_servico=self.artigos[2], quantidade=1)
+
+        aberto.status = "completo"
+        aberto.desconto_cabides = Decimal("5.00")
+        with self.captureOnCommitCallbacks(execute=True):
+            aberto.save()
+
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.status, "completo")
+        self.assertEqual(pedido.desconto_cabides, Decimal("5.00"))
+        self.assertEqual(pedido.total, Decimal("70.00"))
+        self.assertEqual(pedido.soma_pagamentos, Decimal("15.00"))
+        self.assertIsNotNone(pedido.ultimo_pagamento_em)
+        self.assertEqual(pedido.total_pago, Decimal("15.00"))
+        self.assertEqual(pedido.status_pagamento, "parcial")
+
+
+class ReceberSaldoAdminTests(DadosBase, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        user = User.objects.create_superuser("gerente", password="x")
+        cls.funcionario = Funcionario.objects.create(user=user, lavandaria=cls.lavandaria, grupo="gerente")
+
+    def setUp(self):
+        self.client.force_login(self.funcionario.user)
+
+    def receber_saldo(self, pedido):
+        with self.captureOnCommitCallbacks(execute=True):
+            resposta = self.client.get(reverse("admin:core_receber_saldo", args=[pedido.pk]))
+        return [str(m) for m in get_messages(resposta.wsgi_request)]
+
+    def test_recebe_o_saldo_com_desconto(self):
+        pedido = self.pedido_com_itens(0, 0, 10)
+        Pedido.objects.filter(pk=pedido.pk).update(desconto=Decimal("50.00"))
+
+        mensagens = self.receber_saldo(pedido)
+
+        self.assertEqual(mensagens, [f"Recebido saldo do Pedido {pedido.pk}: 250.00 MZN"])
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.soma_pagamentos, Decimal("250.00"))
+        self.assertEqual(pedido.status_pagamento, "pago")
+
+    def test_mostra_o_erro_da_validacao(self):
+        pedido = self.pedido_com_itens(1)
+
+        with mock.patch.object(Pedido, "registrar_pagamento", side_effect=ValidationError("Caixa fechada.")):
+            mensagens = self.receber_saldo(pedido)
+
+        self.assertEqual(mensagens, [f"Pedido {pedido.pk}: Caixa fechada."])
+
+
+class IdempotenciaPagamentoTests(DadosBase, TestCase):
+
+    def pagar(self, pedido, valor, chave):
+        with self.captureOnCommitCallbacks(execute=True):
+            return pedido.registrar_pagamento(valor=Decimal(valor), metodo_pagamento="mpesa", chave_idempotencia=chave)
+
+    def test_repetir_a_chave_devolve_o_mesmo_pagamento(self):
+        pedido = self.pedido_com_itens(0, 0, 1)
+        primeiro = self.pagar(pedido, "10.00", "MP123")
+        self.assertIsInstance(primeiro, PagamentoPedido)
+
+        repetido = self.pagar(Pedido.objects.get(pk=pedido.pk), "10.00", "MP123")
+
+        self.assertEqual(repetido.pk, primeiro.pk)
+        self.assertEqual(pedido.pagamentos.count(), 1)
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.soma_pagamentos, Decimal("10.00"))
+
+    def test_repetir_depois_de_pago_nao_excede_o_saldo(self):
+        pedido = self.pedido_com_itens(1)
+        primeiro = self.pagar(pedido, "10.00", "MP123")
+
+        self.assertEqual(self.pagar(Pedido.objects.get(pk=pedido.pk), "10.00", "MP123").pk, primeiro.pk)
+
+    def test_chave_com_outro_valor(self):
+        pedido = self.pedido_com_itens(0, 0, 1)
+        self.pagar(pedido, "10.00", "MP123")
+
+        with self.assertRaises(ValidationError):
+            self.pagar(pedido, "15.00", "MP123")
+        self.assertEqual(pedido.pagamentos.count(), 1)
+
+    def test_a_chave_e_por_pedido(self):
+        pedidos = [self.pedido_com_itens(1), self.pedido_com_itens(1)]
+
+        pagamentos = [self.pagar(pedido, "10.00", "MP123") for pedido in pedidos]
+
+        self.assertNotEqual(pagamentos[0].pk, pagamentos[1].pk)
+        self.assertEqual(PagamentoPedido.objects.filter(chave_idempotencia="MP123").count(), 2)
+
+
+class RelatorioFinanceiroTests(DadosBase, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        user = User.objects.create_user("caixa", password="x")
+        cls.funcionario = Funcionario.objects.create(user=user, lavandaria=cls.lavandaria, grupo="gerente")
+
+    def request(self):
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(pk=self.funcionario.user_id)
+        FuncionarioMiddleware(lambda r: None)(request)
+        obter_funcionario(request)
+        return request
+
+    def pedidos_pagos(self, n):
+        """`n` pedidos de hoje, um por hora, cada um com um pagamento parcial."""
+        agora = timezone.now()
+        ids = []
+        for i in range(n):
+            pedido = self.pedido_com_itens(1, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                pedido.registrar_pagamento(valor=Decimal("10.00"), metodo_pagamento="numerario")
+            Pedido.objects.filter(pk=pedido.pk).update(criado_em=agora - timedelta(minutes=i))
+            ids.append(pedido.pk)
+        return Pedido.objects.filter(pk__in=ids)
+
+    # lavandaria, totais, pedidos em aberto, movimentos e os resumos: uma
+    # consulta com GROUPING SETS no PostgreSQL; nas outras
+    # bases uma por resumo e outra para o total recebido
+    CONSULTAS = 5 if connection.vendor == "postgresql" else 9
+
+    def gerar(self, pedidos, formato):
+        parametros = _parametros_financeiro(self.request(), pedidos)
+        progresso = mock.Mock(acompanhar=lambda iteravel, total: iteravel)
+        with self.assertNumQueries(self.CONSULTAS):
+            nome, conteudo = tarefas.GERADORES["financeiro"]({**parametros, "formato": formato}, progresso)
+        self.assertTrue(nome.endswith(f".{formato}"))
+        return conteudo
+
+    def test_periodo_do_primeiro_ao_ultimo_pedido(self):
+        pedidos = self.pedidos_pagos(3)
+        datas = sorted(pedidos.values_list("criado_em", flat=True))
+        request = self.request()
+
+        # datas numa consulta e ids noutra
+        with self.assertNumQueries(2):
+            parametros = _parametros_financeiro(request, pedidos)
+
+        self.assertEqual(datetime.fromisoformat(parametros["start_dt"]), datas[0])
+        self.assertEqual(datetime.fromisoformat(parametros["end_dt"]), datas[-1])
+        self.assertEqual(sorted(parametros["pedido_ids"]), sorted(pedidos.values_list("pk", flat=True)))
+
+    def test_consultas_nao_dependem_do_numero_de_pedidos(self):
+        for formato in ("pdf", "xlsx"):
+            for n in (2, 15):
+                with self.subTest(formato=formato, pedidos=n):
+                    self.gerar(self.pedidos_pagos(n), formato)
+
+
+class RelatoriosFechadosTests(DadosBase, TestCase):
+
+    def setUp(self):
+        self.ontem = timezone.localdate() - timedelta(days=1)
+        self.pedido = self.pedido_com_itens(0, 0, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pagamento = PagamentoPedido.objects.create(
+                pedido=self.pedido, valor=Decimal("25.00"), metodo_pagamento="numerario",
+                pago_em=timezone.make_aware(datetime.combine(self.ontem, hora(12))),
+            )
+        self.contextos = []
+
+    def gerar(self, contexto):
+        contexto["pagamentos"] = list(contexto["pagamentos"])
+        self.contextos.append(contexto)
+        return "caixa.pdf", f"ficheiro {len(self.contextos)}".encode()
+
+    def relatorio(self):
+        return relatorios_fechados.relatorio(self.lavandaria, self.ontem, self.ontem, "pdf", self.gerar)
+
+    def assertRemontado(self):
+        gerados = len(self.contextos)
+        _, conteudo = self.relatorio()
+        self.assertEqual(len(self.contextos), gerados + 1)
+        self.assertEqual(conteudo, f"ficheiro {gerados + 1}".encode())
+        return self.contextos[-1]
+
+    def test_relatorio_guardado_e_reutilizado(self):
+        contexto = self.assertRemontado()
+        self.assertEqual([m.valor for m in contexto["pagamentos"]], [Decimal("25.00")])
+        self.assertEqual(contexto["total_recebido"], Decimal("25.00"))
+
+        self.assertEqual(self.relatorio(), ("caixa.pdf", b"ficheiro 1"))
+        self.assertEqual(len(self.contextos), 1)
+        self.assertEqual(RelatorioFechado.objects.count(), 1)
+
+    def test_pagamento_de_dia_fechado_alterado(self):
+        self.relatorio()
+        pagamento = PagamentoPedido.objects.get(pk=self.pagamento.pk)
+        pagamento.valor = Decimal("40.00")
+        with self.captureOnCommitCallbacks(execute=True):
+            pagamento.save()
+
+        contexto = self.assertRemontado()
+        self.assertEqual([m.valor for m in contexto["pagamentos"]], [Decimal("40.00")])
+        self.assertEqual(RelatorioFechado.objects.count(), 1)
+
+    def test_pagamento_de_dia_fechado_apagado(self):
+        self.relatorio()
+        with self.captureOnCommitCallbacks(execute=True):
+            PagamentoPedido.objects.get(pk=self.pagamento.pk).delete()
+
+        contexto = self.assertRemontado()
+        self.assertEqual(contexto["pagamentos"], [])
+        self.assertEqual(contexto["total_recebido"], Decimal("0.00"))
+
+    def test_item_de_pedido_do_periodo(self):
+        self.relatorio()
+        with self.captureOnCommitCallbacks(execute=True):
+            ItemPedido.objects.create(pedido=self.pedido, item_de_servico=self.artigos[0], quantidade=1)
+
+        contexto = self.assertRemontado()
+        self.assertEqual(contexto["total_faturado"], Decimal("70.00"))
+
+    def test_nome_do_cliente_alterado(self):
+        self.relatorio()
+        Cliente.objects.filter(pk=self.cliente.pk).update(nome="Ana Maria")
+
+        contexto = self.assertRemontado()
+        self.assertEqual([m.cliente for m in contexto["pagamentos"]], ["Ana Maria"])
+
+
+class QuitarPedidosTests(DadosBase, TestCase):
+
+    def setUp(self):
+        self.parcial = self.pedido_com_itens(0, 0, 1)
+        self.pago = self.pedido_com_itens(1)
+        self.aberto = self.pedido_com_itens(0, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.parcial.registrar_pagamento(valor=Decimal("10.00"), metodo_pagamento="mpesa")
+            self.pago.registrar_pagamento(valor=Decimal("10.00"), metodo_pagamento="mpesa")
+        self.cliente.refresh_from_db()
+        self.pontos_antes = self.cliente.pontos
+
+    def quitar(self):
+        ids = [self.aberto.pk, self.pago.pk, self.parcial.pk, 999999]
+        return {linha["pedido"]: linha for linha in quitar_pedidos(ids)}
+
+    def test_um_pagamento_por_pedido_em_aberto_pelo_saldo(self):
+        resultado = self.quitar()
+
+        self.assertEqual(resultado[self.parcial.pk]["estado"], "quitado")
+        self.assertEqual(resultado[self.parcial.pk]["valor"], Decimal("20.00"))
+        self.assertEqual(resultado[self.aberto.pk]["valor"], Decimal("40.00"))
+        self.assertEqual(resultado[self.pago.pk]["estado"], "sem_saldo")
+        self.assertEqual(resultado[999999]["estado"], "inexistente")
+
+        novos = PagamentoPedido.objects.filter(metodo_pagamento="numerario")
+        self.assertEqual(
+            sorted(novos.values_list("pedido_id", "valor")),
+            sorted([(self.parcial.pk, Decimal("20.00")), (self.aberto.pk, Decimal("40.00"))]),
+        )
+        self.assertEqual(self.pago.pagamentos.count(), 1)
+        for pedido in (self.parcial, self.aberto):
+            pedido.refresh_from_db()
+            self.assertEqual(pedido.status_pagamento, "pago")
+            self.assertEqual(pedido.soma_pagamentos, pedido.total)
+            self.assertEqual(pedido.saldo, Decimal("0.00"))
+        self.assertEqual(vendas_diarias.diferencas(vendas_diarias.calcular(), vendas_diarias.atuais()), [])
+
+    def test_pontos_uma_vez_por_pedido(self):
+        resultado = self.quitar()
+
+        self.assertEqual(resultado[self.parcial.pk]["pontos"], 300)
+        self.assertEqual(resultado[self.aberto.pk]["pontos"], 400)
+        self.assertEqual(resultado[self.pago.pk]["pontos"], 0)
+        ganhos = MovimentacaoPontos.objects.filter(tipo="ganho")
+        self.assertEqual(ganhos.filter(pedido=self.pago).count(), 1)
+        self.assertEqual(ganhos.filter(pedido=self.parcial).count(), 1)
+        self.assertEqual(LotePontos.objects.filter(movimentacao__pedido=self.aberto).get().saldo, 400)
+        self.cliente.refresh_from_db()
+        self.assertEqual(self.cliente.pontos, self.pontos_antes + 700)
+
+        # repetir não paga nem pontua outra vez
+        resultado = self.quitar()
+
+        self.assertEqual({linha["estado"] for linha in resultado.values()}, {"sem_saldo", "inexistente"})
+        self.assertEqual(PagamentoPedido.objects.count(), 4)
+        self.assertEqual(ganhos.count(), 3)
+        self.cliente.refresh_from_db()
+        self.assertEqual(self.cliente.pontos, self.pontos_antes + 700)
+
+
+class PontosBase(DadosBase):
+
+    def lote(self, pontos, expira_em_dias):
+        """Ganho de `pontos` que expira daqui a `expira_em_dias` dias (negativo: já expirou)."""
+        movimentacao = self.cliente.creditar_pontos(pontos)
+        self.cliente.save(update_fields=["pontos"])
+        LotePontos.objects.filter(movimentacao=movimentacao).update(
+            expira_em=timezone.now() + timedelta(days=expira_em_dias),
+        )
+        return movimentacao.lote
+
+    def saldos(self, *lotes):
+        return [LotePontos.objects.get(pk=lote.pk).saldo for lote in lotes]
+
+
+class LotesPontosTests(PontosBase, TestCase):
+
+    def test_consumo_fifo_pelos_lotes_validos(self):
+        vencido = self.lote(500, -1)
+        tardio = self.lote(300, 60)
+        cedo = self.lote(200, 10)
+
+        self.assertEqual(self.cliente.consumir_pontos(250), 250)
+        self.assertEqual(self.saldos(vencido, cedo, tardio), [500, 0, 250])
+
+        # só há 250 válidos: não se consome do lote vencido
+        self.assertEqual(self.cliente.consumir_pontos(400), 250)
+        self.assertEqual(self.saldos(vencido, cedo, tardio), [500, 0, 0])
+
+    def test_ativos_e_a_expirar(self):
+        vencido = self.lote(500, -1)
+        valido = self.lote(300, 60)
+        gasto = self.lote(100, 10)
+        LotePontos.objects.filter(pk=gasto.pk).update(saldo=0)
+        LotePontos.objects.filter(pk=self.lote(40, -5).pk).update(saldo=0)
+
+        lotes = LotePontos.objects.filter(cliente=self.cliente)
+        self.assertEqual(list(lotes.ativos()), [valido])
+        self.assertEqual(list(lotes.a_expirar()), [vencido])
+        self.assertEqual(self.cliente.pontos_validos(), 300)
+        # num momento dado: daqui a 90 dias o lote válido também venceu
+        daqui_a_90 = timezone.now() + timedelta(days=90)
+        self.assertEqual(list(lotes.ativos(daqui_a_90)), [])
+        self.assertEqual(list(lotes.a_expirar(daqui_a_90)), [vencido, valido])
+
+    def test_migracao_reconstroi_lotes_do_historico(self):
+        outro = Cliente.objects.create(nome="Bruno", telefone="845000000")
+        inicio = timezone.now() - timedelta(days=200)
+
+        def movimento(cliente, tipo, pontos, dia):
+            mov = MovimentacaoPontos.objects.create(cliente=cliente, tipo=tipo, pontos=pontos)
+            MovimentacaoPontos.objects.filter(pk=mov.pk).update(criado_em=inicio + timedelta(days=dia))
+            return mov
+
+        a = movimento(self.cliente, "ganho", 100, 0)      # expira no dia 90
+        b = movimento(self.cliente, "ganho", 50, 10)      # expira no dia 100
+        movimento(self.cliente, "uso", -120, 20)          # a: 0, b: 30
+        c = movimento(self.cliente, "ganho", 40, 50)      # expira no dia 140
+        movimento(self.cliente, "uso", -10, 95)           # a já venceu: b: 20
+        movimento(self.cliente, "expiracao", -20, 101)    # b venceu: b: 0
+        d = movimento(outro, "ganho", 70, 5)
+        movimento(outro, "uso", -30, 6)
+
+        migracao = importlib.import_module("core.migrations.0011_lotepontos")
+        migracao.criar_lotes(apps, None)
+
+        lotes = {lote.movimentacao_id: lote for lote in LotePontos.objects.all()}
+        self.assertEqual(set(lotes), {a.pk, b.pk, c.pk, d.pk})
+        self.assertEqual([lotes[m.pk].saldo for m in (a, b, c, d)], [0, 0, 40, 40])
+        self.assertEqual(lotes[b.pk].expira_em, inicio + timedelta(days=100))
+        self.assertEqual(lotes[d.pk].cliente_id, outro.pk)
+
+
+class ExpirarPontosTests(PontosBase, TestCase):
+
+    def setUp(self):
+        self.vencido = self.lote(500, -1)
+        self.valido = self.lote(300, 60)
+        self.outro = Cliente.objects.create(nome="Bruno", telefone="845000000")
+        self.outro.creditar_pontos(80)
+        self.outro.save(update_fields=["pontos"])
+
+    def test_expira_os_lotes_vencidos(self):
+        agora = timezone.now()
+
+        self.assertEqual(expirar_pontos_clientes([self.cliente.pk, self.outro.pk], agora), {self.cliente.pk: 500})
+
+        self.assertEqual(self.saldos(self.vencido, self.valido), [0, 300])
+        self.cliente.refresh_from_db()
+        self.assertEqual(self.cliente.pontos, 300)
+        expiracao = MovimentacaoPontos.objects.get(tipo="expiracao")
+        self.assertEqual((expiracao.cliente_id, expiracao.pontos), (self.cliente.pk, -500))
+        self.assertEqual(Cliente.objects.get(pk=self.outro.pk).pontos, 80)
+
+    def test_comando_duas_vezes(self):
+        saida = StringIO()
+        call_command("expirar_pontos", "--dry-run", stdout=saida)
+        self.assertIn("1 cliente(s), 1 lote(s), 500 pontos a expirar", saida.getvalue())
+        self.assertFalse(MovimentacaoPontos.objects.filter(tipo="expiracao").exists())
+
+        call_command("expirar_pontos", stdout=StringIO())
+        estado = (
+            list(LotePontos.objects.order_by("pk").values_list("saldo", flat=True)),
+            list(Cliente.objects.order_by("pk").values_list("pontos", flat=True)),
+            MovimentacaoPontos.objects.count(),
+        )
+
+        saida = StringIO()
+        call_command("expirar_pontos", stdout=saida)
+
+        self.assertIn("0 cliente(s), 0 lote(s), 0 pontos a expirar", saida.getvalue())
+        self.assertEqual(estado, (
+            list(LotePontos.objects.order_by("pk").values_list("saldo", flat=True)),
+            list(Cliente.objects.order_by("pk").values_list("pontos", flat=True)),
+            MovimentacaoPontos.objects.count(),
+        ))
+        self.assertEqual(MovimentacaoPontos.objects.filter(tipo="expiracao").count(), 1)
+
+
+class TarefasTests(TestCase):
+
+    def nova(self, **campos):
+        return TarefaRelatorio.objects.create(tipo="vendas", **campos)
+
+    def parada(self, tentativas):
+        """Tarefa "em curso" sem actualizações há uma hora (worker parado a meio)."""
+        tarefa = self.nova(estado="em_curso", tentativas=tentativas)
+        TarefaRelatorio.objects.filter(pk=tarefa.pk).update(atualizado_em=timezone.now() - timedelta(hours=1))
+        return tarefa
+
+    def test_reservar_pela_ordem_de_criacao(self):
+        primeira, segunda = self.nova(), self.nova()
+        self.nova(estado="concluido")
+
+        self.assertEqual(tarefas.reservar().pk, primeira.pk)
+        self.assertEqual(tarefas.reservar().pk, segunda.pk)
+        self.assertIsNone(tarefas.reservar())
+
+        primeira.refresh_from_db()
+        self.assertEqual((primeira.estado, primeira.tentativas), ("em_curso", 1))
+        self.assertIsNotNone(primeira.iniciado_em)
+
+    def test_tarefa_parada_volta_a_fila(self):
+        tarefa = self.parada(tentativas=1)
+        recente = self.nova(estado="em_curso", tentativas=1)
+
+        self.assertEqual(tarefas.recuperar_tarefas_paradas(), (1, 0))
+        tarefa.refresh_from_db()
+        recente.refresh_from_db()
+        self.assertEqual(tarefa.estado, "pendente")
+        self.assertEqual(recente.estado, "em_curso")
+
+        self.assertEqual(tarefas.reservar().pk, tarefa.pk)
+        tarefa.refresh_from_db()
+        self.assertEqual(tarefa.tentativas, 2)
+
+    def test_tarefa_parada_passa_a_erro_depois_das_tentativas(self):
+        tarefa = self.parada(tentativas=tarefas.MAX_TENTATIVAS)
+
+        self.assertEqual(tarefas.recuperar_tarefas_paradas(), (0, 1))
+        tarefa.refresh_from_db()
+        self.assertEqual(tarefa.estado, "erro")
+        self.assertIsNotNone(tarefa.concluido_em)
+        self.assertIsNone(tarefas.reservar())
+
+    def test_excecao_do_gerador_grava_erro(self):
+        tarefa = self.nova()
+
+        def falhar(parametros, progresso):
+            raise ValueError("sem dados")
+
+        with mock.patch.dict(tarefas.GERADORES, {"vendas": falhar}), self.assertLogs("core.tarefas", "ERROR"):
+            tarefas.executar(tarefas.reservar())
+
+        tarefa.refresh_from_db()
+        self.assertEqual((tarefa.estado, tarefa.mensagem), ("erro", "sem dados"))
+        self.assertIsNotNone(tarefa.concluido_em)
+        self.assertIsNone(tarefa.conteudo)
+
+    def test_execucao_grava_o_ficheiro(self):
+        tarefa = self.nova()
+
+        with mock.patch.dict(tarefas.GERADORES, {"vendas": lambda parametros, progresso: ("r.pdf", b"%PDF-1.4")}):
+            tarefas.executar(tarefas.reservar())
+
+        tarefa.refresh_from_db()
+        self.assertEqual((tarefa.estado, tarefa.progresso, tarefa.nome_ficheiro), ("concluido", 100, "r.pdf"))
+        self.assertEqual((bytes(tarefa.conteudo), tarefa.tamanho), (b"%PDF-1.4", 8))
+
+
+class ExportacaoTests(DadosBase, TestCase):
+
+    def setUp(self):
+        obter_catalogo(forcar=True)
+        # totais 60, 20 e 110, criados por esta ordem
+        self.pedidos = [self.pedido_com_itens(0, 0, 2), self.pedido_com_itens(2), self.pedido_com_itens(1, 5)]
+
+    def test_csv_pela_ordem_da_lista_do_admin(self):
+        queryset = Pedido.objects.order_by("-total")  # ordenado pela coluna "total" na lista
+        resposta = exportar_vendas_csv(None, RequestFactory().get("/"), queryset)
+
+        self.assertTrue(resposta.streaming)
+        conteudo = b"".join(resposta.streaming_content).decode("utf-8")
+        self.assertTrue(conteudo.startswith("\ufeff"))
+        self.assertIn('filename="vendas_', resposta["Content-Disposition"])
+
+        cabecalho, *linhas = csv.reader(StringIO(conteudo[1:]))
+        self.assertEqual(cabecalho, exportacao.CABECALHO_VENDAS)
+        grande, pequeno, medio = self.pedidos[2], self.pedidos[1], self.pedidos[0]
+        self.assertEqual(
+            [(int(linha[0]), linha[4], linha[6]) for linha in linhas],
+            [(grande.pk, "Camisa", "1"), (grande.pk, "Calça", "5"), (medio.pk, "Fato", "2"), (pequeno.pk, "Camisa", "2")],
+        )
+        self.assertEqual(linhas[0][2:4], ["Ana", "Lavandaria Central"])
+
+    def test_xlsx_do_relatorio_de_vendas(self):
+        progresso = mock.Mock(acompanhar=lambda iteravel, total: iteravel)
+        parametros = {
+            "pedido_ids": [pedido.pk for pedido in self.pedidos], "ordem": ["criado_em"],
+            "start_date": "01/01/2025", "end_date": "31/01/2025", "formato": "xlsx",
+        }
+        nome, conteudo = tarefas.GERADORES["vendas"](parametros, progresso)
+
+        self.assertEqual(nome, "relatorio_vendas_01-01-2025_a_31-01-2025.xlsx")
+        livro = load_workbook(BytesIO(conteudo), read_only=True)
+        self.assertEqual(livro.sheetnames, ["Vendas"])
+        cabecalho, *linhas = livro["Vendas"].iter_rows(values_only=True)
+        self.assertEqual(list(cabecalho), exportacao.CABECALHO_VENDAS)
+        self.assertEqual(
+            [(linha[0], linha[4], linha[6], Decimal(str(linha[7]))) for linha in linhas],
+            [
+                (self.pedidos[0].pk, "Fato", 2, Decimal("60")),
+                (self.pedidos[1].pk, "Camisa", 2, Decimal("20")),
+                (self.pedidos[2].pk, "Camisa", 1, Decimal("10")),
+                (self.pedidos[2].pk, "Calça", 5, Decimal("100")),
+            ],
+        )
+        self.assertIsInstance(linhas[0][1], datetime)
+
+
+class RelatorioVendasTests(DadosBase, TestCase):
+
+    def setUp(self):
+        obter_catalogo(forcar=True)
+
+    def parametros(self, pedidos):
+        return {
+            "pedido_ids": [pedido.pk for pedido in pedidos], "ordem": ["-criado_em"],
+            "start_date": "01/01/2025", "end_date": "31/01/2025",
+        }
+
+    def test_quantidades_agregadas_batem_com_os_itens(self):
+        pedidos = [self.pedido_com_itens(1, 2, 3), self.pedido_com_itens(4), self.pedido_com_itens(0, 0, 7), self.novo_pedido()]
+        por_item = {pedido.pk: sum(pedido.itens.values_list("quantidade", flat=True)) for pedido in pedidos}
+        queryset = Pedido.objects.filter(pk__in=por_item).order_by("-criado_em")
+
+        # pedidos + itens (prefetch) + total, seja qual for o número de pedidos
+        with self.assertNumQueries(3):
+            linhas = list(pedidos_vendas(queryset))
+            total = quantidade_total(queryset)
+            for pedido in linhas:
+                self.assertEqual(sum(item.quantidade for item in pedido.itens.all()), pedido.quantidade_itens)
+                pedido.cliente.nome
+
+        self.assertEqual({pedido.pk: pedido.quantidade_itens for pedido in linhas}, por_item)
+        self.assertEqual([pedido.pk for pedido in linhas], [pedido.pk for pedido in reversed(pedidos)])
+        self.assertEqual(total, 17)
+        self.assertEqual(quantidade_total(Pedido.objects.none()), 0)
+
+    def test_consultas_do_pdf_nao_dependem_dos_pedidos(self):
+        progresso = mock.Mock(acompanhar=lambda iteravel, total: iteravel)
+        poucos = [self.pedido_com_itens(1, 1) for _ in range(2)]
+        muitos = [self.pedido_com_itens(2, 1, 1) for _ in range(12)]
+
+        for pedidos in (poucos, muitos):
+            # total + pedidos + itens (um bloco do iterator)
+            with self.assertNumQueries(3):
+                nome, conteudo = tarefas.GERADORES["vendas"](self.parametros(pedidos), progresso)
+            self.assertTrue(conteudo.startswith(b"%PDF"))
+        self.assertEqual(nome, "relatorio_vendas_01-01-2025_a_31-01-2025.pdf")
+
+
+class VendasDiariasTests(DadosBase, TestCase):
+
+    def test_apagar_lavandaria_com_pedidos(self):
+        outra = Lavandaria.objects.create(nome="Lavandaria Norte", endereco="Av. Kenneth Kaunda", telefone="843000000")
+        pedido = self.pedido_com_itens(1, 2)
+        Pedido.objects.create(cliente=self.cliente, lavandaria=outra)
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.registrar_pagamento(valor=Decimal("50.00"), metodo_pagamento="numerario")
+        self.assertTrue(VendaDiaria.objects.filter(lavandaria=self.lavandaria).exists())
+
+        self.lavandaria.delete()
+        connection.check_constraints()
+
+        self.assertFalse(Pedido.objects.filter(pk=pedido.pk).exists())
+        self.assertFalse(VendaDiaria.objects.filter(lavandaria_id=pedido.lavandaria_id).exists())
+        self.assertTrue(VendaDiaria.objects.filter(lavandaria=outra).exists())
+
+    def test_migracao_preenche_o_historico(self):
+        pedido = self.pedido_com_itens(1, 2)
+        self.pedido_com_itens(0, 0, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.registrar_pagamento(valor=Decimal("50.00"), metodo_pagamento="numerario")
+        antes = vendas_diarias.atuais()
+        VendaDiaria.objects.all().delete()
+
+        migracao = importlib.import_module("core.migrations.0021_preencher_vendas_diarias")
+        with redirect_stdout(StringIO()):
+            migracao.preencher(apps, None)
+
+        self.assertEqual(vendas_diarias.atuais(), antes)
+        self.assertEqual(vendas_diarias.diferencas(vendas_diarias.calcular(), antes), [])
+
+
+class GruposFuncionariosTests(DadosBase, TestCase):
+
+    def novo_funcionario(self, username, grupo):
+        user = User.objects.create_user(username, password="x")
+        return Funcionario.objects.create(user=user, lavandaria=self.lavandaria, grupo=grupo)
+
+    def test_grupo_apagado_volta_a_ser_criado(self):
+        self.novo_funcionario("caixa1", "caixa")
+        Group.objects.filter(name="caixa").delete()
+
+        funcionario = self.novo_funcionario("caixa2", "caixa")
+
+        grupo = Group.objects.get(name="caixa")
+        self.assertEqual(list(funcionario.user.groups.all()), [grupo])
+        self.assertTrue(grupo.permissions.filter(codename="add_pedido").exists())
+
+
+class FuncionarioMiddlewareTests(DadosBase, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        user = User.objects.create_user("gerente", password="x")
+        cls.funcionario = Funcionario.objects.create(user=user, lavandaria=cls.lavandaria, grupo="gerente")
+
+    def request(self, user):
+        request = RequestFactory().get("/")
+        request.user = user
+        FuncionarioMiddleware(lambda r: None)(request)
+        return request
+
+    def test_funcionario_lido_uma_vez_por_request(self):
+        request = self.request(User.objects.get(pk=self.funcionario.user_id))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(obter_funcionario(request), self.funcionario)
+            self.assertEqual(request.funcionario.pk, self.funcionario.pk)
+            self.assertEqual(request.lavandaria.nome, "Lavandaria Central")
+            self.assertEqual(obter_funcionario(request).user.username, "gerente")
+
+    def test_utilizador_que_nao_e_funcionario(self):
+        request = self.request(User.objects.create_superuser("admin", password="x"))
+
+        with self.assertNumQueries(1):
+            for _ in range(2):
+                with self.assertRaises(Funcionario.DoesNotExist):
+                    obter_funcionario(request)
+            self.assertFalse(request.funcionario)
+            self.assertFalse(request.lavandaria)
+
+    def test_changelist_dos_pedidos_le_o_funcionario_uma_vez(self):
+        self.pedido_com_itens(1)
+        self.client.force_login(self.funcionario.user)
+
+        with CaptureQueriesContext(connection) as consultas:
+            resposta = self.client.get(reverse("admin:core_pedido_changelist"))
+
+        self.assertEqual(resposta.status_code, 200)
+        # o filtro lateral por funcionário faz a sua própria consulta; esta é a do utilizador
+        por_utilizador = [q for q in consultas.captured_queries if 'WHERE "core_funcionario"."user_id"' in q["sql"]]
+        self.assertEqual(len(por_utilizador), 1)
+
+
+class CatalogoTests(DadosBase, TestCase):
+
+    def setUp(self):
+        obter_catalogo(forcar=True)
+
+    def test_artigo_inexistente_nao_recarrega_o_catalogo(self):
+        # uma verificação da versão, que não mudou: nada é recarregado
+        with self.assertNumQueries(1):
+            self.assertIsNone(obter_artigo(999999))
+        with self.assertNumQueries(0):
+            self.assertIsNone(obter_artigo(999999))
+            self.assertIsNone(obter_artigo(999999))
+        with self.assertNumQueries(0):
+            self.assertEqual(obter_artigo(self.artigos[0].pk).preco_base, Decimal("10.00"))
+
+    def test_artigo_criado_noutro_worker(self):
+        # bulk_create não envia post_save: é como se viesse de outro processo
+        novo, = ItemServico.objects.bulk_create([ItemServico(nome="Edredão", preco_base=Decimal("150.00"))])
+        VersaoDados.incrementar(CHAVE_VERSAO)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(obter_artigo(novo.pk).nome, "Edredão")
+
+    def test_artigo_apagado_sai_do_catalogo(self):
+        artigo = ItemServico.objects.create(nome="Cortina", preco_base=Decimal("80.00"))
+        self.assertIsNotNone(obter_artigo(artigo.pk))
+        artigo.delete()
+
+        self.assertIsNone(obter_artigo(artigo.pk))
+        with self.assertNumQueries(0):
+            self.assertIsNone(obter_artigo(artigo.pk))
+
+
+class ReciboTests(DadosBase, TestCase):
+
+    def setUp(self):
+        obter_catalogo(forcar=True)
+
+    def test_consultas_do_contexto_nao_dependem_do_tamanho(self):
+        pequeno = self.pedido_com_itens(1)
+        grande = self.pedido_com_itens(5, 4, 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            for valor in ("10.00", "20.00", "30.00"):
+                grande.registrar_pagamento(valor=Decimal(valor), metodo_pagamento="mpesa")
+            pequeno.registrar_pagamento(valor=Decimal("10.00"), metodo_pagamento="numerario")
+        for _ in range(4):
+            self.pedido_com_itens(1, 1)
+
+        for pedido in (pequeno, grande):
+            with self.assertNumQueries(CONSULTAS_RECIBO):
+                dados = ReciboContexto(pedido.pk).dados()
+            self.assertEqual(len(dados["pedidos_nao_pagos"]), 3)
+
+        dados = ReciboContexto(grande.pk).dados()
+        self.assertEqual(dados["valor_pago"], Decimal("60.00"))
+        self.assertEqual(dados["saldo"], Decimal("160.00"))
+        self.assertEqual(dados["pontos_ganhos"], 0)
+        self.assertEqual(ReciboContexto(pequeno.pk).dados()["pontos_ganhos"], 100)
+
+    def test_texto_do_recibo(self):
+        pedido = self.pedido_com_itens(2, 0, 1)
+        with self.assertNumQueries(CONSULTAS_RECIBO):
+            texto = texto_recibo(pedido.pk)
+        self.assertIn(f"{pedido.pk}", texto)
+        self.assertIn("Camisa", texto)
+
+    def test_versao_muda_com_o_que_o_recibo_imprime(self):
+        pedido = self.pedido_com_itens(1)
+        chaves = [chave_recibo(pedido.pk)]
+
+        def mudou():
+            chaves.append(chave_recibo(pedido.pk))
+            self.assertNotIn(chaves[-1], chaves[:-1])
+
+        self.assertEqual(chave_recibo(pedido.pk), chaves[0])
+
+        with self.no_commit():
+            pedido.adicionar_itens([{"item_de_servico": self.artigos[1], "quantidade": 1}])
+        mudou()
+
+        with self.no_commit():
+            pedido.registrar_pagamento(valor=Decimal("5.00"), metodo_pagamento="numerario")
+        mudou()
+
+        Cliente.objects.filter(pk=self.cliente.pk).update(pontos=F("pontos") + 10)
+        mudou()
+
+        artigo = self.artigos[2]
+        artigo.preco_base = Decimal("35.00")
+        artigo.save()
+        mudou()
+
+        # outro pedido em aberto do mesmo cliente também aparece no recibo
+        self.pedido_com_itens(0, 1)
+        mudou()
+
+        self.assertIsNone(chave_recibo(999999))
+
+    def test_get_condicional(self):
+        pedido = self.pedido_com_itens(1)
+        url = reverse("core:recibo_imagem_png", args=[pedido.pk])
+
+        resposta = self.client.get(url)
+        self.assertEqual(resposta.status_code, 200)
+        etag = resposta["ETag"]
+        self.assertEqual(etag, f'"{chave_recibo(pedido.pk)}"')
+
+        # nada mudou: 304 sem gerar o recibo
+        with mock.patch("core.views.recibo_png") as gerar:
+            resposta = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 304)
+        self.assertEqual(resposta["ETag"], etag)
+        gerar.assert_not_called()
+
+        with self.no_commit():
+            pedido.registrar_pagamento(valor=Decimal("10.00"), metodo_pagamento="mpesa")
+        resposta = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertNotEqual(resposta["ETag"], etag)
+
+        self.assertEqual(self.client.get(reverse("core:recibo_imagem_png", args=[999999])).status_code, 404)
+
+
+class CacheRecibosTests(TestCase):
+
+    def test_lru_limitada_em_bytes(self):
+        cache = CacheRecibos(max_bytes=10)
+        cache.guardar("a", b"1234")
+        cache.guardar("b", b"1234")
+        self.assertEqual(cache.obter("a"), b"1234")  # "a" passa a ser o mais recente
+
+        cache.guardar("c", b"1234")
+        self.assertIsNone(cache.obter("b"))
+        self.assertEqual(cache.obter("a"), b"1234")
+        self.assertEqual(cache.obter("c"), b"1234")
+
+        # maior do que o limite: não fica, e não expulsa nada
+        cache.guardar("d", b"x" * 11)
+        self.assertIsNone(cache.obter("d"))
+        self.assertEqual(cache.obter("a"), b"1234")
+
+        cache.limpar()
+        self.assertIsNone(cache.obter("a"))
+
+
+class FormatosReciboTests(DadosBase, TestCase):
+
+    def setUp(self):
+        obter_catalogo(forcar=True)
+        cache_recibos.limpar()
+        self.pedido = self.pedido_com_itens(2, 0, 1)
+
+    def test_escpos(self):
+        dados = recibo_escpos(self.pedido.pk)
+        self.assertTrue(dados.startswith(escpos.INICIALIZAR))
+        self.assertTrue(dados.endswith(escpos.CORTE_PARCIAL))
+        self.assertIn(b"Camisa", dados)
+
+    def test_png_de_1_bit(self):
+        imagem = Image.open(BytesIO(recibo_png(self.pedido.pk)))
+        self.assertEqual((imagem.format, imagem.mode, imagem.width), ("PNG", "1", LARGURA_RECIBO))
+
+    def test_pbm(self):
+        dados = recibo_pbm(self.pedido.pk)
+        self.assertTrue(dados.startswith(b"P4\n"))
+        imagem = Image.open(BytesIO(dados))
+        self.assertEqual((imagem.mode, imagem.width), ("1", LARGURA_RECIBO))
+        # bitmap bruto, sem compressão: 1 bit por ponto depois do cabeçalho
+        cabecalho = f"P4\n{imagem.width} {imagem.height}\n".encode()
+        self.assertEqual(len(dados), len(cabecalho) + imagem.height * LARGURA_RECIBO // 8)
+
+    def test_pdf(self):
+        dados = recibo_pdf(self.pedido.pk)
+        self.assertTrue(dados.startswith(b"%PDF"))
+        self.assertTrue(dados.rstrip().endswith(b"%%EOF"))
+
+        resposta = self.client.get(reverse("core:recibo_pdf", args=[self.pedido.pk]))
+        self.assertEqual(resposta["Content-Type"], "application/pdf")
+        self.assertEqual(resposta.content, dados)  # da cache: o pedido não mudou
+
+    @override_settings(RECIBO_PROCESSOS=0)
+    def test_recibos_em_lote_sem_pool(self):
+        outro = self.pedido_com_itens(0, 3)
+        ids = [outro.pk, 999999, self.pedido.pk]
+
+        with mock.patch("core.recibos.ProcessPoolExecutor") as pool:
+            recibos = list(recibos_png_em_lote(ids, lote=2))
+        pool.assert_not_called()
+        self.assertEqual([pedido_id for pedido_id, _ in recibos], [outro.pk, self.pedido.pk])
+        for _, png in recibos:
+            self.assertEqual(Image.open(BytesIO(png)).mode, "1")
+        self.assertEqual(recibos[1][1], recibo_png(self.pedido.pk))
+
+        # segunda impressão: tudo da cache, nada é desenhado
+        with mock.patch("core.recibos.desenhar_recibo") as desenhar:
+            self.assertEqual(list(recibos_png_em_lote(ids)), recibos)
+        desenhar.assert_not_called()
+
+
+@skipUnless(connection.vendor == "postgresql", "os planos verificados são os do PostgreSQL")
+class PlanosConsultasTests(TestCase):
+    """
+    Com um ano de movimento (a maior parte já entregue e paga) e estatísticas
+    atualizadas, o planeador escolhe para cada consulta de consultas_quentes()
+    o índice previsto, sem desligar o seqscan.
+    """
+
+    PEDIDOS = 10000
+    # peso de cada lavandaria no movimento: uma sede e filiais mais pequenas
+    PESOS_LAVANDARIAS = [40, 25, 15, 10, 5, 3, 1, 1]
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(6)
+        agora = timezone.now()
+        passo = timedelta(days=365) / cls.PEDIDOS
+        lavandarias = Lavandaria.objects.bulk_create([
+            Lavandaria(nome=f"Lavandaria {i}", endereco="Maputo", telefone=f"8410000{i:02}")
+            for i in range(len(cls.PESOS_LAVANDARIAS))
+        ])
+        clientes = Cliente.objects.bulk_create([
+            Cliente(nome=f"Cliente {i}", telefone=f"842{i:06}") for i in range(400)
+        ])
+
+        pedidos = []
+        for i in range(cls.PEDIDOS):
+            # a última semana ainda está em curso; o resto está quase todo entregue e pago
+            if passo * (cls.PEDIDOS - i) < timedelta(days=7):
+                status = rnd.choice(["pendente", "completo", "pronto", "entregue"])
+                status_pagamento = rnd.choices(["pago", "parcial", "nao_pago"], [60, 15, 25])[0]
+            else:
+                status = rnd.choices(["entregue", "pronto"], [98, 2])[0]
+                status_pagamento = rnd.choices(["pago", "parcial", "nao_pago"], [97, 1, 2])[0]
+            pago = status_pagamento == "pago"
+            pedidos.append(Pedido(
+                cliente=rnd.choice(clientes), lavandaria=rnd.choices(lavandarias, cls.PESOS_LAVANDARIAS)[0], status=status,
+                status_pagamento=status_pagamento, pago=pago, total=Decimal("300.00"),
+                total_pago=Decimal("300.00") if pago else Decimal("0.00"),
+            ))
+        pedidos = Pedido.objects.bulk_create(pedidos, batch_size=2000)
+
+        # criado_em é auto_now_add: um pedido a cada `passo`, o último agora
+        ultimo = pedidos[-1].pk
+        Pedido.objects.update(criado_em=ExpressionWrapper(
+            Value(agora) - (Value(ultimo) - F("pk")) * Value(passo), output_field=models.DateTimeField(),
+        ))
+        criados = dict(Pedido.objects.values_list("pk", "criado_em"))
+
+        pagamentos, movimentacoes = [], []
+        for pedido in pedidos:
+            if pedido.status_pagamento != "nao_pago":
+                pagamentos.append(PagamentoPedido(
+                    pedido=pedido, valor=Decimal("300.00"), metodo_pagamento="numerario",
+                    pago_em=criados[pedido.pk] + timedelta(hours=2),
+                ))
+            if pedido.pago:
+                movimentacoes.append(MovimentacaoPontos(cliente_id=pedido.cliente_id, pedido=pedido, tipo="ganho", pontos=3000))
+                if rnd.random() < 0.1:
+                    movimentacoes.append(MovimentacaoPontos(cliente_id=pedido.cliente_id, pedido=pedido, tipo="uso", pontos=-500))
+        PagamentoPedido.objects.bulk_create(pagamentos, batch_size=2000)
+        movimentacoes = MovimentacaoPontos.objects.bulk_create(movimentacoes, batch_size=2000)
+        MovimentacaoPontos.objects.update(
+            criado_em=Subquery(Pedido.objects.filter(pk=OuterRef("pedido_id")).values("criado_em")[:1]),
+        )
+        LotePontos.objects.bulk_create([
+            LotePontos(
+                cliente_id=m.cliente_id, movimentacao=m, pontos=3000, criado_em=criados[m.pedido_id],
+                expira_em=criados[m.pedido_id] + timedelta(days=90),
+                saldo=3000 if criados[m.pedido_id] + timedelta(days=90) > agora else 0,
+            )
+            for m in movimentacoes if m.tipo == "ganho"
+        ], batch_size=2000)
+
+        with connection.cursor() as cursor:
+            for tabela in ("core_pedido", "core_pagamentopedido", "core_movimentacaopontos", "core_lotepontos"):
+                cursor.execute(f"ANALYZE {tabela}")
+
+        # na sede, os últimos 100 pedidos estão quase todos no fim de
+        # pedido_criado_idx e o PostgreSQL percorre-o filtrando a lavandaria;
+        # numa filial pequena só pedido_lav_criado_idx evita ler o ano inteiro
+        cls.ids = {
+            "lavandaria_id": lavandarias[-1].pk,
+            "cliente_id": clientes[0].pk,
+            "pedido_id": next(pedido.pk for pedido in reversed(pedidos) if pedido.pago),
+        }
+
+    def test_consultas_usam_o_indice_previsto(self):
+        for nome, (indice, queryset) in consultas_quentes(**self.ids).items():
+            with self.subTest(nome):
+                self.assertIn(indice, queryset.explain())
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class PagamentoConcorrenteTests(DadosBase, TransactionTestCase):
+
+    def setUp(self):
+        self.setUpTestData()
+
+    def test_dois_pagamentos_do_saldo_todo(self):
+        pedido = self.pedido_com_itens(0, 0, 10)
+        self.assertEqual(pedido.saldo, Decimal("300.00"))
+
+        barreira = threading.Barrier(2)
+        resultados = []
+        recalcular = Pedido.recalcular_pagamentos
+
+        def recalcular_devagar(instancia):
+            # alarga a janela entre o commit de um pagamento e o recálculo
+            time.sleep(0.3)
+            return recalcular(instancia)
+
+        def pagar():
+            try:
+                barreira.wait()
+                Pedido.objects.get(pk=pedido.pk).registrar_pagamento(
+                    valor=Decimal("300.00"), metodo_pagamento="numerario",
+                )
+                resultados.append("pago")
+            except ValidationError:
+                resultados.append("recusado")
+            finally:
+                connection.close()
+
+        with mock.patch.object(Pedido, "recalcular_pagamentos", recalcular_devagar):
+            threads = [threading.Thread(target=pagar) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sorted(resultados), ["pago", "recusado"])
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.pagamentos.count(), 1)
+        self.assertEqual(pedido.soma_pagamentos, Decimal("300.00"))
+        self.assertEqual(pedido.total_pago, Decimal("300.00"))
+        self.assertEqual(pedido.status_pagamento, "pago")
+
+    def test_pagamentos_simultaneos_na_mesma_venda_diaria(self):
+        # todos somam à mesma linha (lavandaria, hoje, numerário, sem funcionário)
+        pedidos = [self.pedido_com_itens(1) for _ in range(8)]
+        barreira = threading.Barrier(len(pedidos))
+        erros = []
+
+        def pagar(pedido_id):
+            try:
+                barreira.wait()
+                Pedido.objects.get(pk=pedido_id).registrar_pagamento(
+                    valor=Decimal("10.00"), metodo_pagamento="numerario",
+                )
+            except Exception as e:
+                erros.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=pagar, args=(pedido.pk,)) for pedido in pedidos]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(erros, [])
+        atual = vendas_diarias.atuais()
+        self.assertEqual(vendas_diarias.diferencas(vendas_diarias.calcular(), atual), [])
+        self.assertEqual(sum(linha["valor_recebido"] for linha in atual.values()), Decimal("80.00"))
+        self.assertEqual(sum(linha["pedidos_pagos"] for linha in atual.values()), 8)
+
+    def correr(self, alvos):
+        """Uma thread por pedido_id em `alvos`, todas a pagar 10.00 com a chave "MP123"; {thread: pk ou erro}."""
+        barreira = threading.Barrier(len(alvos))
+        resultados = {}
+
+        def pagar(i, pedido_id):
+            try:
+                barreira.wait()
+                resultados[i] = Pedido.objects.get(pk=pedido_id).registrar_pagamento(
+                    valor=Decimal("10.00"), metodo_pagamento="mpesa", chave_idempotencia="MP123",
+                ).pk
+            except Exception as e:
+                resultados[i] = e
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=pagar, args=(i, pedido_id)) for i, pedido_id in enumerate(alvos)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return resultados
+
+    def test_muitas_threads_repetem_a_mesma_chave(self):
+        pedido = self.pedido_com_itens(0, 0, 1)
+
+        resultados = self.correr([pedido.pk] * 12)
+
+        pagamentos = list(pedido.pagamentos.values_list("pk", flat=True))
+        self.assertEqual(len(pagamentos), 1)
+        self.assertEqual(set(resultados.values()), set(pagamentos))
+        pedido.refresh_from_db()
+        self.assertEqual(pedido.soma_pagamentos, Decimal("10.00"))
+
+    def test_muitas_threads_em_pedidos_diferentes(self):
+        # três pedidos, quatro repetições da chave em cada um
+        pedidos = [self.pedido_com_itens(0, 0, 1) for _ in range(3)]
+
+        resultados = self.correr([pedido.pk for pedido in pedidos] * 4)
+
+        self.assertFalse([r for r in resultados.values() if isinstance(r, Exception)])
+        self.assertEqual(len(set(resultados.values())), 3)
+        for pedido in pedidos:
+            pedido.refresh_from_db()
+            self.assertEqual(pedido.pagamentos.count(), 1)
+            self.assertEqual(pedido.soma_pagamentos, Decimal("10.00"))
+
+
+@skipUnlessDBFeature("has_select_for_update_skip_locked")
+class TarefasConcorrentesTests(TransactionTestCase):
+
+    def test_workers_nunca_reservam_a_mesma_tarefa(self):
+        TarefaRelatorio.objects.bulk_create([TarefaRelatorio(tipo="vendas") for _ in range(6)])
+        barreira = threading.Barrier(8)
+        reservadas = []
+        erros = []
+
+        def worker():
+            try:
+                barreira.wait()
+                while (tarefa := tarefas.reservar()) is not None:
+                    reservadas.append(tarefa.pk)
+            except Exception as e:
+                erros.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(erros, [])
+        self.assertEqual(sorted(reservadas), sorted(TarefaRelatorio.objects.values_list("pk", flat=True)))
+        self.assertEqual(set(TarefaRelatorio.objects.values_list("estado", "tentativas")), {("em_curso", 1)})
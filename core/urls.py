@@ -5,6 +5,11 @@ app_name = 'core'
 
 urlpatterns = [
     path('imprimir-recibo-imagem/<int:pedido_id>/', views.imprimir_recibo_imagem, name='imprimir_recibo_imagem'),
+    path('recibo/<int:pedido_id>.png', views.recibo_imagem_png, name='recibo_imagem_png'),
+    path('recibo/<int:pedido_id>.pbm', views.recibo_imagem_pbm, name='recibo_imagem_pbm'),
+    path('recibo/<int:pedido_id>.pdf', views.recibo_pdf_a4, name='recibo_pdf'),
+    path('imprimir-recibo-escpos/<int:pedido_id>/', views.imprimir_recibo_escpos, name='imprimir_recibo_escpos'),
+    path('pedidos/<int:pedido_id>/itens/', views.adicionar_itens_pedido, name='adicionar_itens_pedido'),
     path('meu-pedido/', views.meu_pedido, name='order-track'),
     path('meu-pedido/<int:pedido_id>', views.meu_pedido_details, name='order-details'),
 ]
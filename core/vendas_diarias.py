@@ -0,0 +1,373 @@
+"""
+Totais diários de vendas (VendaDiaria).
+
+Cada pedido conta no dia em que foi criado e cada pagamento no dia em que
+foi pago, por (lavandaria, dia, método de pagamento, funcionário); as
+linhas dos pedidos têm o método vazio. Quem grava um pedido ou pagamento
+soma a diferença (antes/depois) às linhas afectadas com UPDATE ... F(),
+na mesma transação; não há re-agregação a cada evento, pelo que o custo
+do dashboard e dos relatórios depende do número de dias e não de linhas.
+
+Como nos totais incrementais do pedido, o que não passa pelos modelos
+(UPDATE/DELETE em massa, SQL manual) pode deixar desvios: o comando
+`reconstruir_vendas_diarias` verifica e reconstrói a partir das tabelas.
+
+Os mesmos pontos de gravação dão nova versão aos dias já fechados dos
+relatórios guardados (core/relatorios_fechados.py).
+
+O UPDATE fica com a linha (lavandaria, dia, método, funcionário) bloqueada
+até ao commit: gravações da mesma chave ao mesmo tempo esperam umas pelas
+outras só o resto da transação (as chaves são sempre tomadas pela mesma
+ordem, sem deadlocks). A migração 0021 preenche a tabela com o histórico.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+# Campos do Pedido que entram nos totais (ver Pedido._valores_vendas)
+CAMPOS_PEDIDO = (
+    "lavandaria_id", "funcionario_id", "criado_em", "total", "desconto", "desconto_cabides", "status_pagamento",
+)
+
+MEDIDAS = (
+    "pedidos", "pedidos_pagos", "valor_pedidos", "valor_pedidos_pagos", "desconto", "desconto_cabides",
+    "pontos_ganhos", "pagamentos", "valor_recebido",
+)
+
+ZERO = Decimal("0.00")
+
+
+def dia_local(momento):
+    return timezone.localdate(momento)
+
+
+def intervalo_dias(dia_inicio, dia_fim):
+    """[início do primeiro dia, início do dia seguinte ao último[ no fuso local."""
+    inicio = timezone.make_aware(datetime.combine(dia_inicio, time.min))
+    fim = timezone.make_aware(datetime.combine(dia_fim + timedelta(days=1), time.min))
+    return inicio, fim
+
+
+def _chave_ordenacao(chave):
+    lavandaria_id, dia, metodo, funcionario_id = chave
+    return lavandaria_id, dia, metodo, funcionario_id or 0
+
+
+class Deltas:
+    """Diferenças acumuladas por chave, aplicadas de uma vez (chaves sempre pela mesma ordem)."""
+
+    def __init__(self):
+        self._por_chave = defaultdict(lambda: defaultdict(int))
+
+    def somar(self, lavandaria_id, dia, metodo, funcionario_id, **medidas):
+        linha = self._por_chave[(lavandaria_id, dia, metodo or "", funcionario_id)]
+        for medida, valor in medidas.items():
+            linha[medida] += valor
+
+    def pedido(self, valores, sinal):
+        """Contributo de um pedido (dict de CAMPOS_PEDIDO), a somar (1) ou tirar (-1)."""
+        total = valores["total"] or ZERO
+        pago = valores["status_pagamento"] == "pago"
+        self.somar(
+            valores["lavandaria_id"], dia_local(valores["criado_em"]), "", valores["funcionario_id"],
+            pedidos=sinal,
+            pedidos_pagos=sinal if pago else 0,
+            valor_pedidos=sinal * total,
+            valor_pedidos_pagos=sinal * total if pago else ZERO,
+            desconto=sinal * (valores["desconto"] or ZERO),
+            desconto_cabides=sinal * (valores["desconto_cabides"] or ZERO),
+        )
+
+    def pagamento(self, lavandaria_id, pago_em, metodo, funcionario_id, valor, sinal):
+        self.somar(
+            lavandaria_id, dia_local(pago_em), metodo, funcionario_id,
+            pagamentos=sinal, valor_recebido=sinal * (valor or ZERO),
+        )
+
+    def aplicar(self):
+        from .models import VendaDiaria
+
+        for chave in sorted(self._por_chave, key=_chave_ordenacao):
+            medidas = {medida: valor for medida, valor in self._por_chave[chave].items() if valor}
+            if not medidas:
+                continue
+            lavandaria_id, dia, metodo, funcionario_id = chave
+            linhas = VendaDiaria.objects.filter(
+                lavandaria_id=lavandaria_id, dia=dia, metodo_pagamento=metodo, funcionario_id=funcionario_id,
+            )
+            # a primeira linha da chave chega; se dois pedidos a criarem ao
+            # mesmo tempo ficam duas, e quem lê soma-as
+            atualizadas = linhas.filter(pk=linhas.order_by("pk").values("pk")[:1]).update(
+                **{medida: F(medida) + valor for medida, valor in medidas.items()}
+            )
+            if not atualizadas:
+                VendaDiaria.objects.create(
+                    lavandaria_id=lavandaria_id, dia=dia, metodo_pagamento=metodo,
+                    funcionario_id=funcionario_id, **medidas,
+                )
+        self._por_chave.clear()
+
+
+# ===== PEDIDOS =====
+
+def _completar(pedido_id, valores):
+    """Chave do pedido lida da base quando não estava carregada (only/defer)."""
+    if valores["lavandaria_id"] is not None and valores["criado_em"] is not None:
+        return valores
+    from .models import Pedido
+
+    da_base = Pedido.objects.filter(pk=pedido_id).values("lavandaria_id", "criado_em", "funcionario_id").get()
+    return {**valores, **{campo: valores[campo] if valores[campo] is not None else valor
+                          for campo, valor in da_base.items()}}
+
+
+def _chave_pedido(valores):
+    """Chave das linhas do pedido em VendaDiaria: (lavandaria, dia, método vazio, funcionário)."""
+    return valores["lavandaria_id"], dia_local(valores["criado_em"]), "", valores["funcionario_id"]
+
+
+def registar_pedido(pedido, novo=False, apagado=False, update_fields=None, deltas=None):
+    """
+    Soma aos totais a diferença entre o pedido como foi lido
+    (pedido._original_vendas) e como foi gravado, ou tira o pedido apagado.
+    Com `deltas`, só acumula (quem chama aplica); senão aplica já.
+    """
+    antes = None if novo else getattr(pedido, "_original_vendas", None)
+    if not novo and antes is None:
+        # instância sem valores originais (não veio da base): fica para a reconstrução
+        return
+    depois = None if apagado else pedido._valores_vendas()
+    if antes is not None and depois is not None and update_fields is not None:
+        gravados = set(update_fields)
+        depois = {
+            campo: valor if campo in gravados or campo.removesuffix("_id") in gravados else antes[campo]
+            for campo, valor in depois.items()
+        }
+    pedido._original_vendas = depois
+    if antes == depois:
+        return
+
+    aplicar = deltas is None
+    deltas = deltas or Deltas()
+    if antes is not None:
+        antes = _completar(pedido.pk, antes)
+        deltas.pedido(antes, -1)
+        if apagado and getattr(pedido, "_pontos_vendas", 0):
+            deltas.somar(*_chave_pedido(antes), pontos_ganhos=-pedido._pontos_vendas)
+    if depois is not None:
+        depois = _completar(pedido.pk, depois)
+        deltas.pedido(depois, 1)
+    if antes is not None and depois is not None and _chave_pedido(antes) != _chave_pedido(depois):
+        # os pontos ganhos (e os pagamentos, se mudou de lavandaria) vão com o pedido
+        pontos = pontos_do_pedido(pedido.pk)
+        if pontos:
+            deltas.somar(*_chave_pedido(antes), pontos_ganhos=-pontos)
+            deltas.somar(*_chave_pedido(depois), pontos_ganhos=pontos)
+        if depois["lavandaria_id"] != antes["lavandaria_id"]:
+            _mudar_lavandaria_pagamentos(pedido.pk, antes["lavandaria_id"], depois["lavandaria_id"], deltas)
+    if aplicar:
+        deltas.aplicar()
+
+
+def _mudar_lavandaria_pagamentos(pedido_id, de, para, deltas):
+    """Os pagamentos do pedido passam a contar na lavandaria `para`."""
+    from . import relatorios_fechados
+    from .models import PagamentoPedido
+
+    pagamentos = list(
+        PagamentoPedido.objects.filter(pedido_id=pedido_id).values_list(
+            "pago_em", "metodo_pagamento", "criado_por_id", "valor",
+        )
+    )
+    for pago_em, metodo, funcionario_id, valor in pagamentos:
+        deltas.pagamento(de, pago_em, metodo, funcionario_id, valor, -1)
+        deltas.pagamento(para, pago_em, metodo, funcionario_id, valor, 1)
+    for lavandaria_id in (de, para):
+        relatorios_fechados.invalidar(lavandaria_id, [pago_em for pago_em, *_ in pagamentos])
+
+
+def registar_delta_total(pedido, delta):
+    """Pedido.total mudou `delta` por UPDATE (sem save)."""
+    valores = _completar(pedido.pk, pedido._valores_vendas())
+    pago = valores["status_pagamento"] == "pago"
+    deltas = Deltas()
+    deltas.somar(*_chave_pedido(valores), valor_pedidos=delta, valor_pedidos_pagos=delta if pago else ZERO)
+    deltas.aplicar()
+    if getattr(pedido, "_original_vendas", None) is not None:
+        pedido._original_vendas["total"] = pedido.total
+
+
+def pontos_do_pedido(pedido_id):
+    from .models import MovimentacaoPontos
+
+    return MovimentacaoPontos.objects.filter(pedido_id=pedido_id, tipo="ganho").aggregate(
+        s=Sum("pontos")
+    )["s"] or 0
+
+
+def registar_pontos(pedido, pontos, deltas=None):
+    """Pontos de fidelidade ganhos com o pedido."""
+    valores = _completar(pedido.pk, pedido._valores_vendas())
+    aplicar = deltas is None
+    deltas = deltas or Deltas()
+    deltas.somar(*_chave_pedido(valores), pontos_ganhos=pontos)
+    if aplicar:
+        deltas.aplicar()
+
+
+# ===== PAGAMENTOS =====
+
+def _lavandaria_do_pedido(pedido_id):
+    from .models import Pedido
+
+    return Pedido.objects.filter(pk=pedido_id).values_list("lavandaria_id", flat=True).first()
+
+
+def registar_pagamento(pagamento, novo=False, apagado=False, deltas=None):
+    """
+    Soma aos totais o pagamento gravado (tirando o que era antes, se já
+    existia) ou tira o pagamento apagado.
+    """
+    antes = None if novo else getattr(pagamento, "_original_vendas", None)
+    if not novo and not apagado and antes is None:
+        # instância sem valores originais (não veio da base): fica para a reconstrução
+        return
+    depois = None if apagado else (
+        pagamento.pedido_id, pagamento.pago_em, pagamento.metodo_pagamento, pagamento.criado_por_id, pagamento.valor,
+    )
+    if apagado and antes is None:
+        antes = (pagamento.pedido_id, pagamento.pago_em, pagamento.metodo_pagamento,
+                 pagamento.criado_por_id, pagamento.valor)
+    pagamento._original_vendas = depois
+    if antes == depois:
+        return
+
+    aplicar = deltas is None
+    deltas = deltas or Deltas()
+    lavandarias = {}
+    momentos = defaultdict(list)
+    for valores, sinal in ((antes, -1), (depois, 1)):
+        if valores is None:
+            continue
+        pedido_id, pago_em, metodo, funcionario_id, valor = valores
+        if pedido_id not in lavandarias:
+            pedido = pagamento._state.fields_cache.get("pedido")
+            lavandarias[pedido_id] = (
+                pedido.lavandaria_id if pedido is not None and pedido.pk == pedido_id
+                else _lavandaria_do_pedido(pedido_id)
+            )
+        if lavandarias[pedido_id] is None:
+            continue
+        deltas.pagamento(lavandarias[pedido_id], pago_em, metodo, funcionario_id, valor, sinal)
+        momentos[lavandarias[pedido_id]].append(pago_em)
+    if aplicar:
+        deltas.aplicar()
+
+    from . import relatorios_fechados
+
+    for lavandaria_id, pagos_em in momentos.items():
+        relatorios_fechados.invalidar(lavandaria_id, pagos_em)
+
+
+# ===== RECONSTRUÇÃO =====
+
+def calcular(dia_inicio=None, dia_fim=None):
+    """
+    Totais a partir das tabelas, {chave: {medida: valor}}, para os dias
+    dados (todos por omissão). Três consultas agrupadas.
+    """
+    from .models import MovimentacaoPontos, PagamentoPedido, Pedido
+
+    pedidos = Pedido.objects.order_by()
+    pagamentos = PagamentoPedido.objects.order_by()
+    pontos = MovimentacaoPontos.objects.filter(tipo="ganho", pedido__isnull=False).order_by()
+    if dia_inicio is not None:
+        inicio, fim = intervalo_dias(dia_inicio, dia_fim)
+        pedidos = pedidos.filter(criado_em__gte=inicio, criado_em__lt=fim)
+        pagamentos = pagamentos.filter(pago_em__gte=inicio, pago_em__lt=fim)
+        pontos = pontos.filter(pedido__criado_em__gte=inicio, pedido__criado_em__lt=fim)
+
+    linhas = defaultdict(lambda: dict.fromkeys(MEDIDAS, 0))
+    pago = Q(status_pagamento="pago")
+    for row in (
+        pedidos.annotate(d=TruncDate("criado_em"))
+        .values("lavandaria_id", "d", "funcionario_id")
+        .annotate(
+            n=Count("id"), n_pagos=Count("id", filter=pago),
+            valor=Sum("total"), valor_pagos=Sum("total", filter=pago),
+            desc=Sum("desconto"), desc_cabides=Sum("desconto_cabides"),
+        )
+    ):
+        linhas[(row["lavandaria_id"], row["d"], "", row["funcionario_id"])].update(
+            pedidos=row["n"], pedidos_pagos=row["n_pagos"],
+            valor_pedidos=row["valor"] or ZERO, valor_pedidos_pagos=row["valor_pagos"] or ZERO,
+            desconto=row["desc"] or ZERO, desconto_cabides=row["desc_cabides"] or ZERO,
+        )
+    for row in (
+        pontos.annotate(d=TruncDate("pedido__criado_em"))
+        .values("pedido__lavandaria_id", "d", "pedido__funcionario_id")
+        .annotate(p=Sum("pontos"))
+    ):
+        linhas[(row["pedido__lavandaria_id"], row["d"], "", row["pedido__funcionario_id"])]["pontos_ganhos"] = row["p"] or 0
+    for row in (
+        pagamentos.annotate(d=TruncDate("pago_em"))
+        .values("pedido__lavandaria_id", "d", "metodo_pagamento", "criado_por_id")
+        .annotate(n=Count("id"), valor=Sum("valor"))
+    ):
+        linhas[(row["pedido__lavandaria_id"], row["d"], row["metodo_pagamento"], row["criado_por_id"])].update(
+            pagamentos=row["n"], valor_recebido=row["valor"] or ZERO,
+        )
+    return dict(linhas)
+
+
+def atuais(dia_inicio=None, dia_fim=None):
+    """O que está em VendaDiaria, somado por chave (no mesmo formato de calcular())."""
+    from .models import VendaDiaria
+
+    linhas = VendaDiaria.objects.order_by()
+    if dia_inicio is not None:
+        linhas = linhas.filter(dia__gte=dia_inicio, dia__lte=dia_fim)
+    resultado = {}
+    for row in linhas.values("lavandaria_id", "dia", "metodo_pagamento", "funcionario_id").annotate(
+        **{f"s_{medida}": Sum(medida) for medida in MEDIDAS}
+    ):
+        resultado[(row["lavandaria_id"], row["dia"], row["metodo_pagamento"], row["funcionario_id"])] = {
+            medida: row[f"s_{medida}"] or 0 for medida in MEDIDAS
+        }
+    return resultado
+
+
+def diferencas(calculado, atual):
+    """Chaves cujos totais não coincidem (linhas a zero contam como inexistentes)."""
+    vazio = dict.fromkeys(MEDIDAS, 0)
+    return sorted(
+        (
+            chave for chave in calculado.keys() | atual.keys()
+            if calculado.get(chave, vazio) != atual.get(chave, vazio)
+        ),
+        key=_chave_ordenacao,
+    )
+
+
+def substituir_dias(calculado, dias):
+    """Substitui as linhas dos `dias` dados pelos totais calculados (ver calcular())."""
+    from .models import VendaDiaria
+
+    VendaDiaria.objects.filter(dia__in=dias).delete()
+    VendaDiaria.objects.bulk_create(
+        [
+            VendaDiaria(
+                lavandaria_id=lavandaria_id, dia=dia, metodo_pagamento=metodo, funcionario_id=funcionario_id,
+                **medidas,
+            )
+            for (lavandaria_id, dia, metodo, funcionario_id), medidas in sorted(
+                calculado.items(), key=lambda item: _chave_ordenacao(item[0])
+            )
+            if dia in dias and any(medidas.values())
+        ],
+        batch_size=1000,
+    )
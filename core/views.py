@@ -1,232 +1,126 @@
 from django.shortcuts import get_object_or_404, redirect, render, reverse
-from django.http import HttpResponseBadRequest
-from .models import Pedido, Cliente, Lavandaria, ItemPedido, PagamentoPedido
-from django.template.loader import render_to_string
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import ValidationError
+from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from .models import Pedido, Cliente, ItemPedido, Funcionario, VendaDiaria
 import json
-from django.db.models import (
-    Count, Sum, F, OuterRef, Subquery, DecimalField, Value
-)
-from django.db.models.functions import TruncDate, Coalesce
-from django.utils.timezone import now, timedelta, localtime
-from django.db import models
-from PIL import Image, ImageDraw, ImageFont
-import io
-import base64
-import os
-from django.conf import settings
-from .models import MovimentacaoPontos
-
 from decimal import Decimal
-from django.db.models import DecimalField, Value
+from django.db.models import DecimalField, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils.timezone import timedelta, localtime
+from .middleware import obter_funcionario
+from .recibos import recibo_escpos, recibo_pbm, recibo_pdf, recibo_png, versao_recibo
 
 
-today = localtime().date()
+def imprimir_recibo_imagem(request, pedido_id):
+    # A página só referencia a imagem (recibo_imagem_png), que o browser
+    # revalida com ETag: uma reimpressão sem alterações recebe um 304.
+    if not Pedido.objects.filter(pk=pedido_id).exists():
+        raise Http404("Pedido não encontrado.")
 
-# Calcular a data inicial e o intervalo de 7 dias
-data_inicial = now().date() - timedelta(days=6)
-datas_intervalo = [(data_inicial + timedelta(days=i)) for i in range(7)]
+    return render(request, "core/imprimir_recibo.html", {"pedido_id": pedido_id})
 
-font_path = os.path.join(settings.BASE_DIR, "static/font/Roboto.ttf")
 
+def _recibo_condicional(request, pedido_id, gerar, content_type):
+    """
+    Resposta com o recibo gerado por `gerar(pedido_id, chave)`, com ETag
+    (versão do recibo, ver core.recibos) e Last-Modified (última alteração
+    do pedido); responde 304 a GETs condicionais quando nada mudou.
+    """
+    versao = versao_recibo(pedido_id)
+    if versao is None:
+        raise Http404("Pedido não encontrado.")
+    chave, atualizado_em = versao
 
-def imprimir_recibo_imagem(request, pedido_id):
-    pedido = get_object_or_404(Pedido, id=pedido_id)
+    etag = quote_etag(chave)
+    last_modified = int(atualizado_em.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(gerar(pedido_id, chave=chave), content_type=content_type)
 
-    # Subquery: soma pagamentos por pedido
-    pagos_subq = (
-        PagamentoPedido.objects
-        .filter(pedido=OuterRef("pk"))
-        .values("pedido")
-        .annotate(s=Sum("valor"))
-        .values("s")[:1]
-    )
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    # pode ficar no browser, mas é sempre revalidado (o pedido pode mudar)
+    response["Cache-Control"] = "private, no-cache"
+    return response
 
-    # Buscar todos os pedidos não pagos do mesmo cliente (inclui parcial)
-    pedidos_nao_pagos = (
-        Pedido.objects
-        .filter(cliente=pedido.cliente)
-        .exclude(status_pagamento="pago")
-        .annotate(
-            valor_pago_calc=Coalesce(
-                Subquery(pagos_subq),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )
-        .annotate(
-            saldo_calc=Coalesce(
-                F("total") - F("valor_pago_calc"),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )
-        .order_by("-criado_em")
-    )[:3]
-
-    # ✅ Total em dívida (Decimal safe)
-    total_em_divida = (
-        Pedido.objects
-        .filter(cliente=pedido.cliente)
-        .exclude(status_pagamento="pago")
-        .annotate(
-            valor_pago_calc=Coalesce(
-                Subquery(pagos_subq),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )
-        .annotate(
-            saldo_calc=Coalesce(
-                F("total") - F("valor_pago_calc"),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )
-        .aggregate(
-            total=Coalesce(
-                Sum("saldo_calc"),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )["total"]
-    )
 
-    # ✅ Valor pago neste pedido (soma dos pagamentos)
-    valor_pago = (
-        PagamentoPedido.objects
-        .filter(pedido=pedido)
-        .aggregate(
-            total=Coalesce(
-                Sum("valor"),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )["total"]
-    )
+def recibo_imagem_png(request, pedido_id):
+    """Recibo em image/png (1 bit por omissão, ver RECIBO_MODO_IMAGEM)."""
+    return _recibo_condicional(request, pedido_id, recibo_png, "image/png")
 
-    # ================================
-    # 🔹 CORREÇÃO: Desconto fidelidade aplicado
-    # ================================
-
-    # O desconto já está no campo 'desconto' do pedido
-    # Não precisa buscar em PagamentoPedido com referência específica
-    desconto_aplicado = pedido.desconto or Decimal("0.00")
-
-    # Se quiser identificar se foi desconto de fidelidade (opcional)
-    # Verifica se houve consumo de pontos para este pedido
-    mov_uso_pontos = MovimentacaoPontos.objects.filter(
-        pedido=pedido,
-        tipo="uso"
-    ).first()
-
-    if mov_uso_pontos and desconto_aplicado > 0:
-        # É um desconto de fidelidade (consumiu pontos)
-        desconto_fidelidade = desconto_aplicado
-    else:
-        desconto_fidelidade = Decimal("0.00")
-
-    # Cálculo do saldo considerando o desconto
-    # total_final já é total - desconto (propriedade do modelo Pedido)
-    saldo = (pedido.total_final or Decimal("0.00")) - (valor_pago or Decimal("0.00"))
-    if saldo < 0:
-        saldo = Decimal("0.00")
-
-    ultimo_metodo_pagamento = (
-        PagamentoPedido.objects
-        .filter(pedido=pedido)
-        .order_by("-pago_em", "-id")
-        .values_list("metodo_pagamento", flat=True)
-        .first()
-    )
-    ultimo_metodo_pagamento_label = None
-    if ultimo_metodo_pagamento:
-        ultimo_metodo_pagamento_label = ultimo_metodo_pagamento.replace("_", " ").title()
-
-    mov = MovimentacaoPontos.objects.filter(
-        pedido=pedido,
-        tipo="ganho"
-    ).first()
-
-    # 🎯 Verificar se o pagamento foi feito com pontos
-    pagamento_pontos = PagamentoPedido.objects.filter(
-        pedido=pedido,
-        metodo_pagamento="pontos"
-    ).exists()
-
-    # 🎯 Pontos do cliente
-    pontos_totais = pedido.cliente.pontos
-    equivalente_mzn = Decimal(pontos_totais) * Decimal("0.10")
-
-    pontos_ganhos = mov.pontos if mov else 0
-
-    recibo_texto = render_to_string("core/recibo_termico.txt", {
-        "pedido": pedido,
-        "pedidos_nao_pagos": pedidos_nao_pagos,
-        "total_em_divida": total_em_divida,
-        "valor_pago": valor_pago,
-        "saldo": saldo,
-        "ultimo_metodo_pagamento": ultimo_metodo_pagamento,
-        "ultimo_metodo_pagamento_label": ultimo_metodo_pagamento_label,
-
-        # 🎁 pontos
-        "pontos_ganhos": pontos_ganhos,
-        "pontos_totais": pontos_totais,
-        "equivalente_mzn": equivalente_mzn,
-
-        # 🎁 desconto
-        "desconto_aplicado": desconto_aplicado,
-        "desconto_fidelidade": desconto_fidelidade,
-
-        # 🎁 total com desconto (já incluso no pedido.total_final)
-        "total_final": pedido.total_final,
-    })
-
-    # Restante do código permanece IGUAL...
-    # Ajuste do tamanho da fonte e cálculo da altura
+
+def recibo_imagem_pbm(request, pedido_id):
+    """Recibo em bitmap bruto de 1 bit (PBM), para enviar sem descodificar PNG."""
+    return _recibo_condicional(request, pedido_id, recibo_pbm, "image/x-portable-bitmap")
+
+
+def recibo_pdf_a4(request, pedido_id):
+    """Recibo A4 em PDF (itens, total e estado do pagamento)."""
+    return _recibo_condicional(request, pedido_id, recibo_pdf, "application/pdf")
+
+
+def imprimir_recibo_escpos(request, pedido_id):
+    """
+    Recibo em ESC/POS (bytes para enviar em bruto à impressora térmica):
+    texto nativo, negrito, logótipo de 1 bit e corte de papel.
+    """
     try:
-        font = ImageFont.load_default(size=18)
-    except IOError:
-        font = ImageFont.load_default(size=21)
+        dados = recibo_escpos(pedido_id)
+    except Pedido.DoesNotExist:
+        raise Http404("Pedido não encontrado.")
+
+    response = HttpResponse(dados, content_type="application/octet-stream")
+    response["Content-Disposition"] = f'attachment; filename="recibo-{pedido_id}.bin"'
+    return response
 
-    largura = 400
-    altura_texto = 0
-    draw = ImageDraw.Draw(Image.new("RGB", (largura, 1)))
 
-    for linha in recibo_texto.split("\n"):
-        _, _, _, altura_linha = draw.textbbox((0, 0), linha, font=font)
-        altura_texto += altura_linha + 6
+@staff_member_required
+@require_POST
+def adicionar_itens_pedido(request, pedido_id):
+    """
+    Entrada em lote de artigos num pedido (JSON).
 
-    espaco_logo = 100
-    altura = max(altura_texto + espaco_logo, 200)
+    Corpo esperado:
+        {"itens": [{"item_de_servico": 1, "quantidade": 3, "descricao": "..."}, ...]}
+    """
+    if not request.user.has_perm("core.add_itempedido"):
+        return HttpResponseForbidden("Sem permissão para adicionar artigos.")
 
-    img = Image.new("RGB", (largura, altura), "white")
-    draw = ImageDraw.Draw(img)
+    pedido = get_object_or_404(Pedido, id=pedido_id)
+
+    if not request.user.is_superuser:
+        try:
+            funcionario = obter_funcionario(request)
+        except Funcionario.DoesNotExist:
+            return HttpResponseForbidden("O usuário logado não está associado a nenhum funcionário.")
+        if funcionario.lavandaria_id != pedido.lavandaria_id:
+            return HttpResponseForbidden("Pedido de outra lavandaria.")
 
-    # LOGO
     try:
-        logo_path = os.path.join(settings.BASE_DIR, "static/img/local/logo.jpg")
-        logo = Image.open(logo_path).convert("RGBA")
-        logo = logo.resize((160, 100))
-
-        x_logo = (largura - logo.width) // 2
-        img.paste(logo, (x_logo, 10), logo)
-    except Exception:
-        pass
-
-    draw.multiline_text(
-        (10, espaco_logo),
-        recibo_texto,
-        fill="black",
-        font=font,
-        spacing=4
-    )
+        dados = json.loads(request.body or b"{}")
+        itens = dados["itens"]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"erro": "JSON inválido: esperado {\"itens\": [...]}"}, status=400)
 
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    if not isinstance(itens, list) or not all(isinstance(i, dict) for i in itens):
+        return JsonResponse({"erro": "\"itens\" deve ser uma lista de objetos."}, status=400)
 
-    return render(request, "core/imprimir_recibo.html", {"img_base64": img_base64})
+    try:
+        criados = pedido.adicionar_itens(itens)
+    except ValidationError as e:
+        return JsonResponse({"erro": " ".join(e.messages)}, status=400)
+
+    return JsonResponse({
+        "pedido": pedido.id,
+        "itens_criados": len(criados),
+        "total": f"{pedido.total:.2f}",
+        "total_final": f"{pedido.total_final:.2f}",
+        "saldo": f"{pedido.saldo:.2f}",
+    }, status=201)
 
 
 def meu_pedido(request):
@@ -246,74 +140,55 @@ def meu_pedido_details(request, pedido_id):
 
 
 def dashboard_callback(request, context):
-    total_pedidos = Pedido.objects.count()
+    # Totais lidos de VendaDiaria (core/vendas_diarias.py): o custo depende
+    # do número de dias, não do número de pedidos/pagamentos.
+    hoje = localtime().date()
+    data_inicial = hoje - timedelta(days=6)
+    datas_intervalo = [(data_inicial + timedelta(days=i)) for i in range(7)]
+
+    totais = VendaDiaria.objects.aggregate(
+        pedidos=Coalesce(Sum("pedidos"), 0),
+        pedidos_pagos=Coalesce(Sum("pedidos_pagos"), 0),
+        recebido=Coalesce(
+            Sum("valor_recebido"),
+            Value(Decimal("0.00")),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ),
+    )
+    total_pedidos = totais["pedidos"]
 
     # Para parcial: "não pago" = status_pagamento != pago
-    pedidos_nao_pagos = Pedido.objects.exclude(status_pagamento="pago").count()
+    pedidos_nao_pagos = totais["pedidos"] - totais["pedidos_pagos"]
 
     total_clientes = Cliente.objects.count()
 
-    # Pedidos pagos (quitados)
-    pedidos_pagos = Pedido.objects.filter(status_pagamento="pago")
-
     # Pedidos e vendas por dia (últimos 7 dias) — baseado em pedidos quitados
     pedidos_por_dia = (
-        pedidos_pagos.filter(criado_em__date__gte=data_inicial)
-        .annotate(data=TruncDate("criado_em"))
-        .values("data")
-        .annotate(
-            total_pedidos=Count("id"),
-            total_vendas=Coalesce(
-                Sum("total"),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            ),
-        )
+        VendaDiaria.objects.filter(dia__gte=data_inicial)
+        .values("dia")
+        .annotate(total_pedidos=Sum("pedidos_pagos"), total_vendas=Sum("valor_pedidos_pagos"))
+        .order_by("dia")
     )
 
-    pedidos_dict = {str(p["data"]): p["total_pedidos"] for p in pedidos_por_dia}
-    vendas_dict = {str(p["data"]): float(p["total_vendas"] or 0) for p in pedidos_por_dia}
+    pedidos_dict = {str(p["dia"]): p["total_pedidos"] for p in pedidos_por_dia}
+    vendas_dict = {str(p["dia"]): float(p["total_vendas"] or 0) for p in pedidos_por_dia}
 
     labels = [str(data) for data in datas_intervalo]
     data_pedidos = [pedidos_dict.get(str(data), 0) for data in datas_intervalo]
     data_vendas = [vendas_dict.get(str(data), 0) for data in datas_intervalo]
 
-    # Lavandarias: pedidos do dia + vendas do dia (quitados)
-    lavandarias = Lavandaria.objects.annotate(
-        numero_pedidos=Count("pedidos", filter=models.Q(pedidos__criado_em__date=today)),
-        total_vendas=Coalesce(
-            Sum(
-                "pedidos__total",
-                filter=models.Q(pedidos__criado_em__date=today, pedidos__status_pagamento="pago"),
-            ),
-            Value(Decimal("0.00")),
-            output_field=DecimalField(max_digits=12, decimal_places=2),
-        ),
-    )
-
-    # Vendas por lavandaria e método: baseado em PagamentoPedido (recebimentos reais)
+    # Vendas por lavandaria e método: recebimentos reais do dia (caixa do dia)
     vendas_por_lavandaria = (
-        PagamentoPedido.objects
-        .filter(pedido__criado_em__date=today)  # ou pago_em__date=today se quiser “caixa do dia”
-        .select_related("pedido__lavandaria")
-        .values("pedido__lavandaria_id", "pedido__lavandaria__nome", "metodo_pagamento")
-        .annotate(
-            total_vendas=Coalesce(
-                Sum("valor"),
-                Value(Decimal("0.00")),
-                output_field=DecimalField(max_digits=12, decimal_places=2),
-            )
-        )
-        .order_by("pedido__lavandaria__nome", "metodo_pagamento")
+        VendaDiaria.objects
+        .filter(dia=hoje)
+        .exclude(metodo_pagamento="")
+        .values("lavandaria_id", "lavandaria__nome", "metodo_pagamento")
+        .annotate(total_vendas=Sum("valor_recebido"))
+        .filter(total_vendas__gt=0)
+        .order_by("lavandaria__nome", "metodo_pagamento")
     )
 
-    total_vendas = PagamentoPedido.objects.aggregate(
-        total=Coalesce(
-            Sum("valor"),
-            Value(Decimal("0.00")),
-            output_field=DecimalField(max_digits=12, decimal_places=2),
-        )
-    )["total"]
+    total_vendas = totais["recebido"]
 
     context.update(
         {
@@ -345,7 +220,7 @@ def dashboard_callback(request, context):
                 "headers": ["Lavandaria", "Método de Pagamento", "Total Diário"],
                 "rows": [
                     [
-                        venda.get("pedido__lavandaria__nome", "Desconhecida"),
+                        venda.get("lavandaria__nome", "Desconhecida"),
                         venda.get("metodo_pagamento", "Indefinido").replace("_", " ").title(),
                         f"{float(venda.get('total_vendas', 0) or 0):,.2f} MZN",
                     ]
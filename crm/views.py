@@ -5,7 +5,8 @@ from django.core.paginator import Paginator
 from django.db.models import Count, Sum, Avg, Max, Min, Q
 from django.utils import timezone
 
-from core.models import Cliente, Pedido, Funcionario
+from core.middleware import obter_funcionario
+from core.models import Cliente, Funcionario, VendaDiaria
 
 
 @staff_member_required
@@ -13,7 +14,6 @@ def crm_pos_venda(request):
     hoje = timezone.now()
     limite_ativos = hoje - timedelta(days=30)
     limite_risco = hoje - timedelta(days=45)
-    ultimos_7_dias = hoje - timedelta(days=6)
 
     # ======================
     # LAVANDARIA CONTEXTO (IGUAL AO ADMIN)
@@ -21,7 +21,7 @@ def crm_pos_venda(request):
     lavandaria = None
     if not request.user.is_superuser:
         try:
-            funcionario = Funcionario.objects.get(user=request.user)
+            funcionario = obter_funcionario(request)
             lavandaria = funcionario.lavandaria
             if not lavandaria:
                 raise ValueError("O funcionário logado não está associado a nenhuma lavandaria.")
@@ -37,11 +37,16 @@ def crm_pos_venda(request):
     page_number = request.GET.get("page", 1)
 
     # ======================
-    # BASE: PEDIDOS (FILTRADO POR LAVANDARIA)
+    # BASE: TOTAIS DIÁRIOS DE PEDIDOS (FILTRADO POR LAVANDARIA)
     # ======================
-    pedidos_base = Pedido.objects.all()
+    # VendaDiaria (core/vendas_diarias.py): contagens e somas de pedidos sem
+    # percorrer a tabela de pedidos
+    vendas_diarias = VendaDiaria.objects.all()
     if lavandaria:
-        pedidos_base = pedidos_base.filter(lavandaria=lavandaria)
+        vendas_diarias = vendas_diarias.filter(lavandaria=lavandaria)
+    totais_pedidos = vendas_diarias.aggregate(
+        pedidos=Sum("pedidos"), pedidos_pagos=Sum("pedidos_pagos"), valor=Sum("valor_pedidos"),
+    )
 
     # ======================
     # CLIENTES QS (ANNOTATE POR LAVANDARIA)
@@ -104,11 +109,13 @@ def crm_pos_venda(request):
 
     clientes_recorrentes = clientes_qs.filter(total_pedidos__gte=2).count()
 
-    ticket_medio = pedidos_base.aggregate(v=Avg("total"))["v"] or 0
+    ticket_medio = (
+        totais_pedidos["valor"] / totais_pedidos["pedidos"] if totais_pedidos["pedidos"] else 0
+    )
 
     ltv_medio = clientes_qs.aggregate(m=Avg("total_gasto"))["m"] or 0
 
-    pedidos_nao_pagos = pedidos_base.filter(pago=False).count()
+    pedidos_nao_pagos = (totais_pedidos["pedidos"] or 0) - (totais_pedidos["pedidos_pagos"] or 0)
 
     clientes_vip = clientes_qs.filter(total_gasto__gte=10000).count()
 
@@ -125,44 +132,27 @@ def crm_pos_venda(request):
     ]
 
     # ======================
-    # GRÁFICO – PEDIDOS (7 DIAS)
+    # GRÁFICOS – PEDIDOS E VENDAS (7 DIAS)
     # ======================
-    pedidos_qs = (
-        pedidos_base
-        .filter(criado_em__date__gte=ultimos_7_dias.date())
-        .extra(select={"dia": "DATE(criado_em)"})
+    primeiro_dia = timezone.localdate() - timedelta(days=6)
+    por_dia = {
+        row["dia"]: row
+        for row in vendas_diarias
+        .filter(dia__gte=primeiro_dia)
         .values("dia")
-        .annotate(total=Count("id"))
+        .annotate(pedidos=Sum("pedidos"), vendas=Sum("valor_pedidos"))
         .order_by("dia")
-    )
+    }
 
-    labels, pedidos_data = [], []
+    labels, pedidos_data, vendas_data = [], [], []
     for i in range(7):
-        dia = (ultimos_7_dias + timedelta(days=i)).date()
+        dia = primeiro_dia + timedelta(days=i)
         labels.append(dia.strftime("%d/%m"))
-        valor = next((p["total"] for p in pedidos_qs if p["dia"] == dia), 0)
-        pedidos_data.append(valor)
+        row = por_dia.get(dia, {})
+        pedidos_data.append(row.get("pedidos") or 0)
+        vendas_data.append(float(row.get("vendas") or 0))
 
     pedidosChartData = {"labels": labels, "datasets": [{"label": "Pedidos", "data": pedidos_data}]}
-
-    # ======================
-    # GRÁFICO – VENDAS (7 DIAS)
-    # ======================
-    vendas_qs = (
-        pedidos_base
-        .filter(criado_em__date__gte=ultimos_7_dias.date())
-        .extra(select={"dia": "DATE(criado_em)"})
-        .values("dia")
-        .annotate(total=Sum("total"))
-        .order_by("dia")
-    )
-
-    vendas_data = []
-    for i in range(7):
-        dia = (ultimos_7_dias + timedelta(days=i)).date()
-        valor = next((v["total"] for v in vendas_qs if v["dia"] == dia), 0)
-        vendas_data.append(float(valor or 0))
-
     vendasChartData = {"labels": labels, "datasets": [{"label": "Vendas", "data": vendas_data}]}
 
     # ======================
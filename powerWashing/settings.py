@@ -56,6 +56,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.FuncionarioMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -145,6 +146,38 @@ MEDIA_ROOT = BASE_DIR / 'static/images/service'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Pedido.total / soma_pagamentos mantidos por deltas (F()) em vez de re-agregar.
+# Desvios são corrigidos por: python manage.py verificar_totais_pedidos --corrigir
+PEDIDO_TOTAIS_INCREMENTAIS = True
+
+# Catálogo de artigos em memória (core/catalogo.py): intervalo, em segundos,
+# entre verificações da versão na base (alterações noutros workers).
+CATALOGO_VERIFICAR_SEGUNDOS = 5
+
+# Cache (por processo) das imagens de recibo já desenhadas, em bytes.
+RECIBO_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Processos para desenhar recibos em lote (None: até 4, conforme os CPUs;
+# 0: desenha no próprio processo, sem pool).
+RECIBO_PROCESSOS = None
+
+# Modo das imagens de recibo: "1" (preto e branco, PNG pequeno) ou "RGB".
+RECIBO_MODO_IMAGEM = "1"
+
+# Relatórios PDF do admin: gerados pelo worker (processar_relatorios, ver
+# Procfile). False: gerados no próprio pedido (desenvolvimento sem worker).
+RELATORIOS_EM_SEGUNDO_PLANO = True
+# Horas que um relatório terminado fica disponível para descarregar.
+RELATORIO_RETENCAO_HORAS = 72
+# Minutos sem progresso até uma tarefa "em curso" voltar à fila.
+RELATORIO_TAREFA_PARADA_MINUTOS = 15
+# Relatórios financeiros de dias fechados (core/relatorios_fechados.py): um
+# dia fecha estes minutos depois da meia-noite; os ficheiros gerados ficam
+# guardados estes dias.
+RELATORIO_FECHO_MINUTOS = 10
+RELATORIO_FECHADO_RETENCAO_DIAS = 30
+
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedStaticFilesStorage'
 django_heroku.settings(locals())
 